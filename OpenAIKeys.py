@@ -1,20 +1,98 @@
 import os
+import re
+import json
 import time
+import email.utils
+import heapq
+import hashlib
 import random
 import asyncio
-from openai import AsyncOpenAI
+import contextlib
+from collections import deque
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+from usage_tracker import usage_tracker
+
+# ---------------- Shared HTTP transport ---------------- #
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", "30"))
+
+_shared_http_client = None
+
+def get_shared_http_client():
+    """One connection pool for every key/client (recreated lazily after close)."""
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        # Limits class taken from openai's own default so it matches its httpx build
+        limits_cls = type(DEFAULT_CONNECTION_LIMITS)
+        _shared_http_client = DefaultAsyncHttpxClient(
+            limits=limits_cls(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            )
+        )
+    return _shared_http_client
+
+def build_client(key: str) -> AsyncOpenAI:
+    """AsyncOpenAI bound to `key` that rides on the shared transport (retries are ours, not the SDK's)."""
+    return AsyncOpenAI(api_key=key, http_client=get_shared_http_client(), max_retries=0)
+
+KEY_POLICIES = ("random", "least_outstanding", "health_weighted", "token_bucket")
+
+class TokenBucket:
+    """Per-minute token bucket that refills continuously (used for per-key RPM/TPM)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def level(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, amount: float = 1.0):
+        """Consume tokens; may go negative so post-hoc usage (TPM) is still charged."""
+        self.level()
+        self.tokens -= amount
 
 class OpenAIKeyManager:
-    def __init__(self, keys: list[str], cooldown_seconds: int = 3, is_image: bool = False):
+    def __init__(self, keys: list[str], cooldown_seconds: int = 3, is_image: bool = False,
+                 policy: str | None = None, rpm: int | None = None, tpm: int | None = None,
+                 max_outstanding: int | None = None):
         if not keys:
             raise RuntimeError("No OpenAI API keys were provided.")
 
         self.keys = {k: 0 for k in keys}  # key -> cooldown_until timestamp
-        self.stats = {
-            k: {"uses": 0, "failures": 0, "cooldowns": 0,
-                "last_used": 0, "health": 100}
-            for k in keys
-        }
+        self.stats = {k: self._new_stats() for k in keys}
+
+        # Availability index: keys not cooling down (list + position map for O(1)
+        # add/remove) and a min-heap of (cooldown_until, key) drained lazily.
+        self._available = []
+        self._available_pos = {}
+        self._cooldown_heap = []
+        for k in self.keys:
+            self._mark_available(k)
+
+        # Scheduling policy (see KEY_POLICIES) + optional per-key rate budgets
+        self.policy = policy or os.getenv("OPENAI_KEY_POLICY", "least_outstanding")
+        if self.policy not in KEY_POLICIES:
+            print(f"[OpenAI] ⚠️ Unknown key policy {self.policy!r}, using least_outstanding")
+            self.policy = "least_outstanding"
+        self.rpm = rpm if rpm is not None else int(os.getenv("OPENAI_KEY_RPM", "0"))  # 0 = unlimited
+        self.tpm = tpm if tpm is not None else int(os.getenv("OPENAI_KEY_TPM", "0"))  # 0 = unlimited
+        self.max_outstanding = max_outstanding or int(os.getenv("OPENAI_KEY_MAX_OUTSTANDING", "4"))
+        self.buckets = {}  # key -> (rpm bucket | None, tpm bucket | None)
+        for k in keys:
+            self._init_buckets(k)
+        self.rebalances = 0
+
         self.cooldown_seconds = cooldown_seconds
         self.current_key = keys[0]
         self.is_image = is_image
@@ -25,6 +103,100 @@ class OpenAIKeyManager:
         self.guild_key_map = {}
         self.user_key_map = {}
 
+    @staticmethod
+    def _new_stats():
+        return {"uses": 0, "failures": 0, "cooldowns": 0,
+                "last_used": 0, "health": 100, "outstanding": 0}
+
+    def _init_buckets(self, key):
+        self.buckets[key] = (
+            TokenBucket(self.rpm) if self.rpm else None,
+            TokenBucket(self.tpm) if self.tpm else None,
+        )
+
+    def add_key(self, key):
+        """Register a newly discovered key (no-op if already known)."""
+        if key in self.keys:
+            return False
+        self.keys[key] = 0
+        self.stats[key] = self._new_stats()
+        self._init_buckets(key)
+        self._mark_available(key)
+        return True
+
+    # ---------------- Scheduling ---------------- #
+
+    def has_budget(self, key) -> bool:
+        """True if the key still has RPM/TPM budget (always True without buckets)."""
+        rpm_bucket, tpm_bucket = self.buckets.get(key, (None, None))
+        if rpm_bucket and rpm_bucket.level() < 1:
+            return False
+        if tpm_bucket and tpm_bucket.level() <= 0:
+            return False
+        return True
+
+    def is_saturated(self, key) -> bool:
+        stats = self.stats.get(key)
+        if stats is None:
+            return True
+        return stats["outstanding"] >= self.max_outstanding or not self.has_budget(key)
+
+    def _load(self, key):
+        """Lower is better: fewer in-flight requests first, then healthier."""
+        stats = self.stats[key]
+        return (stats["outstanding"], -stats["health"])
+
+    def choose_key(self, available: list[str]):
+        """Pick a key from `available` according to self.policy."""
+        if not available:
+            return None
+        if self.policy == "random" or len(available) == 1:
+            return random.choice(available)
+
+        if self.policy == "health_weighted":
+            weights = [
+                (self.stats[k]["health"] + 1) / (1 + self.stats[k]["outstanding"])
+                for k in available
+            ]
+            return random.choices(available, weights=weights, k=1)[0]
+
+        candidates = available
+        if self.policy == "token_bucket":
+            candidates = [k for k in available if self.has_budget(k)] or available
+
+        # least_outstanding: "power of two choices" — sample two, keep the less loaded
+        a, b = random.sample(candidates, 2) if len(candidates) > 1 else (candidates[0], candidates[0])
+        return a if self._load(a) <= self._load(b) else b
+
+    def begin_request(self, key):
+        stats = self.stats.get(key)
+        if stats is not None:
+            stats["outstanding"] += 1
+        rpm_bucket, _ = self.buckets.get(key, (None, None))
+        if rpm_bucket:
+            rpm_bucket.take(1)
+
+    def end_request(self, key, result=None):
+        stats = self.stats.get(key)
+        if stats is not None:
+            stats["outstanding"] = max(0, stats["outstanding"] - 1)
+        _, tpm_bucket = self.buckets.get(key, (None, None))
+        usage = getattr(result, "usage", None)
+        if tpm_bucket and usage is not None:
+            tpm_bucket.take(getattr(usage, "total_tokens", 0) or 0)
+
+    def summary(self) -> dict:
+        outstanding = sum(s["outstanding"] for s in self.stats.values())
+        hottest = sorted(self.stats.items(), key=lambda kv: kv[1]["uses"], reverse=True)[:3]
+        return {
+            "policy": self.policy,
+            "keys": len(self.keys),
+            "available": len(self.available_keys()),
+            "outstanding": outstanding,
+            "rebalances": self.rebalances,
+            "hottest": [(k[:8], s["uses"], s["outstanding"]) for k, s in hottest],
+        }
+
     # ---------------- Context assignment ---------------- #
 
     def assign_key_for_guild(self, guild_id: int | None):
@@ -34,7 +206,7 @@ class OpenAIKeyManager:
         available = self.available_keys()
         if not available:
             return None
-        chosen = random.choice(available)
+        chosen = self.choose_key(available)
         self.guild_key_map[guild_id] = chosen
         print(f"[OpenAI] 🏰 Guild {guild_id} → key {chosen[:16]}...")
         return chosen
@@ -44,7 +216,7 @@ class OpenAIKeyManager:
         available = self.available_keys()
         if not available:
             return None
-        chosen = random.choice(available)
+        chosen = self.choose_key(available)
         self.user_key_map[user_id] = chosen
         print(f"[OpenAI] 👤 User {user_id} → key {chosen[:16]}...")
         return chosen
@@ -56,7 +228,7 @@ class OpenAIKeyManager:
         available = self.available_keys()
         if not available:
             return None
-        chosen = random.choice(available)
+        chosen = self.choose_key(available)
         if is_guild:
             self.guild_key_map[context_id] = chosen
             print(f"[OpenAI] 🔄 Guild {context_id} switched → {chosen[:16]}...")
@@ -75,9 +247,9 @@ class OpenAIKeyManager:
 
         if context_id is None:
             # DM fallback: just pick any available key
-            key = random.choice(available)
+            key = self.choose_key(available)
             self.current_key = key
-            return AsyncOpenAI(api_key=key)
+            return self.client_for_key(key)
 
         if is_guild:
             if context_id not in self.guild_key_map:
@@ -91,18 +263,29 @@ class OpenAIKeyManager:
         if not key:
             return None
 
+        # Pinned key is busy or out of budget → move this context to a quieter key
+        if self.policy != "random" and self.is_saturated(key) and len(available) > 1:
+            quieter = [k for k in available if k != key and not self.is_saturated(k)]
+            if quieter:
+                key = self.reassign_key(context_id, is_guild) or key
+                self.rebalances += 1
+
         now = time.time()
         cooldown_until = self.keys.get(key, 0)
         if now < cooldown_until:
             # Instead of blocking, rotate key immediately
-            return AsyncOpenAI(api_key=random.choice(available))
+            return self.client_for_key(self.choose_key(available))
 
         self.current_key = key
         self.stats[key]["last_used"] = now
+        return self.client_for_key(key)
 
-        if key not in self.client_cache:
-            self.client_cache[key] = AsyncOpenAI(api_key=key)
-        return self.client_cache[key]
+    def client_for_key(self, key: str) -> AsyncOpenAI:
+        """Build each key's client once; all of them share one HTTP pool."""
+        client = self.client_cache.get(key)
+        if client is None or client._client.is_closed:
+            client = self.client_cache[key] = build_client(key)
+        return client
 
     # ---------------- Key marking ---------------- #
 
@@ -118,99 +301,616 @@ class OpenAIKeyManager:
             self.stats[key]["failures"] += 1
             self.stats[key]["health"] = max(0, self.stats[key]["health"] - 5)
 
-    def mark_cooldown(self, key=None):
+    def mark_cooldown(self, key=None, seconds: float | None = None):
+        """Cool `key` down for `seconds` (server-provided) or the default cooldown."""
         key = key or self.current_key
-        self.keys[key] = time.time() + self.cooldown_seconds
+        if key not in self.keys:
+            return  # already dropped
+        seconds = self.cooldown_seconds if seconds is None else seconds
+        until = max(self.keys[key], time.time() + seconds)  # never shorten an existing cooldown
+        self.keys[key] = until
+        self._mark_unavailable(key)
+        heapq.heappush(self._cooldown_heap, (until, key))
         self.stats[key]["cooldowns"] += 1
-        print(f"[OpenAI] ⏳ Cooldown {self.cooldown_seconds}s for {key[:8]}...")
+        print(f"[OpenAI] ⏳ Cooldown {seconds:.2f}s for {key[:8]}...")
 
     def drop_key(self, key, reason: str):
+        self._mark_unavailable(key)
         self.keys.pop(key, None)
         self.stats.pop(key, None)
+        self.buckets.pop(key, None)
+        self.client_cache.pop(key, None)
         print(f"[OpenAI] 🗑️ Dropped key {key[:8]} ({reason})")
         if not self.keys and self.on_all_keys_exhausted:
             asyncio.create_task(self.on_all_keys_exhausted())
 
     # ---------------- Helpers ---------------- #
 
-    def available_keys(self):
+    def _mark_available(self, key):
+        if key not in self._available_pos:
+            self._available_pos[key] = len(self._available)
+            self._available.append(key)
+
+    def _mark_unavailable(self, key):
+        pos = self._available_pos.pop(key, None)
+        if pos is None:
+            return
+        last = self._available.pop()
+        if last != key:
+            # Swap the tail into the hole to keep removal O(1)
+            self._available[pos] = last
+            self._available_pos[last] = pos
+
+    def _release_expired(self):
+        """Pop every expired cooldown off the heap (stale/dropped entries are skipped)."""
+        heap = self._cooldown_heap
+        if not heap or heap[0][0] > time.time():
+            return
         now = time.time()
-        return [k for k, until in self.keys.items() if now >= until]
+        while heap and heap[0][0] <= now:
+            until, key = heapq.heappop(heap)
+            if key in self.keys and self.keys[key] <= now:
+                self._mark_available(key)
+
+    def next_release_in(self) -> float:
+        """Seconds until the next cooling key becomes available (0 if one already is)."""
+        self._release_expired()
+        if self._available:
+            return 0.0
+        heap = self._cooldown_heap
+        while heap and self.keys.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)  # stale: key dropped or its cooldown was extended
+        if not heap:
+            return float(self.cooldown_seconds)
+        return max(0.0, heap[0][0] - time.time())
+
+    def available_keys(self):
+        """Keys not cooling down. Returns the live index — treat it as read-only."""
+        self._release_expired()
+        return self._available
+
+# ---------------- Work scheduler ---------------- #
+
+PRIORITY_INTERACTIVE = 0  # DMs and mentions
+PRIORITY_CHANNEL = 1      # normal channel chat, image requests
+PRIORITY_IDLE = 2         # idle chat lines / classification
+PRIORITY_MAINTENANCE = 3  # key rescans and other background work
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_CHANNEL: "channel",
+    PRIORITY_IDLE: "idle",
+    PRIORITY_MAINTENANCE: "maintenance",
+}
+
+class WorkShedError(RuntimeError):
+    """Raised when low-priority work is dropped instead of queued."""
+
+class CommittedCallError(Exception):
+    """
+    Raised by an openai_safe_call `fn` that failed after output was already
+    delivered (e.g. mid-stream): the wrapped error still counts against the
+    key (cooldown/drop), but the call is not retried. openai_safe_call
+    re-raises the original error.
+    """
+
+    def __init__(self, error: Exception):
+        super().__init__(str(error))
+        self.error = error
+
+class WorkScheduler:
+    """
+    Admission control in front of openai_safe_call.
+
+    At most `max_concurrency` calls run at once, and each priority class has
+    its own cap. Waiters are woken strictly by priority (lower number first).
+    Idle/maintenance work is shed (WorkShedError) when its queue is full or
+    when higher-priority work is already waiting.
+    """
+
+    def __init__(self, max_concurrency: int | None = None, class_limits: dict | None = None,
+                 queue_limits: dict | None = None):
+        self.max_concurrency = max_concurrency or int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+        self.class_limits = class_limits or {
+            PRIORITY_INTERACTIVE: self.max_concurrency,
+            PRIORITY_CHANNEL: int(os.getenv("OPENAI_CHANNEL_CONCURRENCY", str(max(1, self.max_concurrency * 3 // 4)))),
+            PRIORITY_IDLE: int(os.getenv("OPENAI_IDLE_CONCURRENCY", "2")),
+            PRIORITY_MAINTENANCE: int(os.getenv("OPENAI_MAINTENANCE_CONCURRENCY", "2")),
+        }
+        self.queue_limits = queue_limits or {  # None = never shed
+            PRIORITY_INTERACTIVE: None,
+            PRIORITY_CHANNEL: None,
+            PRIORITY_IDLE: 4,
+            PRIORITY_MAINTENANCE: 16,
+        }
+        self.running = {p: 0 for p in PRIORITY_NAMES}
+        self.waiters = {p: deque() for p in PRIORITY_NAMES}
+        self.stats = {
+            p: {"admitted": 0, "queued": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for p in PRIORITY_NAMES
+        }
+
+    @property
+    def total_running(self) -> int:
+        return sum(self.running.values())
+
+    def _can_run(self, priority: int) -> bool:
+        return (self.total_running < self.max_concurrency
+                and self.running[priority] < self.class_limits[priority])
+
+    def _higher_waiting(self, priority: int) -> bool:
+        return any(self.waiters[p] for p in PRIORITY_NAMES if p < priority)
+
+    def _should_shed(self, priority: int) -> bool:
+        limit = self.queue_limits.get(priority)
+        if priority < PRIORITY_IDLE:
+            return False
+        return self._higher_waiting(priority) or (limit is not None and len(self.waiters[priority]) >= limit)
+
+    def _admit(self, priority: int, waited: float):
+        self.running[priority] += 1
+        stats = self.stats[priority]
+        stats["admitted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def _dispatch(self):
+        for priority in sorted(PRIORITY_NAMES):
+            queue = self.waiters[priority]
+            while queue and self._can_run(priority):
+                future, queued_at = queue.popleft()
+                if future.done():  # cancelled while waiting
+                    continue
+                self._admit(priority, time.monotonic() - queued_at)
+                future.set_result(True)
+
+    async def acquire(self, priority: int = PRIORITY_CHANNEL, shed: bool = True):
+        if self._can_run(priority) and not self._higher_waiting(priority) and not self.waiters[priority]:
+            self._admit(priority, 0.0)
+            return
+        if shed and self._should_shed(priority):
+            self.stats[priority]["shed"] += 1
+            raise WorkShedError(f"{PRIORITY_NAMES[priority]} work shed under load")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, time.monotonic())
+        self.waiters[priority].append(entry)
+        self.stats[priority]["queued"] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(priority)  # admitted just before the cancel landed
+            else:
+                try:
+                    self.waiters[priority].remove(entry)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, priority: int):
+        self.running[priority] = max(0, self.running[priority] - 1)
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_CHANNEL, shed: bool = True):
+        await self.acquire(priority, shed=shed)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def summary(self) -> dict:
+        return {
+            PRIORITY_NAMES[p]: {
+                "running": self.running[p],
+                "waiting": len(self.waiters[p]),
+                "limit": self.class_limits[p],
+                "avg_wait": s["wait_total"] / s["admitted"] if s["admitted"] else 0.0,
+                **s,
+            }
+            for p, s in self.stats.items()
+        }
+
+work_scheduler = WorkScheduler()
+
+# ---------------- Model router ---------------- #
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    closed → open after `failure_threshold` consecutive failures; open → half-open
+    once `reset_timeout` seconds have passed, letting one probe through; the probe's
+    outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def is_open(self) -> bool:
+        """Open and not yet due for a probe (does not change state)."""
+        if self.state == CIRCUIT_OPEN:
+            return time.monotonic() < self.opened_at + self.reset_timeout
+        return self.state == CIRCUIT_HALF_OPEN and self.probing
+
+    def allow(self) -> bool:
+        if self.state == CIRCUIT_CLOSED:
+            return True
+        if self.state == CIRCUIT_OPEN:
+            if time.monotonic() < self.opened_at + self.reset_timeout:
+                return False
+            self.state = CIRCUIT_HALF_OPEN
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CIRCUIT_OPEN:
+                self.trips += 1
+            self.state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """The attempt was cancelled (e.g. lost a hedge) — free the probe slot."""
+        self.probing = False
+
+class ModelRouter:
+    """
+    Per-model circuit breakers plus a rolling latency/error window used to
+    reorder a model priority list. Earlier (cheaper) models keep a preference
+    bias of `order_bias` per position, so a later model only moves ahead when
+    it is clearly faster or the earlier one is erroring.
+    """
+
+    def __init__(self, failure_threshold: int | None = None, reset_timeout: float | None = None,
+                 window: int = 100, min_samples: int = 5, order_bias: float = 0.25):
+        self.failure_threshold = failure_threshold or int(os.getenv("MODEL_BREAKER_FAILURES", "5"))
+        self.reset_timeout = reset_timeout or float(os.getenv("MODEL_BREAKER_RESET", "30"))
+        self.window = window
+        self.min_samples = min_samples
+        self.order_bias = order_bias
+        self.breakers = {}  # model -> CircuitBreaker
+        self.outcomes = {}  # model -> deque[(ok, seconds)]
+
+    def _breaker(self, model) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def _window(self, model) -> deque:
+        window = self.outcomes.get(model)
+        if window is None:
+            window = self.outcomes[model] = deque(maxlen=self.window)
+        return window
+
+    def allow(self, model, force: bool = False) -> bool:
+        """May `model` be tried now? force=True is the caller's last resort."""
+        return self._breaker(model).allow() or force
+
+    def record_success(self, model, seconds: float):
+        self._breaker(model).record_success()
+        self._window(model).append((True, seconds))
+
+    def record_failure(self, model):
+        breaker = self._breaker(model)
+        was_open = breaker.state == CIRCUIT_OPEN
+        breaker.record_failure()
+        self._window(model).append((False, None))
+        if breaker.state == CIRCUIT_OPEN and not was_open:
+            print(f"[OpenAI] 🔌 Circuit open for {model} ({breaker.reset_timeout:.0f}s)")
+
+    def abandon(self, model):
+        self._breaker(model).abandon()
+
+    def error_rate(self, model) -> float:
+        window = self.outcomes.get(model)
+        if not window:
+            return 0.0
+        return sum(1 for ok, _ in window if not ok) / len(window)
+
+    def mean_latency(self, model):
+        samples = [s for ok, s in self.outcomes.get(model, ()) if ok]
+        return sum(samples) / len(samples) if samples else None
+
+    def score(self, model):
+        """Lower is better: mean latency inflated by the error rate (None until enough samples)."""
+        window = self.outcomes.get(model)
+        latency = self.mean_latency(model)
+        if not window or len(window) < self.min_samples or latency is None:
+            return None
+        return latency * (1 + 4 * self.error_rate(model))
+
+    def order(self, models: list[str]) -> list[str]:
+        """Return `models` reordered by health/latency; open circuits go last."""
+        scores = {m: self.score(m) for m in models}
+        known = [s for s in scores.values() if s is not None]
+        baseline = min(known) if known else 1.0
+
+        def rank(item):
+            index, model = item
+            score = scores[model] if scores[model] is not None else baseline
+            return (self._breaker(model).is_open(), score * (1 + self.order_bias * index))
+
+        return [m for _, m in sorted(enumerate(models), key=rank)]
+
+    def summary(self) -> dict:
+        return {
+            model: {
+                "state": breaker.state,
+                "trips": breaker.trips,
+                "error_rate": self.error_rate(model),
+                "mean_latency": self.mean_latency(model),
+            }
+            for model, breaker in self.breakers.items()
+        }
+
+model_router = ModelRouter()
 
 # ---------------- Safe call wrapper ---------------- #
 
+CALL_DEADLINE = float(os.getenv("OPENAI_CALL_DEADLINE", "30"))  # seconds per openai_safe_call
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 4.0
+
+# Error kinds (see classify_error)
+ERROR_QUOTA = "quota"            # key is out of money → drop it
+ERROR_AUTH = "auth"              # key is invalid/revoked → drop it
+ERROR_RATE_LIMIT = "rate_limit"  # key is throttled → cool down exactly as long as asked
+ERROR_MODEL = "model"            # model/server-side → fail fast, key stays healthy
+ERROR_REQUEST = "request"        # our request is bad → fail fast, retrying can't help
+ERROR_TRANSIENT = "transient"    # network hiccup → jittered backoff and retry
+
+QUOTA_CODES = ("insufficient_quota", "billing_hard_limit_reached", "billing_not_active")
+
+# Substring fallback for exceptions that are not openai.APIError instances
+MODEL_ERROR_MARKERS = (
+    "model_not_found", "does not exist", "not supported", "unsupported",
+    "overloaded", "server error", "bad gateway", "service unavailable",
+    "timed out", "timeout", "500", "502", "503", "504",
+)
+KEY_ERROR_MARKERS = ("quota", "billing", "401", "invalid api key", "429", "rate limit")
+
+def is_model_error(err: str) -> bool:
+    """True for model/server-side failures (key problems always win)."""
+    if any(marker in err for marker in KEY_ERROR_MARKERS):
+        return False
+    return any(marker in err for marker in MODEL_ERROR_MARKERS)
+
+def _error_code(e) -> str | None:
+    code = getattr(e, "code", None)
+    if code:
+        return str(code)
+    body = getattr(e, "body", None)
+    if isinstance(body, dict):
+        inner = body.get("error", body)
+        if isinstance(inner, dict) and inner.get("code"):
+            return str(inner["code"])
+    return None
+
+def classify_error(e: BaseException) -> str:
+    """Map an exception to one of the ERROR_* kinds, by type first and text last."""
+    if isinstance(e, openai.RateLimitError):
+        return ERROR_QUOTA if _error_code(e) in QUOTA_CODES else ERROR_RATE_LIMIT
+    if isinstance(e, openai.AuthenticationError):
+        return ERROR_AUTH
+    # 403 = model/region not allowed for the account, not a bad key: never drop keys for it
+    if isinstance(e, (openai.PermissionDeniedError, openai.NotFoundError, openai.InternalServerError, openai.APITimeoutError)):
+        return ERROR_MODEL
+    if isinstance(e, asyncio.TimeoutError):  # the call outlived its deadline (wait_for)
+        return ERROR_MODEL
+    if isinstance(e, (openai.BadRequestError, openai.UnprocessableEntityError)):
+        return ERROR_REQUEST
+    if isinstance(e, openai.APIConnectionError):
+        return ERROR_TRANSIENT
+    if isinstance(e, openai.APIStatusError):
+        return ERROR_MODEL if e.status_code >= 500 else ERROR_TRANSIENT
+
+    err = str(e).lower()
+    if "quota" in err or "billing" in err:
+        return ERROR_QUOTA
+    if "401" in err or "invalid api key" in err:
+        return ERROR_AUTH
+    if "429" in err or "rate limit" in err:
+        return ERROR_RATE_LIMIT
+    if is_model_error(err):
+        return ERROR_MODEL
+    return ERROR_TRANSIENT
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_duration(value: str) -> float | None:
+    """Parse OpenAI reset durations like '1s', '6m0s', '250ms' (or bare seconds)."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+def retry_after_seconds(e: BaseException) -> float | None:
+    """How long the server asked us to wait (Retry-After / x-ratelimit-reset-*), if it said."""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = _parse_duration(retry_after)
+        if seconds is None:
+            try:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                seconds = when.timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return max(0.0, seconds)
+
+    # Exhausted budgets say when they reset; prefer those, else the soonest reset
+    resets = []
+    for kind in ("requests", "tokens"):
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        seconds = _parse_duration(reset) if reset else None
+        if seconds is None:
+            continue
+        exhausted = headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+        resets.append((not exhausted, seconds))
+    if not resets:
+        return None
+    exhausted = [s for not_exhausted, s in resets if not not_exhausted]
+    return max(exhausted) if exhausted else min(s for _, s in resets)
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2^attempt))."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
 async def openai_safe_call(
     manager: OpenAIKeyManager,
     fn,
     context_id=None,
     is_guild=True,
     is_image=False,
-    retries=10
+    retries=10,
+    priority=PRIORITY_CHANNEL,
+    deadline=None,
+    tags=None
 ):
     """
     Ultra-fast + safe wrapper for OpenAI calls:
+    - Admission through work_scheduler (priority classes, may raise WorkShedError)
     - Context-locked key (guilds/users)
-    - Auto key rotation & cooldown
-    - Small retry delay for speed
-    - Handles quota, rate limits, invalid keys, etc.
+    - Errors classified by exception type (classify_error)
+    - Rate-limited keys cool down for exactly the server's Retry-After / reset
+    - Jittered exponential backoff for transient errors
+    - Overall deadline per call (OPENAI_CALL_DEADLINE, default 30s)
+    - response.usage recorded in usage_tracker with `tags` (feature/model/guild/user)
     """
     if manager is None:
         raise RuntimeError("[OpenAI] 🚨 Key manager not initialized!")
 
+    async with work_scheduler.slot(priority):
+        return await _safe_call_attempts(
+            manager, fn, context_id, is_guild, is_image, retries,
+            CALL_DEADLINE if deadline is None else deadline, tags
+        )
+
+async def _safe_call_attempts(manager, fn, context_id, is_guild, is_image, retries, deadline, tags=None):
     last_exc = None
     key_type = "IMAGE" if is_image else "CHAT"
-
-    # small fixed delay for quick retries
-    delay = 0.4  
+    deadline_at = time.monotonic() + deadline
+    transient_failures = 0
+    attempts = 0
 
     for attempt in range(retries):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            print(f"[OpenAI] ⌛ Deadline of {deadline:.0f}s reached after {attempt} attempts")
+            break
+        attempts = attempt + 1
+
+        key = None
         try:
             # 🔹 Try to get a client for this context
             client = manager.get_client_for_context(context_id, is_guild)
             if client is None:
-                print(f"[OpenAI] ⏳ No available {key_type} key for {context_id}, retrying...")
+                # Everything is cooling down → sleep until the first key frees up
+                wait = min(max(manager.next_release_in(), 0.05), remaining)
+                print(f"[OpenAI] ⏳ No available {key_type} key for {context_id}, waiting {wait:.2f}s...")
                 manager.reassign_key(context_id, is_guild)
-                await asyncio.sleep(0.2)
+                await asyncio.sleep(wait)
                 continue
 
-            # 🔹 Run the API call
-            result = await fn(client)
-            manager.mark_success(manager.current_key)
+            # 🔹 Run the API call (track in-flight load on this exact key)
+            key = getattr(client, "api_key", None) or manager.current_key
+            manager.current_key = key
+            manager.begin_request(key)
+            result = None
+            started = time.perf_counter()
+            try:
+                # The deadline bounds the call itself too, not just the gaps between attempts
+                result = await asyncio.wait_for(fn(client), remaining)
+            finally:
+                manager.end_request(key, result)
+            manager.mark_success(key)
+            try:
+                usage_tracker.record_response(result, key=key, latency=time.perf_counter() - started, **(tags or {}))
+            except Exception as e:  # accounting must never turn a paid success into a retry
+                print(f"[Usage] ⚠️ Could not record usage: {e}")
             return result
 
         except Exception as e:
+            committed = isinstance(e, CommittedCallError)
+            if committed:
+                e = e.error
             last_exc = e
-            err = str(e).lower()
-            manager.mark_failure(manager.current_key)
+            kind = classify_error(e)
+            manager.current_key = key or manager.current_key
+            key = manager.current_key
 
-            # --- Fast categorized failover --- #
-            if "quota" in err or "billing" in err:
-                print(f"[OpenAI] 🚫 Quota/billing issue for {manager.current_key[:8]}")
-                manager.drop_key(manager.current_key, "quota/billing")
-                manager.reassign_key(context_id, is_guild)
-                continue
+            # --- Not the key's fault: let the caller pick another model --- #
+            if kind in (ERROR_MODEL, ERROR_REQUEST):
+                print(f"[OpenAI] 🧩 {kind.capitalize()} error (key {key[:8]} kept healthy): {e or type(e).__name__}")
+                raise e
 
-            if "401" in err or "invalid api key" in err:
-                print(f"[OpenAI] ❌ Invalid key {manager.current_key[:8]}")
-                manager.drop_key(manager.current_key, "invalid key")
+            manager.mark_failure(key)
+
+            if kind in (ERROR_QUOTA, ERROR_AUTH):
+                print(f"[OpenAI] 🚫 {kind.capitalize()} failure for {key[:8]}")
+                manager.drop_key(key, kind)
                 manager.reassign_key(context_id, is_guild)
+                if committed:
+                    raise e
                 continue
 
-            if "429" in err or "rate limit" in err:
-                print(f"[OpenAI] ⚠️ Rate limit hit → cooldown {delay}s (try {attempt+1}/{retries})")
-                manager.mark_cooldown(manager.current_key)
+            if kind == ERROR_RATE_LIMIT:
+                # Cool this key down for exactly as long as the server asked, then move on
+                wait = retry_after_seconds(e)
+                manager.mark_cooldown(key, wait)
+                print(f"[OpenAI] ⚠️ Rate limit on {key[:8]} (try {attempt + 1}/{retries})")
                 manager.reassign_key(context_id, is_guild)
-                await asyncio.sleep(delay)
-                delay = min(delay + 0.3, 3.0)
+                if committed:
+                    raise e
                 continue
 
-            # --- Unknown / transient error --- #
-            print(f"[OpenAI] ⚠️ Unexpected error on key {manager.current_key[:8]}: {e}")
-            manager.mark_cooldown(manager.current_key)
-            await asyncio.sleep(0.5)
+            if committed:
+                print(f"[OpenAI] ⚠️ Transient error on key {key[:8]} after output was delivered: {e}")
+                raise e
+
+            # --- Transient: jittered exponential backoff --- #
+            delay = min(backoff_delay(transient_failures), max(0.0, deadline_at - time.monotonic()))
+            transient_failures += 1
+            print(f"[OpenAI] ⚠️ Transient error on key {key[:8]}: {e} → retry in {delay:.2f}s")
+            await asyncio.sleep(delay)
             continue
 
-    print(f"[OpenAI] ❌ All {retries} retries failed. Last error: {last_exc}")
+    print(f"[OpenAI] ❌ Gave up after {attempts} attempts. Last error: {last_exc}")
     if isinstance(last_exc, BaseException):
         raise last_exc
     else:
@@ -218,95 +918,214 @@ async def openai_safe_call(
 
 # ---------------- Key scanning ---------------- #
 
-async def scan_all_keys(batch_size: int = 10) -> list[str]:
-    """Scan all OPENAI_KEY_* env vars and return only valid keys, parallelized."""
-    print("[OpenAI] 🔄 Scanning all text keys...")
-    all_keys = [k for k in (os.getenv(f"OPENAI_KEY_{i}") for i in range(1, 500)) if k]
-    if not all_keys:
-        raise RuntimeError("[OpenAI] 🚨 No OPENAI_KEY_* found in environment.")
+KEY_CACHE_PATH = os.getenv("OPENAI_KEY_CACHE", "key_validation.json")
+KEY_CACHE_TTL = float(os.getenv("OPENAI_KEY_CACHE_TTL_HOURS", "24")) * 3600
+SCAN_CONCURRENCY = int(os.getenv("OPENAI_SCAN_CONCURRENCY", "10"))
+TRUST_KEY_CACHE = os.getenv("OPENAI_TRUST_KEY_CACHE", "0") == "1"  # offline warm start: no validation calls
 
-    valid_keys = []
+# Failures that say something about the key itself (safe to remember);
+# anything else (network, 5xx) is retried on the next scan.
+DEFINITIVE_KEY_ERRORS = ("401", "invalid api key", "incorrect api key", "quota", "billing", "deactivated")
 
-    async def test_key(key):
+class KeyValidationCache:
+    """
+    Local JSON record of key validation results, keyed by a SHA-256
+    fingerprint (raw keys are never written to disk).
+    """
+
+    def __init__(self, path: str = KEY_CACHE_PATH, ttl: float = KEY_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}  # fingerprint -> {"valid": bool, "checked": ts, "error": str | None}
+        self.load()
+
+    @staticmethod
+    def fingerprint(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            print(f"[OpenAI] ⚠️ Key cache unreadable ({e}), starting fresh")
+            self.entries = {}
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
         try:
-            client = AsyncOpenAI(api_key=key)
-            await client.models.list()
-            print(f"[OpenAI] ✅ Key {key[:8]} works")
-            return key
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
         except Exception as e:
-            print(f"[OpenAI] ❌ Key {key[:8]} invalid ({e})")
+            print(f"[OpenAI] ⚠️ Could not save key cache: {e}")
+
+    def get(self, key: str, allow_expired: bool = False):
+        """Cached entry for `key`, or None if unknown (or expired, unless allow_expired)."""
+        entry = self.entries.get(self.fingerprint(key))
+        if entry is None:
             return None
+        if not allow_expired and time.time() - entry.get("checked", 0) > self.ttl:
+            return None
+        return entry
 
-    # Run in batches
-    for i in range(0, len(all_keys), batch_size):
-        batch = all_keys[i:i + batch_size]
-        tasks = [asyncio.create_task(test_key(k)) for k in batch]
+    def set(self, key: str, valid: bool, error: str | None = None):
+        self.entries[self.fingerprint(key)] = {"valid": valid, "checked": time.time(), "error": error}
 
-        for coro in asyncio.as_completed(tasks):
-            result = await coro
-            if result:
-                valid_keys.append(result)
+_key_cache = None
 
-    if not valid_keys:
-        raise print("[OpenAI] 🚨 No valid text keys found.")
-    print(f"[OpenAI] ✅ Found {len(valid_keys)} valid text keys.")
-    return valid_keys
+def get_key_cache() -> KeyValidationCache:
+    global _key_cache
+    if _key_cache is None:
+        _key_cache = KeyValidationCache()
+    return _key_cache
+
+def _env_keys(prefix: str) -> list[str]:
+    return [k for k in (os.getenv(f"{prefix}{i}") for i in range(1, 500)) if k]
 
-async def scan_all_image_keys(batch_size: int = 10) -> list[str]:
-    """Scan all IMAGE_KEY_* env vars and return only valid keys, parallelized."""
-    print("[OpenAI] 🔄 Scanning all image keys...")
-    all_keys = [k for k in (os.getenv(f"IMAGE_KEY_{i}") for i in range(1, 500)) if k]
+async def _scan_keys(prefix: str, label: str, concurrency: int | None = None,
+                     priority: int | None = None, trust_cache: bool | None = None) -> list[str]:
+    """
+    Validate every `<prefix>N` env key and return the valid ones (env order).
+    Fresh cache entries are reused; only unknown/expired keys are checked, at most
+    `concurrency` at a time (sliding window, no batch barriers). With trust_cache,
+    nothing is checked: cached-invalid keys are skipped, everything else is kept.
+    """
+    started = time.perf_counter()
+    print(f"[OpenAI] 🔄 Scanning all {label} keys...")
+    all_keys = _env_keys(prefix)
     if not all_keys:
-        raise RuntimeError("[OpenAI] 🚨 No IMAGE_KEY_* found in environment.")
+        raise RuntimeError(f"[OpenAI] 🚨 No {prefix}* found in environment.")
+
+    cache = get_key_cache()
+    trust_cache = TRUST_KEY_CACHE if trust_cache is None else trust_cache
+    results = {}  # key -> bool
+    to_check = []
+    for key in all_keys:
+        entry = cache.get(key, allow_expired=trust_cache)
+        if entry is not None:
+            results[key] = entry["valid"]
+        elif trust_cache:
+            results[key] = True  # unknown: trust it, runtime failures will drop it
+        else:
+            to_check.append(key)
 
-    valid_keys = []
+    semaphore = asyncio.Semaphore(concurrency or SCAN_CONCURRENCY)
 
     async def test_key(key):
-        try:
-            client = AsyncOpenAI(api_key=key)
-            await client.models.list()
-            print(f"[OpenAI] ✅ Image key {key[:8]} works")
-            return key
-        except Exception as e:
-            print(f"[OpenAI] ❌ Image key {key[:8]} invalid ({e})")
-            return None
-
-    # Run in batches
-    for i in range(0, len(all_keys), batch_size):
-        batch = all_keys[i:i + batch_size]
-        tasks = [asyncio.create_task(test_key(k)) for k in batch]
+        async with semaphore:
+            try:
+                client = build_client(key)
+                if priority is None:
+                    await client.models.list()
+                else:
+                    async with work_scheduler.slot(priority, shed=False):
+                        await client.models.list()
+                print(f"[OpenAI] ✅ {label.capitalize()} key {key[:8]} works")
+                cache.set(key, True)
+                results[key] = True
+            except Exception as e:
+                err = str(e).lower()
+                print(f"[OpenAI] ❌ {label.capitalize()} key {key[:8]} invalid ({e})")
+                if any(marker in err for marker in DEFINITIVE_KEY_ERRORS):
+                    cache.set(key, False, str(e)[:200])
+                results[key] = False
 
-        for coro in asyncio.as_completed(tasks):
-            result = await coro
-            if result:
-                valid_keys.append(result)
+    if to_check:
+        await asyncio.gather(*(test_key(k) for k in to_check))
+        cache.save()
 
+    valid_keys = [k for k in all_keys if results.get(k)]
+    elapsed = time.perf_counter() - started
+    mode = "trusted cache" if trust_cache else f"checked {len(to_check)}, cached {len(all_keys) - len(to_check)}"
     if not valid_keys:
-        raise print("[OpenAI] 🚨 No valid image keys found.")
-    print(f"[OpenAI] ✅ Found {len(valid_keys)} valid image keys.")
+        raise RuntimeError(f"[OpenAI] 🚨 No valid {label} keys found ({mode}).")
+    print(f"[OpenAI] ✅ Found {len(valid_keys)}/{len(all_keys)} valid {label} keys in {elapsed:.2f}s ({mode}).")
     return valid_keys
 
+async def scan_all_keys(concurrency: int | None = None, priority: int | None = None,
+                        trust_cache: bool | None = None) -> list[str]:
+    """Scan all OPENAI_KEY_* env vars and return only valid keys."""
+    return await _scan_keys("OPENAI_KEY_", "text", concurrency, priority, trust_cache)
+
+async def scan_all_image_keys(concurrency: int | None = None, priority: int | None = None,
+                              trust_cache: bool | None = None) -> list[str]:
+    """Scan all IMAGE_KEY_* env vars and return only valid keys."""
+    return await _scan_keys("IMAGE_KEY_", "image", concurrency, priority, trust_cache)
+
+async def close_shared_clients():
+    """Drop cached per-key clients and close the shared connection pool."""
+    global _shared_http_client
+    for manager in (key_manager, image_key_manager):
+        if manager is not None:
+            manager.client_cache.clear()
+    if _shared_http_client is not None and not _shared_http_client.is_closed:
+        await _shared_http_client.aclose()
+        print("[OpenAI] 🔌 Closed shared HTTP pool.")
+    _shared_http_client = None
+
 # ---------------- Lazy-loaded managers ---------------- #
 
 key_manager = None
 image_key_manager = None
 
+VALIDATE_KEYS_ON_START = os.getenv("OPENAI_VALIDATE_ON_START", "0") == "1"  # 1 = block startup on a full scan
+_validation_tasks = set()
+
+async def _startup_keys(prefix: str, scan) -> list[str]:
+    """
+    Keys to start with. By default the env keys minus cached-invalid ones (no
+    network calls); the real scan then runs in the background. With
+    OPENAI_VALIDATE_ON_START=1, startup waits for the full validation scan.
+    """
+    keys = _env_keys(prefix)
+    if not keys:
+        return keys
+    try:
+        return await scan() if VALIDATE_KEYS_ON_START else await scan(trust_cache=True)
+    except Exception as e:
+        print(f"[OpenAI] ⚠️ Startup key check failed ({e}); using unvalidated {prefix}* keys")
+        return keys
+
+async def _validate_in_background(manager: OpenAIKeyManager, scan, label: str):
+    """Maintenance-priority validation scan after startup; drops keys that are definitively invalid."""
+    try:
+        await scan(concurrency=5, priority=PRIORITY_MAINTENANCE)
+    except Exception as e:
+        print(f"[OpenAI] ⚠️ Background {label} key validation: {e}")
+    cache = get_key_cache()
+    for key in list(manager.keys):
+        entry = cache.get(key)
+        if entry is not None and not entry["valid"]:  # network errors are never cached as invalid
+            manager.drop_key(key, "failed validation")
+
+def _start_background_validation(manager: OpenAIKeyManager, scan, label: str):
+    if VALIDATE_KEYS_ON_START:
+        return
+    task = asyncio.get_running_loop().create_task(_validate_in_background(manager, scan, label))
+    _validation_tasks.add(task)
+    task.add_done_callback(_validation_tasks.discard)
+
 async def init_key_manager():
     global key_manager
     if key_manager is None:
-        keys = [k for k in (os.getenv(f"OPENAI_KEY_{i}") for i in range(1, 500)) if k]
+        keys = await _startup_keys("OPENAI_KEY_", scan_all_keys)
         if not keys:
             raise RuntimeError("No text keys found.")
         key_manager = OpenAIKeyManager(keys)
+        _start_background_validation(key_manager, scan_all_keys, "text")
     return key_manager
 
 async def init_image_key_manager():
     global image_key_manager
     if image_key_manager is None:
-        keys = [k for k in (os.getenv(f"IMAGE_KEY_{i}") for i in range(1, 500)) if k]
+        keys = await _startup_keys("IMAGE_KEY_", scan_all_image_keys)
         if not keys:
             raise RuntimeError("No image keys found.")
         image_key_manager = OpenAIKeyManager(keys, is_image=True)
+        _start_background_validation(image_key_manager, scan_all_image_keys, "image")
     return image_key_manager
 
 # ---------------- Periodic rescans ---------------- #
@@ -319,12 +1138,9 @@ async def periodic_rescan(interval_hours: int = 6):
         if not key_manager:
             continue
         print("[OpenAI] 🔄 Background rescan (text keys)...")
-        new_keys = await scan_all_keys(batch_size=5)
+        new_keys = await scan_all_keys(concurrency=5, priority=PRIORITY_MAINTENANCE)
         for key in new_keys:
-            if key not in key_manager.keys:
-                key_manager.keys[key] = 0
-                key_manager.stats[key] = {"uses": 0, "failures": 0,
-                                          "cooldowns": 0, "last_used": 0, "health": 100}
+            key_manager.add_key(key)
         print(f"[OpenAI] ✅ Rescan done. Total text keys: {len(key_manager.keys)}")
 
 async def image_periodic_rescan(interval_hours: int = 6):
@@ -335,10 +1151,7 @@ async def image_periodic_rescan(interval_hours: int = 6):
         if not image_key_manager:
             continue
         print("[OpenAI] 🔄 Background rescan (image keys)...")
-        new_keys = await scan_all_image_keys(batch_size=5)
+        new_keys = await scan_all_image_keys(concurrency=5, priority=PRIORITY_MAINTENANCE)
         for key in new_keys:
-            if key not in image_key_manager.keys:
-                image_key_manager.keys[key] = 0
-                image_key_manager.stats[key] = {"uses": 0, "failures": 0,
-                                                "cooldowns": 0, "last_used": 0, "health": 100}
+            image_key_manager.add_key(key)
         print(f"[OpenAI] ✅ Rescan done. Total image keys: {len(image_key_manager.keys)}")
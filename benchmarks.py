@@ -0,0 +1,299 @@
+"""
+Micro-benchmarks for hot paths.
+
+Usage:
+    python benchmarks.py                 # run everything
+    python benchmarks.py available_keys  # run one benchmark
+    python benchmarks.py memory_footprint
+    python benchmarks.py sqlite_store
+    python benchmarks.py recall_index
+"""
+import io
+import gc
+import os
+import sys
+import time
+import random
+import asyncio
+import datetime
+import functools
+import itertools
+import tempfile
+import contextlib
+import tracemalloc
+
+from OpenAIKeys import OpenAIKeyManager
+from memory import (
+    MemoryManager, MemoryEntry, RecallIndex, SQLiteMemoryBackend,
+    MEMORY_MAX_PER_USER, MEMORY_RESTORE_ROWS, MEMORY_RECALL_TOP_K, MEMORY_RECALL_MAX_DOCS
+)
+
+# ================== Helpers ================== #
+
+def _timeit(fn, iterations: int) -> float:
+    """Return average microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+# ================== Key manager ================== #
+
+def _legacy_available_keys(manager: OpenAIKeyManager):
+    """The old O(n) scan, kept here only as a baseline."""
+    now = time.time()
+    return [k for k, until in manager.keys.items() if now >= until]
+
+def bench_available_keys(n_keys: int = 500, iterations: int = 20000, cooling_share: float = 0.1):
+    """available_keys() selection, heap index vs. the old linear scan."""
+    keys = [f"sk-bench-{i:04d}" for i in range(n_keys)]
+    manager = OpenAIKeyManager(keys, cooldown_seconds=3600)
+    with contextlib.redirect_stdout(io.StringIO()):  # mark_cooldown logs every call
+        for key in random.sample(keys, int(n_keys * cooling_share)):
+            manager.mark_cooldown(key)
+
+    def legacy():
+        random.choice(_legacy_available_keys(manager))
+
+    def indexed():
+        random.choice(manager.available_keys())
+
+    print(f"[Bench] available_keys @ {n_keys} keys ({int(cooling_share * 100)}% cooling):")
+    print(f"  linear scan : {_timeit(legacy, iterations):8.2f} µs/call")
+    print(f"  heap index  : {_timeit(indexed, iterations):8.2f} µs/call")
+
+    # Churn: every call puts the chosen key into a zero-length cooldown, so the
+    # next call has to release it again (worst case for the heap).
+    churn = OpenAIKeyManager(keys, cooldown_seconds=0)
+
+    def legacy_churn():
+        key = random.choice(_legacy_available_keys(churn))
+        churn.keys[key] = time.time()
+
+    def indexed_churn():
+        churn.mark_cooldown(random.choice(churn.available_keys()))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy_us = _timeit(legacy_churn, iterations)
+        indexed_us = _timeit(indexed_churn, iterations)
+    print(f"  + cooldown churn, linear : {legacy_us:8.2f} µs/call")
+    print(f"  + cooldown churn, heap   : {indexed_us:8.2f} µs/call")
+
+# ================== Memory manager ================== #
+
+def _legacy_save(data: dict, guild_id, guild_name, channel_id, channel_name, user_id, username, content, role="user"):
+    """The old MemoryManager.save: one 11-field dict per message in unbounded lists."""
+    entry = {
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "guild_id": guild_id,
+        "guild_name": guild_name,
+        "channel_id": channel_id,
+        "channel_name": channel_name,
+        "user_id": user_id,
+        "username": username,
+        "content": content,
+        "role": role,
+        "emotion": "neutral",
+        "avatar_url": None
+    }
+    data.setdefault(guild_id, {}).setdefault(channel_id, {}).setdefault(user_id, []).append(entry)
+
+def _legacy_context(data: dict, guild_id, channel_id, user_id, limit=10):
+    """The old get_monika_context: concatenate user + bot lists and fully sort them."""
+    users = data[guild_id][channel_id]
+    merged = users.get(user_id, []) + users.get("bot", [])
+    return sorted(merged, key=lambda x: x.get("timestamp", ""))[-limit:]
+
+def _fill_memory(save, n_messages: int, guilds: int, channels: int, users: int, contents: list):
+    """Spread n_messages over guild → channel → user (every 4th message is Monika's reply)."""
+    per_channel = users + 1
+    for i in range(n_messages):
+        g, rest = divmod(i, channels * per_channel)
+        g %= guilds
+        c, u = divmod(rest, per_channel)
+        guild_id, channel_id = f"{900000000000000000 + g}", f"{800000000000000000 + g * channels + c}"
+        if i % 4 == 3:
+            save(guild_id, f"Guild {g}", channel_id, f"channel-{c}", "bot", "Monika", contents[i % len(contents)], "assistant")
+        else:
+            user_id = f"{700000000000000000 + u}"
+            save(guild_id, f"Guild {g}", channel_id, f"channel-{c}", user_id, f"user{u}", contents[i % len(contents)], "user")
+
+def _traced(build):
+    """(result, bytes allocated by build(), seconds) measured with tracemalloc."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before, elapsed
+
+def bench_memory_footprint(n_messages: int = 1_000_000, guilds: int = 10, channels: int = 20, users: int = 20,
+                           iterations: int = 2000):
+    """Bytes per stored message and get_monika_context latency, compact entries vs. the old dicts."""
+    # Contents are shared by both stores so the numbers show per-entry overhead, not text
+    contents = [f"message body {i} " + "lorem ipsum " * (i % 8) for i in range(1000)]
+
+    def build_legacy():
+        data = {}
+        _fill_memory(functools.partial(_legacy_save, data), n_messages, guilds, channels, users, contents)
+        return data
+
+    def build_compact():
+        manager = MemoryManager(max_per_user=n_messages)  # no eviction: compare the same 1M messages
+        _fill_memory(manager.save, n_messages, guilds, channels, users, contents)
+        return manager
+
+    print(f"[Bench] MemoryManager @ {n_messages:,} messages ({guilds}×{channels} channels, {users} users each):")
+    legacy, legacy_bytes, legacy_s = _traced(build_legacy)
+    guild_id, channel_id, user_id = "900000000000000000", "800000000000000000", "700000000000000000"
+    legacy_us = _timeit(lambda data=legacy: _legacy_context(data, guild_id, channel_id, user_id), iterations)
+    scanned = len(legacy[guild_id][channel_id][user_id]) + len(legacy[guild_id][channel_id]["bot"])
+    del legacy
+    compact, compact_bytes, compact_s = _traced(build_compact)
+    compact_us = _timeit(lambda: compact.get_monika_context(guild_id, channel_id, user_id), iterations)
+
+    print(f"  dict entries    : {legacy_bytes / 2**20:8.1f} MiB ({legacy_bytes / n_messages:6.1f} B/msg) | fill {legacy_s:5.2f}s")
+    print(f"  compact entries : {compact_bytes / 2**20:8.1f} MiB ({compact_bytes / n_messages:6.1f} B/msg) | fill {compact_s:5.2f}s")
+    print(f"  context, sort   : {legacy_us:8.2f} µs/call ({scanned} user+bot msgs)")
+    print(f"  context, merge  : {compact_us:8.2f} µs/call")
+    print(f"  (live retention is MEMORY_MAX_PER_USER={MEMORY_MAX_PER_USER} per guild/channel/user)")
+
+def bench_sqlite_store(n_rows: int = 1_000_000, guilds: int = 10, channels: int = 20, users: int = 20,
+                       restore_rows: int = MEMORY_RESTORE_ROWS, iterations: int = 500):
+    """SQLite write-behind throughput, startup restore and per-conversation queries at n_rows."""
+    contents = [f"message body {i} " + "lorem ipsum " * (i % 8) for i in range(1000)]
+
+    async def run(path):
+        backend = SQLiteMemoryBackend(path)
+        manager = MemoryManager(backend=backend)
+        with contextlib.redirect_stdout(io.StringIO()):
+            await manager.start()
+            await manager.wait_restored()
+        start = time.perf_counter()
+        chunk = 50_000
+        for offset in range(0, n_rows, chunk):  # feed in chunks so the writer drains as it would live
+            _fill_memory(manager.save, min(chunk, n_rows - offset), guilds, channels, users, contents)
+            await asyncio.sleep(0)
+        await manager.flush()
+        write_s = time.perf_counter() - start
+        stats = backend.summary()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await manager.close()
+
+        restored = MemoryManager(backend=SQLiteMemoryBackend(path))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await restored.start(restore_rows)
+            await restored.wait_restored()
+        restore_s = time.perf_counter() - start
+
+        guild_id, channel_id, user_id = "900000000000000000", "800000000000000005", "700000000000000003"
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await restored.backend.recent(guild_id, channel_id, user_id, 10)
+        recent_us = (time.perf_counter() - start) / iterations * 1e6
+        with contextlib.redirect_stdout(io.StringIO()):
+            await restored.close()
+        return write_s, stats, restore_s, recent_us
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memory.db")
+        write_s, stats, restore_s, recent_us = asyncio.run(run(path))
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+
+    print(f"[Bench] SQLite memory store @ {n_rows:,} rows:")
+    print(f"  write-behind    : {n_rows / write_s:10.0f} rows/s ({stats['batches']} batches, max {stats['batch_max']}, "
+          f"slowest {stats['write_max'] * 1000:.0f}ms) | {size / 2**20:.1f} MiB on disk")
+    print(f"  startup restore : {restore_s:8.2f}s for the newest {restore_rows:,} rows")
+    print(f"  recent(10)      : {recent_us:8.1f} µs/query (indexed, off-loop thread)")
+
+def _zipf_texts(n: int, vocab_size: int = 20000, words=(5, 25), seed: int = 7) -> list:
+    """n synthetic chat messages over a Zipf-distributed vocabulary (like real word frequencies)."""
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = list({"".join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(vocab_size * 2)})[:vocab_size]
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocab) + 1)))
+    texts = []
+    for _ in range(n):
+        texts.append(" ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(*words))))
+    return texts
+
+def bench_recall_index(n_entries: int = 1_000_000, guilds: int = 10, users: int = 100,
+                       heavy_docs: int = MEMORY_RECALL_MAX_DOCS, traced_entries: int = 100_000, queries: int = 2000):
+    """BM25 recall index: incremental build rate, memory and top-k query latency at n_entries."""
+    texts = _zipf_texts(50_000)
+    scopes = guilds * users
+    entries = [
+        MemoryEntry(i, f"{900000000000000000 + i % guilds}", "Guild", "800000000000000000", "chat",
+                    f"{700000000000000000 + (i // guilds) % users}", "user", texts[i % len(texts)])
+        for i in range(n_entries)
+    ]
+
+    def build(entries):
+        manager = MemoryManager(max_per_user=1)  # index only: RAM conversation store kept tiny
+        for key in {(entry.guild_id, entry.user_id) for entry in entries}:
+            manager.recall_index[key] = RecallIndex(max_docs=n_entries)  # no eviction at this size
+        manager._index_entries(entries)
+        return manager
+
+    # tracemalloc slows allocation ~10x: memory is measured on whole indexes of a few users, timing untraced
+    traced_users = {f"{700000000000000000 + u}" for u in range(max(1, users * traced_entries // n_entries))}
+    traced_slice = [entry for entry in entries if entry.user_id in traced_users]
+    traced_entries = len(traced_slice)
+    _, traced_bytes, _ = _traced(lambda: build(traced_slice))
+    gc.collect()
+    start = time.perf_counter()
+    manager = build(entries)
+    build_s = time.perf_counter() - start
+    docs = sum(len(index) for index in manager.recall_index.values())
+
+    rng = random.Random(11)
+    query_texts = [" ".join(rng.choice(texts).split()[:rng.randint(3, 8)]) for _ in range(queries)]
+    keys = list(manager.recall_index)
+
+    def run_queries(target, pick_key):
+        timings = []
+        for i, query in enumerate(query_texts):
+            guild_id, user_id = pick_key(i)
+            start = time.perf_counter()
+            target.recall(guild_id, user_id, query, min_age=0)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        return timings
+
+    spread = run_queries(manager, lambda i: keys[i % len(keys)])
+
+    heavy = MemoryManager(max_per_user=1)
+    heavy.recall_index[("1", "1")] = RecallIndex(max_docs=heavy_docs)
+    heavy_entries = [MemoryEntry(i, "1", "Guild", "2", "chat", "1", "user", texts[i % len(texts)]) for i in range(heavy_docs)]
+    start = time.perf_counter()
+    heavy._index_entries(heavy_entries)
+    heavy_build_s = time.perf_counter() - start
+    worst = run_queries(heavy, lambda i: ("1", "1"))
+
+    def pct(timings, p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+    print(f"[Bench] Recall index @ {n_entries:,} messages ({scopes} guild/user indexes, {docs:,} docs indexed):")
+    print(f"  build           : {build_s:6.2f}s ({n_entries / build_s:,.0f} msgs/s incremental) | "
+          f"~{traced_bytes / traced_entries * n_entries / 2**20:.0f} MiB ({traced_bytes / traced_entries:.0f} B/msg, "
+          f"traced on {traced_entries:,})")
+    print(f"  query, {n_entries // scopes:,} docs : p50 {pct(spread, 0.5):6.3f}ms | p99 {pct(spread, 0.99):6.3f}ms | "
+          f"max {spread[-1] * 1000:6.3f}ms (top-{MEMORY_RECALL_TOP_K})")
+    print(f"  query, {heavy_docs:,} docs : p50 {pct(worst, 0.5):6.3f}ms | p99 {pct(worst, 0.99):6.3f}ms | "
+          f"max {worst[-1] * 1000:6.3f}ms (one user at the MEMORY_RECALL_MAX_DOCS cap; build {heavy_build_s:.2f}s)")
+
+BENCHMARKS = {
+    "available_keys": bench_available_keys,
+    "memory_footprint": bench_memory_footprint,
+    "sqlite_store": bench_sqlite_store,
+    "recall_index": bench_recall_index,
+}
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
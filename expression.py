@@ -1,14 +1,95 @@
 # expression.py — fixed and more robust
-import os, datetime, random, asyncio
+import os, re, time, datetime, random, asyncio
 
 SPRITE_DIR = "Sprites/user's"
+CLASSIFIER_MODELS = ["gpt-5-nano", "gpt-5-mini", "gpt-5"]  # preferred order; model_router adapts it
 
 def _today_date():
     """Return a date object representing today (useful for deterministic daily seeding)."""
     return datetime.date.today()
 
+# ---------------- Local emotion classifier ----------------
+# cue -> (label, weight). Labels are ones most outfits have, so get_sprite
+# rarely has to fall back to "neutral".
+EMOTION_LEXICON = {
+    "happy": ["happy", "glad", "yay", "great", "awesome", "love", "lovely", "wonderful", "excited",
+              "fun", "haha", "hehe", "lol", "amazing", "yes!", "thank", "thanks", "enjoy", "delighted",
+              "😊", "😄", "😁", "💚", "❤️", "♥", "🥰", ":)", ":d"],
+    "eyes close smile": ["ahaha", "ehehe", "fufu", "*smiles*", "*giggles*", "giggle", "cute", "sweet"],
+    "sad": ["sad", "sorry", "miss", "lonely", "alone", "unhappy", "down", "hurt", "sigh", "😔", "😞", ":("],
+    "crying": ["cry", "crying", "tears", "sob", "heartbroken", "😭", "😢"],
+    "sad smile": ["bittersweet", "it's okay", "it's fine", "don't worry", "i understand", "wish"],
+    "concerned": ["worried", "worry", "concerned", "careful", "are you okay", "are you alright",
+                  "hope you're", "take care", "uh oh", "hmm?", "trouble"],
+    "serious": ["honestly", "seriously", "listen", "important", "actually", "must", "should", "need to"],
+    "very serious": ["angry", "mad", "annoyed", "stop", "enough", "unacceptable", "how dare", "😠", "😡"],
+    "disappointed": ["disappointed", "disappointing", "let down", "really?", "ugh"],
+    "embarrass": ["embarrass", "embarrassed", "blush", "blushing", "flustered", "shy", "*blushes*",
+                  "you're making me", "😳", "☺️"],
+    "nervous": ["nervous", "anxious", "uneasy", "um", "umm", "uh", "well...", "😅", "awkward"],
+    "nervous laughing": ["ahaha...", "haha...", "heh", "oops", "whoops"],
+    "horrified": ["scared", "afraid", "terrified", "horrible", "creepy", "oh no", "what?!", "😱", "😨"],
+    "horrified surprised": ["what!?", "no way", "wait what", "shocked", "can't believe", "😮", "😲"],
+    "thinking": ["think", "thinking", "wonder", "maybe", "perhaps", "curious", "hmm", "🤔"],
+    "neutral": ["okay", "ok", "sure", "alright", "i see", "noted"],
+}
+
+NEGATIONS = {"not", "no", "never", "don't", "dont", "isn't", "isnt", "aren't", "wasn't", "can't", "cannot"}
+
+class LocalEmotionClassifier:
+    """
+    Keyword/emoji lexicon scorer that picks a sprite label in microseconds.
+
+    predict() returns (label, confidence). Confidence is the winning label's
+    share of all cue weight, damped for texts with very few cues, so a single
+    stray "ok" never beats the LLM. Cues right after a negation are ignored.
+    """
+
+    def __init__(self, valid_labels, lexicon=None):
+        valid = set(valid_labels)
+        self.cues = {}         # single-word cue -> label
+        self.phrases = []      # (multi-word or symbol cue, label)
+        for label, cues in (lexicon or EMOTION_LEXICON).items():
+            if label not in valid:
+                continue
+            for cue in cues:
+                cue = cue.lower()
+                if re.fullmatch(r"[a-z']+", cue):
+                    self.cues[cue] = label
+                else:
+                    self.phrases.append((cue, label))
+
+    def predict(self, text: str):
+        if not isinstance(text, str) or not text:
+            return None, 0.0
+        lowered = text.lower()
+        scores = {}
+
+        negate = False
+        for word in re.findall(r"[a-z']+", lowered):
+            if word in NEGATIONS:
+                negate = True
+                continue
+            label = self.cues.get(word)
+            if label and not negate:
+                scores[label] = scores.get(label, 0.0) + 1.0
+            negate = False
+
+        for cue, label in self.phrases:
+            hits = lowered.count(cue)
+            if hits:
+                scores[label] = scores.get(label, 0.0) + 1.5 * hits
+
+        if not scores:
+            return None, 0.0
+
+        label, top = max(scores.items(), key=lambda kv: kv[1])
+        total = sum(scores.values())
+        confidence = (top / total) * (top / (top + 1.0))
+        return label, round(confidence, 3)
+
 class User_SpritesManager:
-    def __init__(self, sprite_dir=SPRITE_DIR):
+    def __init__(self, sprite_dir=SPRITE_DIR, local_threshold=None):
         self.sprite_dir = sprite_dir
 
         # selected casual variant for the day (e.g. "casual 1")
@@ -561,13 +642,50 @@ class User_SpritesManager:
         # valid emotions (computed from loaded sprites)
         self.valid = self._extract_all_emotions()
 
+        # local fast-path classifier; the LLM is only asked below this confidence
+        self.local_classifier = LocalEmotionClassifier(self.valid)
+        if local_threshold is None:
+            local_threshold = float(os.getenv("EMOTION_LOCAL_THRESHOLD", "0.6"))
+        self.local_threshold = local_threshold
+        self.classifier_stats = {"local": 0, "remote": 0, "local_seconds": 0.0, "remote_seconds": 0.0}
+
         print("[DEBUG] Loaded sprites:", self.sprites_by_outfit)
 
     # ---------------- Classify ----------------
-    async def classify(self, text: str) -> str:
+    async def classify(self, text, priority: int = None, guild=None, user=None) -> str:
+        """
+        Classify text into one of the valid emotion labels.
+        Tries the local lexicon first and only asks OpenAI when its
+        confidence is below self.local_threshold.
+        `text` may also be a list of lines, classified as one block.
+        `priority` is the OpenAIKeys work_scheduler class (default: channel);
+        `guild`/`user` ids attribute remote calls in the usage ledger.
+        """
+        if isinstance(text, (list, tuple)):
+            text = "\n".join(str(line) for line in text if line)
+        start = time.perf_counter()
+        label, confidence = self.local_classifier.predict(text)
+        elapsed = time.perf_counter() - start
+        self.classifier_stats["local_seconds"] += elapsed
+        if label and confidence >= self.local_threshold:
+            self.classifier_stats["local"] += 1
+            print(f"[Emotion Classifier] local → {label} (conf {confidence:.2f}, {elapsed * 1e6:.0f}µs)")
+            return label
+
+        print(f"[Emotion Classifier] local unsure (conf {confidence:.2f} < {self.local_threshold}) → remote")
+        self.classifier_stats["remote"] += 1
+        start = time.perf_counter()
+        try:
+            return await self._classify_remote(text, priority, guild, user)
+        finally:
+            self.classifier_stats["remote_seconds"] += time.perf_counter() - start
+
+    async def _classify_remote(self, text: str, priority: int = None, guild=None, user=None) -> str:
         """Classify text into one of the valid emotion labels using OpenAI."""
-        from OpenAIKeys import openai_safe_call, key_manager  # already in your project
-        model_priority = ["gpt-5-nano", "gpt-5-mini", "gpt-5"]
+        from OpenAIKeys import openai_safe_call, key_manager, model_router, classify_error, ERROR_MODEL, PRIORITY_CHANNEL, WorkShedError  # already in your project
+        if priority is None:
+            priority = PRIORITY_CHANNEL
+        model_priority = model_router.order(CLASSIFIER_MODELS)
 
         prompt = (
             "Return ONLY one label from this list:\n"
@@ -576,6 +694,9 @@ class User_SpritesManager:
         )
 
         for model in model_priority:
+            if not model_router.allow(model, force=model == model_priority[-1]):
+                continue
+
             async def call_fn(client):
                 return await client.chat.completions.create(
                     model=model,
@@ -586,9 +707,15 @@ class User_SpritesManager:
                 )
 
             try:
-                response = await openai_safe_call(key_manager, call_fn)
+                start = time.perf_counter()
+                response = await openai_safe_call(
+                    key_manager, call_fn, priority=priority,
+                    tags={"feature": "emotion", "model": model, "guild": guild, "user": user}
+                )
                 if not response or not response.choices:
+                    model_router.record_failure(model)
                     continue
+                model_router.record_success(model, time.perf_counter() - start)
 
                 raw = response.choices[0].message.content.strip().lower()
 
@@ -599,8 +726,21 @@ class User_SpritesManager:
 
                 print(f"[Emotion Classifier WARN] Unexpected response: {raw}")
 
+            except WorkShedError:
+                model_router.abandon(model)  # may hold the half-open probe
+                print("[Emotion Classifier] ⏭️ Shed under load → neutral")
+                break
+
+            except asyncio.CancelledError:
+                model_router.abandon(model)
+                raise
+
             except Exception as e:
                 print(f"[Emotion Classifier Error] {model} → {e}")
+                if classify_error(e) == ERROR_MODEL:
+                    model_router.record_failure(model)
+                else:
+                    model_router.abandon(model)  # bad request / exhausted keys: not the model's fault
                 continue
 
         return "neutral"
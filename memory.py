@@ -1,131 +1,1286 @@
-import datetime
+import io
+import os
 import re
+import sys
+import gzip
+import json
+import math
+import time
+import heapq
+import bisect
+import sqlite3
+import asyncio
+import datetime
+import itertools
+import contextlib
+import concurrent.futures
+from array import array
+from collections import OrderedDict, deque
+from typing import Optional
+
+CONVERSATION_BUFFER_MAX_KEYS = int(os.getenv("CONVERSATION_BUFFER_MAX_KEYS", "5000"))  # LRU cap on (channel, user) keys
+
+class ConversationBuffer:
+    """
+    Bounded per-(channel, user) ring buffer of recent conversation turns.
+
+    Fed live from on_message and from Monika's own replies, so building a prompt
+    never needs a REST round trip. A key is "cold" until it has been backfilled
+    once from channel history; after that it only grows from live traffic.
+    Message ids are tracked so the same message is never stored twice.
+    At most `max_keys` keys are kept; the least recently used one is evicted
+    (and simply goes cold again, so the next prompt backfills it).
+    """
+
+    def __init__(self, maxlen: int = 50, max_keys: int = CONVERSATION_BUFFER_MAX_KEYS):
+        self.maxlen = maxlen
+        self.max_keys = max_keys
+        self.buffers = OrderedDict()  # (channel_id, user_id) -> deque of turn dicts, LRU order
+        self.ids = {}                 # (channel_id, user_id) -> set of stored message ids
+        self.last_seen_id = {}        # (channel_id, user_id) -> newest message id recorded
+        self.warm = OrderedDict()     # keys that no longer need a backfill (ordered set, LRU order)
+        self.stats = {"records": 0, "duplicates": 0, "backfills": 0, "hits": 0, "evictions": 0}
+
+    @staticmethod
+    def _key(channel_id, user_id):
+        return (str(channel_id), str(user_id))
+
+    def _touch(self, key):
+        """Mark `key` most recently used and evict the oldest keys over max_keys."""
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+        if key in self.warm:
+            self.warm.move_to_end(key)
+        while len(self.buffers) > self.max_keys:
+            old, _ = self.buffers.popitem(last=False)
+            self.ids.pop(old, None)
+            self.last_seen_id.pop(old, None)
+            self.warm.pop(old, None)
+            self.stats["evictions"] += 1
+        while len(self.warm) > self.max_keys:  # keys cleared on purpose stay warm without a buffer
+            self.warm.popitem(last=False)
+
+    def record(self, channel_id, user_id, message_id, author, content, role="user"):
+        """Append one turn; returns False if it was empty or already stored."""
+        if not content:
+            return False
+        key = self._key(channel_id, user_id)
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = deque(maxlen=self.maxlen)
+            self.ids[key] = set()
+        ids = self.ids[key]
+
+        if message_id is not None and message_id in ids:
+            self.stats["duplicates"] += 1
+            return False
+
+        if len(buf) == buf.maxlen:
+            ids.discard(buf[0]["id"])
+        buf.append({"id": message_id, "author": author, "role": role, "content": content})
+        if message_id is not None:
+            ids.add(message_id)
+            if message_id > self.last_seen_id.get(key, 0):
+                self.last_seen_id[key] = message_id
+        self.stats["records"] += 1
+        self._touch(key)
+        return True
+
+    def is_cold(self, channel_id, user_id) -> bool:
+        return self._key(channel_id, user_id) not in self.warm
+
+    def backfill(self, channel_id, user_id, turns):
+        """
+        Merge older turns (oldest first, as dicts with id/author/role/content)
+        in front of whatever was recorded live, then mark the key warm.
+        """
+        key = self._key(channel_id, user_id)
+        live = list(self.buffers.get(key, ()))
+        live_ids = {t["id"] for t in live}
+        older = [t for t in turns if t.get("content") and t.get("id") not in live_ids]
+
+        merged = deque(older + live, maxlen=self.maxlen)
+        self.buffers[key] = merged
+        self.ids[key] = {t["id"] for t in merged if t["id"] is not None}
+        newest = max(self.ids[key], default=0)
+        if newest > self.last_seen_id.get(key, 0):
+            self.last_seen_id[key] = newest
+        self.warm[key] = None
+        self.stats["backfills"] += 1
+        self._touch(key)
+
+    def get(self, channel_id, user_id, limit=None, exclude_ids=()):
+        """Return up to `limit` most recent turns (oldest first), skipping exclude_ids."""
+        key = self._key(channel_id, user_id)
+        buf = self.buffers.get(key)
+        if not buf:
+            return []
+        self.stats["hits"] += 1
+        self._touch(key)
+        turns = [t for t in buf if t["id"] not in exclude_ids] if exclude_ids else list(buf)
+        return turns[-limit:] if limit else turns
+
+    def clear(self, channel_id=None, user_id=None):
+        """Forget one key, every key for a channel or a user, or everything."""
+        if channel_id is None and user_id is None:
+            keys = list(self.buffers)
+        elif channel_id is None:
+            keys = [k for k in self.buffers if k[1] == str(user_id)]
+        elif user_id is None:
+            keys = [k for k in self.buffers if k[0] == str(channel_id)]
+        else:
+            keys = [self._key(channel_id, user_id)]
+        for key in keys:
+            self.buffers.pop(key, None)
+            self.ids.pop(key, None)
+            self.last_seen_id.pop(key, None)
+            self.warm[key] = None  # cleared on purpose: don't backfill the forgotten turns
+            self._touch(key)
+
+    def to_dict(self):
+        return {f"{c}:{u}": list(buf) for (c, u), buf in self.buffers.items()}
+
+MEMORY_MAX_PER_USER = int(os.getenv("MEMORY_MAX_PER_USER", "500"))  # per guild → channel → user deque
+
+def _parse_timestamp(value) -> float:
+    """Epoch seconds from an epoch number or an ISO / 'YYYY-MM-DD HH:MM:SS' string (naive = UTC)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        dt = datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return 0.0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+_EPOCH = datetime.datetime(1970, 1, 1)  # naive UTC, matches the old utcnow().isoformat() entries
+
+def _intern(value):
+    return sys.intern(str(value)) if value is not None else None
+
+def _entry_ts(entry) -> float:
+    return entry.ts
+
+class MemoryEntry:
+    """
+    One stored message. Slots instead of a dict (~5x smaller), an epoch float
+    instead of an ISO string, and interned ids/names/roles (shared by every
+    entry of the same guild/channel/user). Reads like the old dict entries
+    via get()/[]/to_dict(), so exporters keep working.
+    """
+    __slots__ = ("ts", "guild_id", "guild_name", "channel_id", "channel_name",
+                 "user_id", "username", "content", "role", "emotion", "avatar_url")
+
+    FIELDS = ("timestamp",) + __slots__[1:]
+
+    def __init__(self, ts, guild_id, guild_name, channel_id, channel_name, user_id, username,
+                 content, role="user", emotion="neutral", avatar_url=None):
+        self.ts = ts
+        self.guild_id = _intern(guild_id)
+        self.guild_name = _intern(guild_name)
+        self.channel_id = _intern(channel_id)
+        self.channel_name = _intern(channel_name)
+        self.user_id = _intern(user_id)
+        self.username = _intern(username)
+        self.content = content
+        self.role = _intern(role)
+        self.emotion = _intern(emotion)
+        self.avatar_url = _intern(avatar_url)
+
+    @property
+    def timestamp(self) -> str:
+        return (_EPOCH + datetime.timedelta(seconds=self.ts)).isoformat()
+
+    def get(self, field, default=None):
+        if field not in self.FIELDS:
+            return default
+        value = getattr(self, field)
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"MemoryEntry({self.timestamp}, {self.username}: {self.content[:40]!r})"
+
+# ================== Recall index ================== #
+# Incremental BM25 over each user's own messages per guild, so a reference to
+# something said weeks ago can pull those messages back into the prompt.
+# Postings are packed as (doc_id << 8 | tf) in one array('I') per term.
+
+MEMORY_RECALL_TOP_K = int(os.getenv("MEMORY_RECALL_TOP_K", "3"))
+MEMORY_RECALL_MIN_AGE = float(os.getenv("MEMORY_RECALL_MIN_AGE", "900"))      # seconds; newer turns are in the chat context
+MEMORY_RECALL_MAX_DOCS = int(os.getenv("MEMORY_RECALL_MAX_DOCS", "5000"))    # per guild/user; oldest dropped past this
+BM25_K1 = 1.2
+BM25_B = 0.75
+RECALL_COMMON_DF = 0.1   # terms in more than this share of docs only re-score candidates found by rarer terms
+
+_WORD = re.compile(r"[^\W_]{2,}")
+_STOPWORDS = frozenset(
+    "the and for are but not you your yours with this that have has had was were will would can could "
+    "should what when where who why how all any our out its it's just like get got about from into then "
+    "than them they their there here she her him his been being also very really too some more much "
+    "yes yeah okay ok lol haha monika".split()
+)
+
+def recall_terms(text: str) -> list:
+    """Lower-cased words (2+ letters/digits) without stopwords; interned so scopes share them."""
+    return [sys.intern(word) for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+
+class RecallIndex:
+    """BM25 index over one user's messages in one guild (append-only, rebuilt when over max_docs)."""
+    __slots__ = ("docs", "lengths", "postings", "total_length", "max_docs")
+
+    def __init__(self, max_docs: int = MEMORY_RECALL_MAX_DOCS):
+        self.docs = []              # doc id -> MemoryEntry
+        self.lengths = array("H")   # doc id -> term count
+        self.postings = {}          # term -> array('I') of doc_id << 8 | tf
+        self.total_length = 0
+        self.max_docs = max_docs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, entry: MemoryEntry):
+        terms = recall_terms(entry.content)
+        if not terms:
+            return
+        if len(self.docs) >= self.max_docs:
+            self._rebuild(self.docs[-(self.max_docs * 3 // 4):])
+        doc_id = len(self.docs)
+        self.docs.append(entry)
+        self.lengths.append(min(len(terms), 0xFFFF))
+        self.total_length += len(terms)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        postings = self.postings
+        for term, tf in counts.items():
+            plist = postings.get(term)
+            if plist is None:
+                plist = postings[term] = array("I")
+            plist.append(doc_id << 8 | min(tf, 0xFF))
+
+    def _rebuild(self, docs: list):
+        """Drop the oldest docs (amortized: runs once per max_docs/4 additions)."""
+        self.docs, self.lengths, self.postings, self.total_length = [], array("H"), {}, 0
+        for entry in docs:
+            self.add(entry)
+
+    def search(self, terms: list, k: int = MEMORY_RECALL_TOP_K, before: Optional[float] = None) -> list:
+        """Top `k` (score, MemoryEntry) for the query terms, only docs older than `before`."""
+        n = len(self.docs)
+        if not n or not terms:
+            return []
+        avgdl = self.total_length / n
+        lengths = self.lengths
+        norm_a = BM25_K1 * (1 - BM25_B)
+        norm_b = BM25_K1 * BM25_B / avgdl
+        postings = self.postings
+        query = sorted((postings[term] for term in set(terms) if term in postings), key=len)  # rarest first
+        common_df = n * RECALL_COMMON_DF
+        scores = {}
+        for plist in query:
+            df = len(plist)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            boost = idf * (BM25_K1 + 1)
+            if scores and df > common_df:
+                # Common term: look up only the candidates (postings are sorted by doc id)
+                for doc_id in list(scores):
+                    i = bisect.bisect_left(plist, doc_id << 8)
+                    if i < df and plist[i] >> 8 == doc_id:
+                        tf = plist[i] & 0xFF
+                        scores[doc_id] += boost * tf / (tf + norm_a + norm_b * lengths[doc_id])
+                continue
+            for packed in plist:
+                doc_id = packed >> 8
+                tf = packed & 0xFF
+                scores[doc_id] = scores.get(doc_id, 0.0) + boost * tf / (tf + norm_a + norm_b * lengths[doc_id])
+        if not scores:
+            return []
+        docs = self.docs
+        # A few extra candidates cover the ones filtered out as too recent
+        ranked = heapq.nlargest(k + 16 if before is not None else k, scores.items(), key=_score)
+        results = []
+        for doc_id, score in ranked:
+            entry = docs[doc_id]
+            if before is not None and entry.ts >= before:
+                continue
+            results.append((score, entry))
+            if len(results) == k:
+                break
+        return results
+
+def _score(item) -> float:
+    return item[1]
+
+# ================== Rolling summaries ================== #
+# Older turns of a (guild, user) conversation are folded into one short note
+# that rides along in the prompt. The newest MEMORY_SUMMARY_KEEP_RECENT turns
+# stay raw (they are already in the prompt as chat history).
+
+MEMORY_SUMMARY_KEEP_RECENT = int(os.getenv("MEMORY_SUMMARY_KEEP_RECENT", "20"))
+MEMORY_SUMMARY_MIN_TURNS = int(os.getenv("MEMORY_SUMMARY_MIN_TURNS", "12"))        # fewer new turns → wait
+MEMORY_SUMMARY_INPUT_TOKENS = int(os.getenv("MEMORY_SUMMARY_INPUT_TOKENS", "2000"))  # transcript budget per call
+MEMORY_SUMMARY_MAX_CHARS = int(os.getenv("MEMORY_SUMMARY_MAX_CHARS", "1200"))      # note size cap (~300 tokens)
+MEMORY_SUMMARY_BATCH = int(os.getenv("MEMORY_SUMMARY_BATCH", "4"))                 # conversations per round
+MEMORY_SUMMARY_REPLY_WINDOW = 300  # seconds: Monika's reply within this of a user turn belongs to it
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars/token); good enough for budgets."""
+    return len(text) // 4 + 1
+
+class MemoryNote:
+    """Compact summary of a user's older turns in one guild, up to `until` (epoch)."""
+    __slots__ = ("guild_id", "user_id", "text", "until", "turns", "updated")
+
+    def __init__(self, guild_id, user_id, text: str, until: float = 0.0, turns: int = 0, updated: float = 0.0):
+        self.guild_id = _intern(guild_id)
+        self.user_id = _intern(user_id)
+        self.text = text
+        self.until = until
+        self.turns = turns
+        self.updated = updated
+
+# ================== Storage backends ================== #
+# MemoryManager keeps the recent window in RAM (deques above) and hands every
+# saved entry to a backend for durable storage. Writes are write-behind: save()
+# never blocks on disk, a single writer task flushes batches.
+
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "sqlite")  # "sqlite" | "memory" (RAM only)
+MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH", "memory.db")
+MEMORY_WRITE_BATCH = int(os.getenv("MEMORY_WRITE_BATCH", "500"))        # max rows per transaction
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "1.0"))  # seconds a batch may wait
+MEMORY_RESTORE_ROWS = int(os.getenv("MEMORY_RESTORE_ROWS", "200000"))   # newest rows loaded at startup
+RESTORE_CHUNK = 2000  # restored entries merged into RAM between event-loop yields
+
+class MemoryBackend:
+    """Storage interface for MemoryManager. The base class keeps nothing (RAM-only mode)."""
+
+    name = "memory"
+    durable = False  # survives restarts (lets load_history resume from its checkpoint)
+
+    async def start(self):
+        pass
+
+    def append(self, entry: "MemoryEntry"):
+        pass
+
+    async def recent(self, guild_id, channel_id, user_id, limit: int) -> list:
+        """Newest `limit` entries for one guild/channel/user, oldest first."""
+        return []
+
+    async def restore(self, limit: int, per_key: Optional[int] = None, before: Optional[float] = None) -> dict:
+        """
+        Newest `limit` entries older than `before` as {(guild, channel, user):
+        [entries oldest first]}, at most `per_key` each.
+        """
+        return {}
+
+    async def delete_guild(self, guild_id):
+        pass
+
+    async def load_notes(self) -> list:
+        """Every stored MemoryNote."""
+        return []
+
+    async def save_note(self, note: "MemoryNote"):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def summary(self) -> dict:
+        return {"backend": self.name}
+
+class SQLiteMemoryBackend(MemoryBackend):
+    """
+    SQLite in WAL mode, indexed on (guild, channel, user, ts) and on ts.
+    All database work runs on one dedicated thread, so the event loop never
+    waits on disk and the connection is only ever touched from one thread.
+    """
+
+    name = "sqlite"
+    durable = True
+
+    COLUMNS = ("ts", "guild_id", "guild_name", "channel_id", "channel_name",
+               "user_id", "username", "content", "role", "emotion", "avatar_url")
+
+    def __init__(self, path: str = MEMORY_DB_PATH, batch_size: int = MEMORY_WRITE_BATCH,
+                 flush_interval: float = MEMORY_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue()
+        self.conn = None
+        self.writer = None
+        self._flush_now = asyncio.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-db")
+        self.stats = {"queued": 0, "written": 0, "batches": 0, "errors": 0, "batch_max": 0, "write_max": 0.0}
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints; WAL keeps it crash-safe
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                guild_id TEXT NOT NULL,
+                guild_name TEXT,
+                channel_id TEXT NOT NULL,
+                channel_name TEXT,
+                user_id TEXT NOT NULL,
+                username TEXT,
+                content TEXT NOT NULL,
+                role TEXT,
+                emotion TEXT,
+                avatar_url TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_scope ON memories (guild_id, channel_id, user_id, ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_ts ON memories (ts)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notes (
+                guild_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                until REAL NOT NULL,
+                turns INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        """)
+        conn.commit()
+        self.conn = conn
+
+    async def start(self):
+        if self.conn is None:
+            await self._run(self._connect)
+            print(f"[Memory] 🗄️ SQLite store ready at {self.path}")
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._writer_loop())
+
+    def append(self, entry):
+        self.queue.put_nowait(entry)
+        self.stats["queued"] += 1
+        if self.queue.qsize() >= self.batch_size:
+            self._flush_now.set()
+
+    # ---------------- Writer ---------------- #
+
+    def _insert(self, rows):
+        self.conn.executemany(
+            f"INSERT INTO memories ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            rows
+        )
+        self.conn.commit()
+
+    async def _writer_loop(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Let the batch fill for up to flush_interval (skipped when a backlog or flush() is waiting)
+            if self.queue.qsize() + 1 < self.batch_size and not self._flush_now.is_set():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if self.queue.empty():
+                self._flush_now.clear()
+
+            rows = [tuple(getattr(entry, column) for column in self.COLUMNS) for entry in batch]
+            started = time.perf_counter()
+            try:
+                await self._run(self._insert, rows)
+                self.stats["written"] += len(rows)
+                self.stats["batches"] += 1
+                self.stats["batch_max"] = max(self.stats["batch_max"], len(rows))
+                self.stats["write_max"] = max(self.stats["write_max"], time.perf_counter() - started)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"[Memory] ❌ SQLite write of {len(rows)} rows failed: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def flush(self):
+        """Wait until everything queued so far is on disk."""
+        if self.writer is None or self.writer.done():
+            return
+        self._flush_now.set()
+        await self.queue.join()
+
+    # ---------------- Reads ---------------- #
+
+    def _select(self, sql, params):
+        return self.conn.execute(sql, params).fetchall()
+
+    async def recent(self, guild_id, channel_id, user_id, limit: int) -> list:
+        if self.conn is None:
+            return []
+        rows = await self._run(
+            self._select,
+            f"SELECT {', '.join(self.COLUMNS)} FROM memories "
+            "WHERE guild_id = ? AND channel_id = ? AND user_id = ? ORDER BY ts DESC LIMIT ?",
+            (str(guild_id), str(channel_id), str(user_id), limit)
+        )
+        rows.reverse()
+        return [MemoryEntry(*row) for row in rows]
+
+    async def restore(self, limit: int, per_key: Optional[int] = None, before: Optional[float] = None) -> dict:
+        if self.conn is None:
+            return {}
+
+        def load():
+            # Entries are built and grouped here, on the DB thread, not on the event loop
+            grouped = {}
+            rows = self._select(
+                f"SELECT {', '.join(self.COLUMNS)} FROM memories WHERE ts < ? ORDER BY ts DESC LIMIT ?",
+                (float("inf") if before is None else before, limit)
+            )
+            for row in rows:
+                key = (row[1], row[3], row[5])  # guild_id, channel_id, user_id
+                group = grouped.get(key)
+                if group is None:
+                    group = grouped[key] = []
+                if per_key is None or len(group) < per_key:
+                    group.append(MemoryEntry(*row))
+            for group in grouped.values():
+                group.reverse()  # newest first from SQL → oldest first
+            return {(_intern(g), _intern(c), _intern(u)): group for (g, c, u), group in grouped.items()}
+
+        return await self._run(load)
+
+    async def delete_guild(self, guild_id):
+        if self.conn is None:
+            return
+        await self.flush()
+
+        def delete():
+            self.conn.execute("DELETE FROM memories WHERE guild_id = ?", (str(guild_id),))
+            self.conn.execute("DELETE FROM notes WHERE guild_id = ?", (str(guild_id),))
+            self.conn.commit()
+
+        await self._run(delete)
+
+    async def load_notes(self) -> list:
+        if self.conn is None:
+            return []
+        rows = await self._run(self._select, "SELECT guild_id, user_id, text, until, turns, updated FROM notes", ())
+        return [MemoryNote(*row) for row in rows]
+
+    async def save_note(self, note):
+        if self.conn is None:
+            return
+
+        def upsert():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO notes (guild_id, user_id, text, until, turns, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (note.guild_id, note.user_id, note.text, note.until, note.turns, note.updated)
+            )
+            self.conn.commit()
+
+        await self._run(upsert)
+
+    async def close(self):
+        await self.flush()
+        if self.writer is not None:
+            self.writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.writer
+            self.writer = None
+        if self.conn is not None:
+            await self._run(self.conn.close)
+            self.conn = None
+        self._executor.shutdown(wait=False)
+        # Ready for start() again: __main__ reruns main() on a fresh loop after a crash
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-db")
+        self.queue = asyncio.Queue()
+        self._flush_now = asyncio.Event()
+        print(f"[Memory] 🗄️ SQLite store closed ({self.stats['written']} rows written this run)")
+
+    def summary(self) -> dict:
+        return {"backend": self.name, "path": self.path, "pending": self.queue.qsize(), **self.stats}
+
+def create_memory_backend(kind: str = MEMORY_BACKEND) -> MemoryBackend:
+    if kind == "sqlite":
+        return SQLiteMemoryBackend()
+    if kind not in ("memory", "none", ""):
+        print(f"[Memory] ⚠️ Unknown MEMORY_BACKEND={kind!r} → RAM only")
+    return MemoryBackend()
+
+# ================== Memory log channel ================== #
+# One line per entry (older logs: one entry per message; now packed batches,
+# see MemoryChannelLogger):
+# `[ts]` | `Server name: G, ID: (1)` | `Channel name: C, ID: (2)` | `User Name: U, ID: (3)` | `Role: r` | `content` | `emotion`
+
+MEMORY_CHECKPOINT_PATH = os.getenv("MEMORY_CHECKPOINT_PATH", "memory_checkpoint.json")
+HISTORY_PAGE_SIZE = 100  # Discord's maximum per history request
+CHECKPOINT_SAVE_DELAY = float(os.getenv("MEMORY_CHECKPOINT_SAVE_DELAY", "5"))  # debounce for sunk-id saves
+
+_LOG_LINE = re.compile(
+    r"^`?\[(?P<ts>[^\]]+)\]`? \| "
+    r"`?Server name: (?P<guild_name>.*?), ID: \((?P<guild_id>[^)]*)\)`? \| "
+    r"`?Channel name: (?P<channel_name>.*?), ID: \((?P<channel_id>[^)]*)\)`? \| "
+    r"`?User Name: (?P<username>.*?), ID: \((?P<user_id>[^)]*)\)`? \| "
+    r"`?Role: (?P<role>[^`|]*?)`? \| "
+    r"`?(?P<content>.*?)`? \| `?(?P<emotion>[^`|]*?)`?$",
+    re.S
+)
+
+# ---------------- Batched channel logger ---------------- #
+# Many entries per Discord message: a packed text message while it fits, a
+# gzip attachment past the threshold. Packed lines escape "\" and newlines so
+# every entry stays on one line.
+
+MEMORY_LOG_FLUSH_INTERVAL = float(os.getenv("MEMORY_LOG_FLUSH_INTERVAL", "30"))  # seconds a batch may wait
+MEMORY_LOG_ATTACH_THRESHOLD = int(os.getenv("MEMORY_LOG_ATTACH_THRESHOLD", "1900"))  # chars; above → .gz file
+MEMORY_LOG_MAX_BATCH_BYTES = int(os.getenv("MEMORY_LOG_MAX_BATCH_BYTES", str(256 * 1024)))  # flush early at this size
+MEMORY_LOG_MAX_PENDING = 20000  # lines kept for retry while Discord is failing
+BATCH_HEADER = "`[memory-batch]`"
+
+_PACKED_ESCAPES = {"\\": "\\", "|": "|", "n": "\n"}
+_PACKED_ESCAPE = re.compile(r"\\(.)", re.S)
+
+def _pack_content(content: str) -> str:
+    return content.replace("\\", "\\\\").replace("|", "\\|").replace("\n", "\\n")
+
+def _unpack_content(content: str) -> str:
+    return _PACKED_ESCAPE.sub(lambda m: _PACKED_ESCAPES.get(m.group(1), m.group(0)), content)
+
+def format_memory_log_line(timestamp: str, guild_name, guild_id, channel_name, channel_id,
+                           username, user_id, role, content: str, emotion, packed: bool = False) -> str:
+    safe_content = _pack_content(content) if packed else content.replace("|", "\\|")
+    return (
+        f"`[{timestamp}]` | `Server name: {guild_name}, ID: ({guild_id})` | "
+        f"`Channel name: {channel_name}, ID: ({channel_id})` | "
+        f"`User Name: {username}, ID: ({user_id})` | "
+        f"`Role: {role}` | `{safe_content}` | `{emotion}`"
+    )
+
+class MemoryChannelLogger:
+    """
+    Buffers memory log lines for one channel and posts them in batches:
+    on a timer (flush_interval), early once max_batch_bytes are buffered,
+    and on flush() at shutdown. Failed batches are kept for the next try.
+    """
+
+    def __init__(self, channel, flush_interval: float = MEMORY_LOG_FLUSH_INTERVAL,
+                 attach_threshold: int = MEMORY_LOG_ATTACH_THRESHOLD,
+                 max_batch_bytes: int = MEMORY_LOG_MAX_BATCH_BYTES, on_sent=None):
+        self.channel = channel
+        self.flush_interval = flush_interval
+        self.attach_threshold = attach_threshold
+        self.max_batch_bytes = max_batch_bytes
+        self.on_sent = on_sent  # called with each posted message id
+        self.lines = []
+        self.size = 0
+        self._timer_task = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        self.stats = {"entries": 0, "messages": 0, "attachments": 0, "failures": 0, "dropped": 0}
+
+    def add(self, line: str):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        loop = asyncio.get_running_loop()
+        if self.size >= self.max_batch_bytes:
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = loop.create_task(self.flush())
+        elif self._timer_task is None or self._timer_task.done():
+            self._timer_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.lines:
+                return
+            lines, self.lines, self.size = self.lines, [], 0
+            header = f"{BATCH_HEADER} {len(lines)} entries"
+            body = "\n".join([header] + lines)
+            try:
+                if len(body) <= self.attach_threshold:
+                    sent = await self.channel.send(body)
+                else:
+                    import discord  # only needed for attachments
+                    data = gzip.compress(body.encode("utf-8"))
+                    sent = await self.channel.send(
+                        f"{header} (gzip, {len(body) // 1024} KiB → {len(data) // 1024} KiB)",
+                        file=discord.File(io.BytesIO(data), filename=f"memory-{int(time.time())}.log.gz")
+                    )
+                    self.stats["attachments"] += 1
+            except Exception as e:
+                self.stats["failures"] += 1
+                self.lines = lines + self.lines
+                overflow = len(self.lines) - MEMORY_LOG_MAX_PENDING
+                if overflow > 0:
+                    del self.lines[:overflow]  # still in the memory store; only the mirror loses them
+                    self.stats["dropped"] += overflow
+                self.size = sum(len(line) + 1 for line in self.lines)
+                print(f"[Memory Channel Error] Batch of {len(lines)} entries not sent ({e}); will retry")
+                return
+            self.stats["entries"] += len(lines)
+            self.stats["messages"] += 1
+            print(f"[Memory] Logged {len(lines)} entries to channel in one message")
+            if self.on_sent is not None and sent is not None:
+                self.on_sent(sent.id)
+
+    def summary(self) -> dict:
+        return {"pending": len(self.lines), **self.stats}
+
+def parse_memory_log_line(text: str, packed: bool = False) -> Optional[MemoryEntry]:
+    match = _LOG_LINE.match(text.strip())
+    if not match:
+        return None
+    content = _unpack_content(match["content"]) if packed else match["content"].replace("\\|", "|")
+    return MemoryEntry(
+        _parse_timestamp(match["ts"]), match["guild_id"], match["guild_name"],
+        match["channel_id"], match["channel_name"], match["user_id"], match["username"],
+        content.strip(), match["role"].strip(), match["emotion"].strip() or "neutral"
+    )
+
+def parse_memory_log(contents: list) -> list:
+    """
+    Parse a page of memory-channel payloads, each either a message text or
+    the bytes of a .gz attachment. Handles the old one-entry-per-message
+    format and packed batches (BATCH_HEADER + one entry per line).
+    """
+    entries = []
+    for payload in contents:
+        if isinstance(payload, bytes):
+            try:
+                payload = gzip.decompress(payload).decode("utf-8")
+            except Exception as e:
+                print(f"[Memory Parse Warning] Unreadable batch attachment: {e}")
+                continue
+        if payload.startswith(BATCH_HEADER):
+            lines, packed = payload.split("\n")[1:], True
+        else:
+            lines, packed = [payload], False
+        for line in lines:
+            entry = parse_memory_log_line(line, packed)
+            if entry is None:
+                print(f"[Memory Parse Warning] Skipping malformed line: {line[:120]}")
+                continue
+            entries.append(entry)
+    return entries
+
+class _Snowflake:
+    """Minimal discord Snowflake for history(after=...) (keeps this module discord-free)."""
+    __slots__ = ("id",)
+
+    def __init__(self, id: int):
+        self.id = id
+
+class HistoryCheckpoint:
+    """Last memory-channel message id already replayed into the store (JSON file)."""
+
+    def __init__(self, path: str = MEMORY_CHECKPOINT_PATH):
+        self.path = path
+        self.last_message_id = 0
+        self.rows = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.last_message_id = int(data.get("last_message_id", 0))
+            self.rows = int(data.get("rows", 0))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[Memory] ⚠️ History checkpoint unreadable ({e}), starting fresh")
+
+    def advance(self, message_id: int, rows: int):
+        self.last_message_id = max(self.last_message_id, message_id)
+        self.rows += rows
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"last_message_id": self.last_message_id, "rows": self.rows, "updated": time.time()}, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[Memory] ⚠️ Could not save history checkpoint: {e}")
 
 class MemoryManager:
-    def __init__(self):
-        # Structure: guild_id -> channel_id -> user_id -> list of messages
+    def __init__(self, max_per_user: int = MEMORY_MAX_PER_USER, backend: Optional[MemoryBackend] = None):
+        # Structure: guild_id -> channel_id -> user_id -> deque(maxlen) of MemoryEntry (oldest first)
         self.data = {}
+        self.max_per_user = max_per_user
+        self.backend = backend or MemoryBackend()
+        self.discord_sink = None  # optional memory channel: every save is also logged there
+        self._loaded = set()      # (guild, channel, user) keys already backfilled from the backend
+        self._sunk_ids = set()    # memory-channel message ids this run posted itself
+        self._channel_loggers = {}  # channel id -> MemoryChannelLogger
+        self._history_done = False
+        self.checkpoint = HistoryCheckpoint()
+        self.history_stats = {"status": "idle"}
+        self.notes = {}               # (guild, user) -> MemoryNote
+        self._compact_pending = set()  # (guild, user) keys with turns newer than their note
+        self.compaction_stats = {"rounds": 0, "notes": 0, "turns": 0, "tokens_in": 0, "failures": 0,
+                                 "deferred": 0, "last_seconds": 0.0}
+        self.recall_index = {}  # (guild, user) -> RecallIndex over the user's own messages
+        self._unindexed = {}    # (guild, user) -> restored/imported entries, indexed on first recall()
+        self._restore_task = None
+        self._checkpoint_task = None
+        self.recall_stats = {"queries": 0, "hits": 0, "lazy_builds": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+    def _bucket(self, guild_id, channel_id, user_id) -> deque:
+        users = self.data.setdefault(_intern(guild_id), {}).setdefault(_intern(channel_id), {})
+        bucket = users.get(user_id)
+        if bucket is None:
+            bucket = users[_intern(user_id)] = deque(maxlen=self.max_per_user)
+        return bucket
+
+    def _extend_sorted(self, guild_id, channel_id, user_id, entries):
+        """Add entries that may be older than what is stored (history loads/imports); keeps time order."""
+        bucket = self._bucket(guild_id, channel_id, user_id)
+        entries = sorted(entries, key=_entry_ts)
+        if not bucket or not entries or entries[0].ts >= bucket[-1].ts:
+            bucket.extend(entries)
+            if entries and user_id != "bot":
+                self._compact_pending.add((_intern(guild_id), _intern(user_id)))
+                self._defer_index(entries)
+            return
+        merged = deque(heapq.merge(bucket, entries, key=_entry_ts), maxlen=self.max_per_user)
+        self.data[_intern(guild_id)][_intern(channel_id)][_intern(user_id)] = merged
+        if user_id != "bot":
+            self._compact_pending.add((_intern(guild_id), _intern(user_id)))
+            self._defer_index(entries)
 
     def save(self, guild_id, guild_name, channel_id, channel_name, user_id, username, content, emotion=None, avatar_url=None, role="user"):
-        entry = {
-            "timestamp": datetime.datetime.utcnow().isoformat(),
-            "guild_id": guild_id,
-            "guild_name": guild_name,
-            "channel_id": channel_id,
-            "channel_name": channel_name,
-            "user_id": user_id,
-            "username": username,
-            "content": content,
-            "role": role,
-            "emotion": emotion or "neutral",
-            "avatar_url": avatar_url
-        }
-        self.data.setdefault(guild_id, {}).setdefault(channel_id, {}).setdefault(user_id, []).append(entry)
+        entry = MemoryEntry(
+            time.time(), guild_id, guild_name, channel_id, channel_name,
+            user_id, username, content, role, emotion or "neutral", avatar_url
+        )
+        bucket = self._bucket(guild_id, channel_id, user_id)
+        if bucket and entry.ts < bucket[-1].ts:
+            entry.ts = bucket[-1].ts  # clock stepped back: keep the deque sorted
+        bucket.append(entry)
+        self.backend.append(entry)
+        if role == "user":
+            self._compact_pending.add((entry.guild_id, entry.user_id))
+            self._index_entries((entry,))
+        if self.discord_sink is not None:
+            self._log_to_sink(entry)
 
-    def get_monika_context(self, guild_id: str, channel_id: str, user_id: str, limit=10):
-        """Retrieve the last few relevant messages from Monika and a user in the given channel."""
-        guild_id = str(guild_id)
-        channel_id = str(channel_id)
-        user_id = str(user_id)
+    def _log_to_sink(self, entry: MemoryEntry):
+        """Secondary sink: mirror the entry into the Discord memory channel (batched)."""
+        try:
+            self._channel_logger(self.discord_sink).add(format_memory_log_line(
+                entry.timestamp[:19].replace("T", " "), entry.guild_name, entry.guild_id,
+                entry.channel_name, entry.channel_id, entry.username, entry.user_id,
+                entry.role, entry.content, entry.emotion, packed=True
+            ))
+        except RuntimeError:
+            return  # no running loop (scripts/benchmarks)
 
-        if guild_id not in self.data:
-            return []
+    def _channel_logger(self, channel) -> MemoryChannelLogger:
+        logger = self._channel_loggers.get(channel.id)
+        if logger is None:
+            logger = self._channel_loggers[channel.id] = MemoryChannelLogger(channel, on_sent=self._note_sunk)
+        return logger
 
-        if channel_id not in self.data[guild_id]:
-            return []
+    def _note_sunk(self, message_id: int):
+        """Our own mirrored lines are already stored: never replay them into the store."""
+        self._sunk_ids.add(message_id)
+        if self._history_done:
+            self.checkpoint.advance(message_id, 0)
+            self._schedule_checkpoint_save()
 
-        user_messages = self.data[guild_id][channel_id].get(user_id, [])
-        bot_messages = self.data[guild_id][channel_id].get("bot", [])
+    def _schedule_checkpoint_save(self):
+        """Persist the checkpoint soon (debounced), so a crash doesn't replay this run's batches."""
+        if not self.backend.durable:
+            return
+        if self._checkpoint_task is None or self._checkpoint_task.done():
+            self._checkpoint_task = asyncio.get_running_loop().create_task(self._save_checkpoint_later())
 
-        # Merge and sort by timestamp (assuming timestamp is ISO format)
-        all_messages = user_messages + bot_messages
+    async def _save_checkpoint_later(self):
+        await asyncio.sleep(CHECKPOINT_SAVE_DELAY)
         try:
-            sorted_messages = sorted(all_messages, key=lambda x: x.get("timestamp", ""))
+            await self.backend.flush()  # the rows behind those messages must be on disk first
         except Exception as e:
-            print(f"[Context Sort Error] {e}")
-            sorted_messages = all_messages
+            print(f"[Memory] ⚠️ Checkpoint save skipped, flush failed: {e}")
+            return
+        self.checkpoint.save()
 
-        return sorted_messages[-limit:]
+    # ---------------- Backend lifecycle ---------------- #
+
+    async def start(self, restore_rows: int = MEMORY_RESTORE_ROWS):
+        """
+        Open the backend and load the notes, then restore the newest
+        `restore_rows` entries into RAM in a background task (see wait_restored).
+        """
+        await self.backend.start()
+        for note in await self.backend.load_notes():
+            self.notes[(note.guild_id, note.user_id)] = note
+        if self._restore_task is None:
+            self._restore_task = asyncio.get_running_loop().create_task(self._restore(restore_rows, time.time()))
+
+    async def _restore(self, restore_rows: int, before: float):
+        started = time.perf_counter()
+        try:
+            # Only rows from before start(): anything saved since is already in RAM
+            grouped = await self.backend.restore(restore_rows, per_key=self.max_per_user, before=before)
+        except Exception as e:
+            print(f"[Memory] ❌ Restore from {self.backend.name} failed: {e}")
+            return
+        restored = merged = 0
+        for (guild_id, channel_id, user_id), entries in grouped.items():
+            self._extend_sorted(guild_id, channel_id, user_id, entries)
+            restored += len(entries)
+            merged += len(entries)
+            if merged >= RESTORE_CHUNK:  # let messages through between chunks
+                merged = 0
+                await asyncio.sleep(0)
+        print(f"[Memory] ✅ Restored {restored} entries ({len(grouped)} conversations) "
+              f"from {self.backend.name} in {time.perf_counter() - started:.2f}s")
+
+    async def wait_restored(self):
+        """Wait for the startup restore (if any) to finish."""
+        if self._restore_task is not None:
+            await asyncio.shield(self._restore_task)
+
+    async def backfill(self, guild_id, channel_id, user_id):
+        """Load a conversation that fell outside the startup restore window (once per key)."""
+        key = (str(guild_id), str(channel_id), str(user_id))
+        if key in self._loaded:
+            return
+        self._loaded.add(key)
+        await self.wait_restored()  # otherwise restored rows could be loaded twice
+        bucket = self.data.get(key[0], {}).get(key[1], {}).get(key[2])
+        if bucket is not None and len(bucket) == bucket.maxlen:
+            return
+        entries = await self.backend.recent(*key, self.max_per_user)
+        if bucket:
+            entries = [entry for entry in entries if entry.ts < bucket[0].ts]  # restored rows are already here
+        if entries:
+            self._extend_sorted(*key, entries)
+
+    async def load_context(self, guild_id, channel_id, user_id, limit=10):
+        """get_monika_context, backfilling the user and bot streams from the backend first."""
+        await self.backfill(guild_id, channel_id, user_id)
+        await self.backfill(guild_id, channel_id, "bot")
+        return self.get_monika_context(guild_id, channel_id, user_id, limit)
+
+    async def clear_guild(self, guild_id):
+        """Forget a guild in RAM and in the backend."""
+        guild_id = str(guild_id)
+        self.data.pop(guild_id, None)
+        self._loaded = {key for key in self._loaded if key[0] != guild_id}
+        self.notes = {key: note for key, note in self.notes.items() if key[0] != guild_id}
+        self._compact_pending = {key for key in self._compact_pending if key[0] != guild_id}
+        self.recall_index = {key: index for key, index in self.recall_index.items() if key[0] != guild_id}
+        self._unindexed = {key: entries for key, entries in self._unindexed.items() if key[0] != guild_id}
+        await self.backend.delete_guild(guild_id)
+
+    async def flush(self):
+        for logger in list(self._channel_loggers.values()):
+            await logger.flush()
+        await self.backend.flush()
+        if self._history_done and self.backend.durable:
+            self.checkpoint.save()
+
+    async def close(self):
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()  # flush() below saves the checkpoint anyway
+        if self._restore_task is not None and not self._restore_task.done():
+            self._restore_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._restore_task
+        await self.flush()
+        await self.backend.close()
+
+    def summary(self) -> dict:
+        conversations = entries = 0
+        for channels in self.data.values():
+            for users in channels.values():
+                conversations += len(users)
+                entries += sum(len(bucket) for bucket in users.values())
+        summary = {"conversations": conversations, "entries": entries, **self.backend.summary()}
+        if self._channel_loggers:
+            sinks = [logger.summary() for logger in self._channel_loggers.values()]
+            summary["sink"] = {key: sum(s[key] for s in sinks) for key in sinks[0]}
+        summary["compaction"] = {"stored": len(self.notes), "pending": len(self._compact_pending), **self.compaction_stats}
+        summary["recall"] = {
+            "indexes": len(self.recall_index),
+            "docs": sum(len(index) for index in self.recall_index.values()),
+            "unindexed": sum(len(entries) for entries in self._unindexed.values()),
+            **self.recall_stats,
+        }
+        return summary
+
+    # ---------------- Recall ---------------- #
+
+    def _defer_index(self, entries):
+        """Bulk rows (restore, history, imports) are indexed lazily by recall(), off the startup path."""
+        for entry in entries:
+            if entry.role == "user":
+                self._unindexed.setdefault((entry.guild_id, entry.user_id), []).append(entry)
+
+    def _index_entries(self, entries):
+        for entry in entries:
+            if entry.role != "user":
+                continue
+            key = (entry.guild_id, entry.user_id)
+            index = self.recall_index.get(key)
+            if index is None:
+                index = self.recall_index[key] = RecallIndex()
+            index.add(entry)
+
+    def recall(self, guild_id, user_id, query: str, k: int = MEMORY_RECALL_TOP_K,
+               min_age: float = MEMORY_RECALL_MIN_AGE) -> list:
+        """
+        The user's `k` past messages in this guild most relevant to `query`
+        (BM25), skipping the last `min_age` seconds (already in the chat
+        context). Oldest first. Restored/imported rows for this user are
+        indexed here, on the first query.
+        """
+        key = (str(guild_id), str(user_id))
+        started = time.perf_counter()
+        pending = self._unindexed.pop(key, None)
+        index = self.recall_index.get(key)
+        if pending:
+            if index is None:
+                index = self.recall_index[key] = RecallIndex()
+            # One rebuild over old + deferred docs, newest max_docs kept (bounded by the cap)
+            docs = sorted(index.docs + pending, key=_entry_ts)
+            index._rebuild(docs[-index.max_docs:])
+            self.recall_stats["lazy_builds"] += 1
+        if index is None:
+            return []
+        hits = index.search(recall_terms(query), k, before=time.time() - min_age)
+        elapsed = time.perf_counter() - started
+        stats = self.recall_stats
+        stats["queries"] += 1
+        stats["hits"] += len(hits)
+        stats["seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        return sorted((entry for _, entry in hits), key=_entry_ts)
+
+    # ---------------- Rolling summaries ---------------- #
+
+    def get_memory_note(self, guild_id, user_id) -> str:
+        """The compacted long-term note for a user in a guild ("" when none yet)."""
+        note = self.notes.get((str(guild_id), str(user_id)))
+        return note.text if note else ""
+
+    def _summary_batch(self, guild_id: str, user_id: str, since: float,
+                       keep_recent: int = MEMORY_SUMMARY_KEEP_RECENT, min_turns: int = MEMORY_SUMMARY_MIN_TURNS,
+                       token_budget: int = MEMORY_SUMMARY_INPUT_TOKENS):
+        """
+        Transcript lines for the user's turns newer than `since` (all channels
+        of the guild, each with Monika's reply) minus the newest `keep_recent`,
+        cut to `token_budget`. Returns (lines, last_ts, turns) or None when
+        fewer than `min_turns` are waiting.
+        """
+        streams = []
+        for users in self.data.get(guild_id, {}).values():
+            user_stream = users.get(user_id)
+            if not user_stream or user_stream[-1].ts <= since:
+                continue
+            bot_stream = list(users.get("bot", ()))
+            bot_ts = [entry.ts for entry in bot_stream]
+            pairs, used = [], set()
+            for entry in user_stream:
+                if entry.ts <= since:
+                    continue
+                reply = None
+                i = bisect.bisect_left(bot_ts, entry.ts)
+                if i < len(bot_ts) and i not in used and bot_ts[i] - entry.ts <= MEMORY_SUMMARY_REPLY_WINDOW:
+                    reply = bot_stream[i]
+                    used.add(i)
+                pairs.append((entry.ts, entry, reply))
+            streams.append(pairs)
+
+        turns = list(heapq.merge(*streams, key=lambda pair: pair[0]))
+        if keep_recent:
+            turns = turns[:-keep_recent]
+        if len(turns) < min_turns:
+            return None
+
+        lines, tokens, last_ts, count = [], 0, since, 0
+        for ts, entry, reply in turns:
+            chunk = [f"{entry.username}: {entry.content}"]
+            if reply is not None:
+                chunk.append(f"Monika: {reply.content}")
+            cost = sum(estimate_tokens(line) for line in chunk)
+            if lines and tokens + cost > token_budget:
+                break
+            lines.extend(chunk)
+            tokens += cost
+            last_ts, count = ts, count + 1
+        return lines, last_ts, count
+
+    async def compact(self, summarize, max_conversations: int = MEMORY_SUMMARY_BATCH) -> int:
+        """
+        One compaction round: fold waiting turns of up to `max_conversations`
+        users into their notes. `summarize(previous_note, transcript, guild_id=,
+        user_id=)` returns the new note text, or None to defer (e.g. shed under
+        load). A failed or deferred key is skipped, so it can't hold up the
+        others; it still uses one of the round's `max_conversations` attempts.
+        Returns how many notes were updated.
+        """
+        started = time.perf_counter()
+        stats = self.compaction_stats
+        updated = attempts = 0
+        for key in list(self._compact_pending):
+            if attempts >= max_conversations:
+                break
+            guild_id, user_id = key
+            note = self.notes.get(key)
+            batch = self._summary_batch(guild_id, user_id, note.until if note else 0.0)
+            if batch is None:
+                self._compact_pending.discard(key)  # re-added by the next save
+                continue
+            lines, until, count = batch
+            transcript = "\n".join(lines)
+            attempts += 1
+            try:
+                text = await summarize(note.text if note else "", transcript, guild_id=guild_id, user_id=user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                stats["failures"] += 1
+                print(f"[Memory] ⚠️ Summarizing {guild_id}/{user_id} failed: {e}")
+                continue
+            if not text:
+                stats["deferred"] += 1
+                continue  # this one waits for a later round; move on to the next key
+            note = MemoryNote(guild_id, user_id, text.strip()[:MEMORY_SUMMARY_MAX_CHARS], until,
+                              (note.turns if note else 0) + count, time.time())
+            self.notes[key] = note
+            await self.backend.save_note(note)
+            updated += 1
+            stats["notes"] += 1
+            stats["turns"] += count
+            stats["tokens_in"] += estimate_tokens(transcript)
+        stats["rounds"] += 1
+        stats["last_seconds"] = time.perf_counter() - started
+        if updated:
+            print(f"[Memory] 📝 Compacted {updated} conversations into notes in {stats['last_seconds']:.1f}s")
+        return updated
+
+    def get_monika_context(self, guild_id: str, channel_id: str, user_id: str, limit=10):
+        """Retrieve the last few relevant messages from Monika and a user in the given channel."""
+        channels = self.data.get(str(guild_id))
+        if not channels:
+            return []
+        users = channels.get(str(channel_id))
+        if not users:
+            return []
+
+        user_messages = users.get(str(user_id), ())
+        bot_messages = users.get("bot", ())
+
+        # Both deques are already time-ordered: merge them newest-first and stop after `limit`
+        newest = heapq.merge(reversed(user_messages), reversed(bot_messages), key=_entry_ts, reverse=True)
+        recent = list(itertools.islice(newest, limit))
+        recent.reverse()
+        return [entry.to_dict() for entry in recent]
 
     async def save_to_memory_channel(self, content, emotion, user_id, username, role, guild_id, guild_name, channel_id, channel_name, memory_channel):
+        """Queue one entry for the channel's batched logger (posted on its timer / size trigger)."""
         if not memory_channel:
             print("[Memory] No memory channel provided.")
             return
 
-        safe_content = content.replace("|", "\\|")
         timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-
-        log_message = (
-            f"`[{timestamp}]` | `Server name: {guild_name}, ID: ({guild_id})` | "
-            f"`Channel name: {channel_name}, ID: ({channel_id})` | "
-            f"`User Name: {username}, ID: ({user_id})` | "
-            f"`Role: {role}` | `{safe_content}` | `{emotion}`"
-        )
-
-        try:
-            await memory_channel.send(log_message)
-            print(f"[Memory] Logged to channel: {log_message}")
-        except Exception as e:
-            print(f"[Memory Channel Error] {e}")
+        self._channel_logger(memory_channel).add(format_memory_log_line(
+            timestamp, guild_name, guild_id, channel_name, channel_id,
+            username, user_id, role, content, emotion, packed=True
+        ))
 
     async def load_history(self, client, MEMORY_CHAN_ID):
+        """
+        Replay the memory log channel into RAM and the backend, oldest first,
+        in pages of HISTORY_PAGE_SIZE fetched with `after=`. With a durable
+        backend only messages newer than the checkpoint are fetched (older ones
+        are already in the store); the checkpoint advances after every page, so
+        an interrupted load resumes where it stopped. Meant to run as a
+        background task: parsing happens off the event loop.
+        """
+        await self.wait_restored()  # replayed rows must not race the restore into RAM
+        started = time.perf_counter()
         log_channel = client.get_channel(MEMORY_CHAN_ID)
         if not log_channel:
             print("[Memory] Log channel not found.")
             return
 
-        print("[Memory] Loading history from log channel...")
+        checkpoint = self.checkpoint
+        resume_id = checkpoint.last_message_id if self.backend.durable else 0
+        if checkpoint.last_message_id and not self.backend.durable:
+            print("[Memory] RAM-only backend → replaying the whole log channel")
+        print(f"[Memory] Loading history from log channel (after {resume_id or 'start'})...")
+        self.history_stats = {"status": "loading", "rows": 0, "messages": 0, "pages": 0, "seconds": 0.0, "after": resume_id}
 
-        async for msg in log_channel.history(limit=500):
-            try:
-                if not msg.content or "] |" not in msg.content:
+        after = _Snowflake(resume_id) if resume_id else None
+        rows = messages = pages = 0
+        while True:
+            page = [msg async for msg in log_channel.history(limit=HISTORY_PAGE_SIZE, after=after, oldest_first=True)]
+            if not page:
+                break
+            pages += 1
+            messages += len(page)
+            contents = []
+            for msg in page:
+                if msg.id in self._sunk_ids:
                     continue
+                if msg.content.startswith(BATCH_HEADER) and msg.attachments:
+                    for attachment in msg.attachments:
+                        if attachment.filename.endswith(".gz"):
+                            contents.append(await attachment.read())
+                elif msg.content:
+                    contents.append(msg.content)
+            entries = await asyncio.to_thread(parse_memory_log, contents)
 
-                timestamp_part, rest = msg.content.split("] |", 1)
-                timestamp = timestamp_part.strip("[")
-                parts = [p.strip() for p in rest.split(" | ")]
+            grouped = {}
+            for entry in entries:
+                grouped.setdefault((entry.guild_id, entry.channel_id, entry.user_id), []).append(entry)
+                self.backend.append(entry)
+            for (guild_id, channel_id, user_id), group in grouped.items():
+                self._extend_sorted(guild_id, channel_id, user_id, group)
+            rows += len(entries)
 
-                if len(parts) < 6:
-                    print(f"[Memory Parse Warning] Skipping malformed line: {msg.content}")
-                    continue
-
-                guild_info = parts[0].replace("Server name:", "").split(", ID: (")
-                guild_name = guild_info[0].strip()
-                guild_id = guild_info[1].strip(")")
-
-                channel_info = parts[1].replace("Channel name:", "").split(", ID: (")
-                channel_name = channel_info[0].strip()
-                channel_id = channel_info[1].strip(")")
-
-                user_info = parts[2].replace("User Name:", "").split(", ID: (")
-                username = user_info[0].strip()
-                user_id = user_info[1].strip(")")
-
-                role = parts[3].replace("Role:", "").strip()
-                content = parts[4].replace("\\|", "|").strip()
-                emotion = parts[5].strip()
-
-                self.data \
-                    .setdefault(guild_id, {}) \
-                    .setdefault(channel_id, {}) \
-                    .setdefault(user_id, []) \
-                    .append({
-                        "guild_id": guild_id,
-                        "guild_name": guild_name,
-                        "channel_id": channel_id,
-                        "channel_name": channel_name,
-                        "user_id": user_id,
-                        "username": username,
-                        "role": role,
-                        "content": content,
-                        "emotion": emotion,
-                        "timestamp": timestamp
-                    })
+            # Rows must be on disk before the checkpoint says they were processed
+            await self.backend.flush()
+            checkpoint.advance(page[-1].id, len(entries))
+            if self.backend.durable:
+                checkpoint.save()
+            self.history_stats.update(rows=rows, messages=messages, pages=pages, seconds=time.perf_counter() - started)
 
-            except Exception as e:
-                print(f"[Memory Parse Error] {e}")
+            after = page[-1]
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
 
-        print("[Memory] History load complete.")
+        self._history_done = True
+        if self._sunk_ids:  # lines this run mirrored itself are already stored
+            checkpoint.advance(max(self._sunk_ids), 0)
+            if self.backend.durable:
+                checkpoint.save()
+        elapsed = time.perf_counter() - started
+        self.history_stats.update(status="done", seconds=elapsed)
+        print(f"[Memory] ✅ History load complete: {rows} rows from {messages} messages "
+              f"({pages} pages) in {elapsed:.2f}s")
 
     def import_from_text(self, guild_id: str, text: str) -> int:
         """
@@ -135,12 +1290,9 @@ class MemoryManager:
         """
         lines = text.splitlines()
         imported = 0
-
-        self.data.setdefault(guild_id, {})
-
+        guild_id = str(guild_id)
         current_channel = "imported"
-        self.data[guild_id].setdefault(current_channel, {})
-        self.data[guild_id][current_channel].setdefault("manual_import", [])
+        entries = []
 
         section = "memories"  # track which section we're parsing
         personality = []
@@ -158,13 +1310,10 @@ class MemoryManager:
                 match = re.match(r"\[(.*?)\] (.*?): (.*)", line)
                 if match:
                     ts, username, content = match.groups()
-                    entry = {
-                        "timestamp": ts,
-                        "username": username,
-                        "content": content,
-                        "user_id": "manual_import"
-                    }
-                    self.data[guild_id][current_channel]["manual_import"].append(entry)
+                    entries.append(MemoryEntry(
+                        _parse_timestamp(ts), guild_id, None, current_channel, None,
+                        "manual_import", username, content
+                    ))
                     imported += 1
 
             elif section == "personality":
@@ -181,6 +1330,7 @@ class MemoryManager:
                         relationship["with"] = [u.strip() for u in with_users.split(",")]
 
         # Save into memory
+        self._extend_sorted(guild_id, current_channel, "manual_import", entries)
         if personality:
             self.set_personality(guild_id, personality)
         if relationship:
@@ -10,6 +10,8 @@ import traceback
 import datetime
 import threading
 import typing
+from typing import Optional
+from types import SimpleNamespace
 import atexit
 import requests
 import json
@@ -33,10 +35,21 @@ from OpenAIKeys import (
     init_key_manager,
     init_image_key_manager,
     periodic_rescan,
+    close_shared_clients,
+    work_scheduler,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_CHANNEL,
+    PRIORITY_IDLE,
+    PRIORITY_MAINTENANCE,
+    WorkShedError,
+    CommittedCallError,
+    classify_error,
+    ERROR_MODEL,
+    model_router,
     key_manager,
     image_key_manager
 )
-from memory import MemoryManager
+from memory import MemoryManager, ConversationBuffer, create_memory_backend, MEMORY_SUMMARY_MAX_CHARS
 from expression import User_SpritesManager
 # from expression_dokitubers import DOKITUBER_MANAGERS
 # from expression_MAS import MAS_SpritesManager
@@ -46,12 +59,18 @@ from monika_personality import MonikaTraits
 from performance import (
     background_task,
     cache_result,
+    SingleFlight,
+    LatencyWindow,
+    LRUCache,
+    Debouncer,
+    StageTimer,
     get_memory_usage,
     cleanup_memory,
     async_cleanup_memory,
     monitor_event_loop,
 )
 from vote_tracker import VoteTracker
+from usage_tracker import usage_tracker
 from Idle_Presence import monika_idle_presences
 
 logging.basicConfig(
@@ -63,10 +82,36 @@ logger = logging.getLogger("Monika")
 logger.info("Just Monika!")
 
 # ================== OpenAI Cache ================== #
-_openai_cache = {}  # (context_id, model, hash) -> (timestamp, reply_text)
 CACHE_TTL = 20  # seconds before cache expires
-CACHE_PRUNE_INTERVAL = 200  # prune every 200 cache inserts
-_cache_counter = 0
+CACHE_SNAPSHOT_DIR = os.getenv("CACHE_SNAPSHOT_DIR")  # optional: persist caches across restarts
+_openai_cache = LRUCache(  # (context_id, model, hash) -> reply_text
+    "OpenAI Cache",
+    max_entries=int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "2000")),
+    max_bytes=int(os.getenv("REPLY_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+    ttl=CACHE_TTL,
+    snapshot_path=os.path.join(CACHE_SNAPSHOT_DIR, "reply_cache.json") if CACHE_SNAPSHOT_DIR else None,
+)
+_openai_inflight = SingleFlight("OpenAI")  # (context_id, conv_hash) -> shared in-flight task
+pipeline_timer = StageTimer("Pipeline")  # "guild.*" / "dm.*" stage latencies (see pipeline_benchmark.py)
+REPLY_MODELS = ["gpt-5-nano", "gpt-5-mini", "gpt-3.5-turbo"]  # preferred order; model_router adapts it
+
+# ---------------- Provider prompt caching ---------------- #
+PROMPT_CACHE_KEY = os.getenv("OPENAI_PROMPT_CACHE_KEY", "1") == "1"  # route same-prefix requests together
+_prompt_cache_latency = {"hit": LatencyWindow(), "miss": LatencyWindow()}  # reply latency by cached_tokens > 0
+
+def _prefix_cache_options(conversation: list[dict]) -> dict:
+    """prompt_cache_key from the static system prompt: same persona/settings → same provider cache."""
+    if not PROMPT_CACHE_KEY or not conversation or conversation[0].get("role") != "system":
+        return {}
+    return {"prompt_cache_key": hashlib.sha256(conversation[0]["content"].encode("utf-8")).hexdigest()[:32]}
+
+def _record_prompt_cache(usage, elapsed: float):
+    """Split reply latency by whether the provider served part of the prompt from its cache."""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    _prompt_cache_latency["hit" if cached else "miss"].add(elapsed)
 
 def _make_conv_hash(conversation: list[dict]) -> str:
     """Create a stable short hash from the conversation list (system included)."""
@@ -78,101 +123,425 @@ def _make_conv_hash(conversation: list[dict]) -> str:
     )
     return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
 
-def _prune_cache():
-    """Remove expired cache entries safely to free memory."""
-    global _openai_cache
-    now = time.time()
-    expired = [k for k, (ts, _) in _openai_cache.items() if now - ts >= CACHE_TTL]
-    for k in expired:
-        _openai_cache.pop(k, None)
-    if expired:
-        print(f"[OpenAI] 🧹 Pruned {len(expired)} expired cache entries.")
-
-async def call_openai_with_retries(user, relationship, personality, conversation):
+async def call_openai_with_retries(user, relationship, personality, conversation, emotion_labels=None, priority=PRIORITY_CHANNEL):
     """
     Fast and safe OpenAI caller:
     - Caches responses for 20s
-    - Avoids UnboundLocalError by proper global use
+    - Coalesces identical in-flight requests (same context + conversation)
     - Optimized for 3–5s replies
     - Handles multiple concurrent users safely
+    - With emotion_labels: asks for a JSON {"reply", "emotion"} object and
+      returns the raw JSON text (see parse_structured_reply)
+    - priority: work_scheduler class (PRIORITY_INTERACTIVE for DMs/mentions)
     """
-    global _cache_counter, _openai_cache  # ✅ ensures both are global
-
-    model_priority = ["gpt-5-nano", "gpt-5-mini", "gpt-3.5-turbo"]
+    model_priority = model_router.order(REPLY_MODELS)
 
     # ---------------- Context ---------------- #
     context_id = getattr(getattr(user, "guild", None), "id", None) or user.id
     is_guild = hasattr(user, "guild") and user.guild is not None
+    usage_tags = {
+        "feature": "reply_structured" if emotion_labels else "reply",
+        "guild": context_id if is_guild else None,
+        "user": user.id,
+    }
 
     if not isinstance(conversation, list):
         raise ValueError("Conversation must be a list of messages.")
 
+    request_options = None
+    if emotion_labels:
+        conversation = _with_structured_instruction(conversation, emotion_labels)
+        request_options = {"response_format": {"type": "json_object"}}
+
     # ---------------- Cache check ---------------- #
     conv_hash = _make_conv_hash(conversation)
     for model in model_priority:
         cache_key = (context_id, model, conv_hash)
-        cached = _openai_cache.get(cache_key)
-        if cached:
-            ts, cached_reply = cached
-            if time.time() - ts < CACHE_TTL:
-                print(f"[OpenAI] ⚡ Cache hit → {model}")
-                return cached_reply
-            else:
-                _openai_cache.pop(cache_key, None)
+        cached_reply = _openai_cache.get(cache_key)
+        if cached_reply:
+            print(f"[OpenAI] ⚡ Cache hit → {model}")
+            return cached_reply
+
+    # ---------------- Single-flight ---------------- #
+    # Identical requests that arrive while one is still running share its result
+    return await _openai_inflight.run(
+        (context_id, conv_hash),
+        lambda: _complete_conversation(
+            user, relationship, personality, conversation,
+            model_priority, context_id, is_guild, conv_hash, request_options, priority, usage_tags
+        )
+    )
 
+async def _complete_conversation(user, relationship, personality, conversation, model_priority, context_id, is_guild, conv_hash, request_options=None, priority=PRIORITY_CHANNEL, usage_tags=None):
+    """Build the system prompt, then ask model_priority (hedged or sequential) for a reply."""
     # ---------------- Build system prompt ---------------- #
-    system_prompt = await generate_monika_system_prompt(
-        guild=user.guild if hasattr(user, "guild") else None,
-        user=user,
-        relationship_type=relationship,
-        selected_modes=personality,
+    # The handlers already put the system prompt first; only build one if missing
+    if conversation and conversation[0].get("role") == "system":
+        full_conversation = conversation
+    else:
+        static_prompt, volatile_prompt = await generate_monika_prompt_parts(
+            guild=user.guild if hasattr(user, "guild") else None,
+            user=user,
+            relationship_type=relationship,
+            selected_modes=personality,
+        )
+        full_conversation = with_volatile_context([{"role": "system", "content": static_prompt}] + conversation, volatile_prompt)
+
+    if HEDGE_ENABLED and len(model_priority) > 1:
+        reply_text = await _hedged_completion(model_priority, full_conversation, context_id, is_guild, conv_hash, request_options, priority, usage_tags)
+    else:
+        reply_text = None
+        # ---------------- Sequential fast retry ---------------- #
+        for model in model_priority:
+            reply_text = await _call_model(
+                model, full_conversation, context_id, is_guild, conv_hash, request_options, priority,
+                force=model == model_priority[-1], usage_tags=usage_tags
+            )
+            if reply_text:
+                break
+
+    if reply_text:
+        return reply_text
+
+    print("[OpenAI] ❌ All models failed.")
+    return None
+
+async def _call_model(model, full_conversation, context_id, is_guild, conv_hash, request_options=None, priority=PRIORITY_CHANNEL, force=False, usage_tags=None):
+    """
+    Run one model through openai_safe_call; return the reply text or None.
+    Skipped while the model's circuit is open unless `force` (last resort).
+    """
+    if not model_router.allow(model, force=force):
+        print(f"[OpenAI] 🔌 {model} circuit open → skip")
+        return None
+
+    options = {**_prefix_cache_options(full_conversation), **(request_options or {})}
+
+    async def call_fn(client):
+        # ⚡ Remove asyncio.wait_for (causes CancelledError)
+        return await client.chat.completions.create(
+            model=model,
+            messages=full_conversation,
+            timeout=15,  # safe internal OpenAI timeout (doesn't block asyncio)
+            **options
+        )
+
+    try:
+        start_time = time.perf_counter()
+        response = await openai_safe_call(
+            key_manager,
+            fn=call_fn,
+            context_id=context_id,
+            is_guild=is_guild,
+            is_image=False,
+            priority=priority,
+            tags={**(usage_tags or {}), "model": model}
+        )
+        elapsed = time.perf_counter() - start_time
+
+        # Validate response
+        if response and getattr(response, "choices", None):
+            msg = response.choices[0].message
+            if msg and msg.content:
+                reply_text = msg.content.strip()
+                if reply_text:
+                    print(f"[OpenAI] ✅ {model} → {elapsed:.2f}s")
+                    model_router.record_success(model, elapsed)
+                    _model_latency.setdefault(model, LatencyWindow()).add(elapsed)
+                    _record_prompt_cache(getattr(response, "usage", None), elapsed)
+                    _openai_cache.set((context_id, model, conv_hash), reply_text)
+                    return reply_text
+
+        print(f"[OpenAI] ⚠️ {model} returned empty or invalid response → next")
+        model_router.record_failure(model)
+
+    except asyncio.CancelledError:
+        # Lost a hedge race — not a failure of the key or the model
+        model_router.abandon(model)
+        raise
+
+    except Exception as e:
+        # Key problems are handled inside openai_safe_call. Only model/server errors
+        # count against the breaker; a bad request (400, context length) or exhausted
+        # keys just release the probe slot
+        print(f"[OpenAI] ⚠️ {model} failed: {e}")
+        if classify_error(e) == ERROR_MODEL:
+            model_router.record_failure(model)
+        else:
+            model_router.abandon(model)
+
+    return None
+
+# ================== Model Hedging ================== #
+HEDGE_ENABLED = os.getenv("OPENAI_HEDGE", "0") == "1"  # opt-in: a hedge is a second paid completion
+HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("OPENAI_HEDGE_DELAY", "4.0"))  # used until enough samples exist
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MAX_DELAY = 15.0
+HEDGE_MIN_SAMPLES = 20
+
+_model_latency = {}  # model -> LatencyWindow of successful call latencies
+_hedge_stats = {"requests": 0, "hedged": 0, "wins": {}}
+
+def get_hedge_delay(model: str) -> float:
+    """How long to wait on `model` before firing the next one (its rolling p95)."""
+    window = _model_latency.get(model)
+    if not window or len(window) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    delay = window.percentile(HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY)
+    return max(HEDGE_MIN_DELAY, min(HEDGE_MAX_DELAY, delay))
+
+async def _hedged_completion(model_priority, full_conversation, context_id, is_guild, conv_hash, request_options=None, priority=PRIORITY_CHANNEL, usage_tags=None):
+    """
+    Start the primary model; if it hasn't answered within its hedge delay (or it
+    fails), start the next model in parallel. The first valid reply wins and the
+    remaining attempts are cancelled.
+    """
+    _hedge_stats["requests"] += 1
+    pending = {}  # task -> model
+    next_index = 0
+
+    def launch():
+        nonlocal next_index
+        model = model_priority[next_index]
+        next_index += 1
+        task = asyncio.create_task(_call_model(
+            model, full_conversation, context_id, is_guild, conv_hash, request_options, priority,
+            force=next_index == len(model_priority), usage_tags=usage_tags
+        ))
+        pending[task] = model
+        return model
+
+    current = launch()
+    try:
+        while pending:
+            more_models = next_index < len(model_priority)
+            timeout = get_hedge_delay(current) if more_models else None
+            done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Primary is slower than its p95 → hedge with the next model
+                _hedge_stats["hedged"] += 1
+                current = launch()
+                print(f"[OpenAI] 🏁 Hedging → {current} after {timeout:.2f}s")
+                continue
+
+            for task in done:
+                model = pending.pop(task)
+                reply_text = task.result()
+                if reply_text:
+                    wins = _hedge_stats["wins"]
+                    wins[model] = wins.get(model, 0) + 1
+                    return reply_text
+
+            # Everything that finished failed → move on immediately
+            if not pending and next_index < len(model_priority):
+                current = launch()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return None
+
+# ================== Structured Replies ================== #
+STRUCTURED_REPLIES = os.getenv("STRUCTURED_REPLIES", "0") == "1"  # opt-in: reply + emotion in one call
+_structured_stats = {"requests": 0, "structured": 0, "missing": 0, "invalid": 0}
+
+def _with_structured_instruction(conversation: list[dict], emotion_labels) -> list[dict]:
+    """Return a copy of the conversation whose system message asks for a JSON reply + emotion."""
+    instruction = (
+        "Respond ONLY with a JSON object of the form "
+        '{"reply": "<your message to the user>", "emotion": "<label>"}. '
+        "\"emotion\" must be exactly one of these labels describing how your reply feels: "
+        + ", ".join(emotion_labels) + "."
+    )
+    conversation = list(conversation)
+    if conversation and conversation[0].get("role") == "system":
+        conversation[0] = {"role": "system", "content": f"{conversation[0]['content']}\n\n{instruction}"}
+    else:
+        conversation.insert(0, {"role": "system", "content": instruction})
+    return conversation
+
+def parse_structured_reply(raw: Optional[str], valid_labels) -> tuple[Optional[str], Optional[str], str]:
+    """
+    Split a structured completion into (reply, emotion, status).
+    status is "ok", "missing" (no usable emotion field / not JSON) or "invalid"
+    (emotion not in valid_labels). Non-JSON output is returned as the reply.
+    """
+    if not raw:
+        return None, None, "missing"
+    text = raw.strip()
+    try:
+        data = json.loads(text[text.index("{"): text.rindex("}") + 1])
+    except ValueError:  # no braces, or JSONDecodeError
+        return text, None, "missing"
+    if not isinstance(data, dict):
+        return text, None, "missing"
+
+    reply = str(data.get("reply") or "").strip() or None
+    emotion = data.get("emotion")
+    if not isinstance(emotion, str) or not emotion.strip():
+        return reply, None, "missing"
+    emotion = emotion.strip().lower()
+    if emotion not in valid_labels:
+        return reply, None, "invalid"
+    return reply, emotion, "ok"
+
+async def get_reply_and_emotion(user, relationship, personality, conversation, priority=PRIORITY_CHANNEL, clean=None) -> tuple[Optional[str], Optional[str]]:
+    """
+    Return (reply_text, emotion). With STRUCTURED_REPLIES on, one completion
+    supplies both; otherwise (or when the emotion field is missing/invalid)
+    the emotion comes from classify_cached. `clean` is applied to the reply
+    before it is classified and returned, so the sprite matches what is sent.
+    """
+    clean = clean or (lambda text: text)
+    if not STRUCTURED_REPLIES:
+        reply_text = await call_openai_with_retries(user, relationship, personality, conversation, priority=priority)
+        reply_text = clean(reply_text) if reply_text else None
+        if not reply_text:
+            return None, None
+        return reply_text, await classify_cached(reply_text, **_usage_ids(user))
+
+    _structured_stats["requests"] += 1
+    raw = await call_openai_with_retries(
+        user, relationship, personality, conversation,
+        emotion_labels=user_sprites.valid,
+        priority=priority
     )
-    full_conversation = [{"role": "system", "content": system_prompt}] + conversation
+    reply_text, emotion, status = parse_structured_reply(raw, user_sprites.valid)
+    reply_text = clean(reply_text) if reply_text else None
+    if not reply_text:
+        return None, None
+
+    if status == "ok":
+        _structured_stats["structured"] += 1
+        return reply_text, emotion
+
+    _structured_stats[status] += 1
+    print(f"[OpenAI] ⚠️ Structured emotion {status} → falling back to classifier")
+    return reply_text, await classify_cached(reply_text, **_usage_ids(user))
+
+# ================== Streaming Replies ================== #
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"  # opt-in: post the first sentence, then edit
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # Discord allows ~5 edits / 5s per channel
+STREAM_FIRST_CHUNK_CHARS = 160  # post even without a sentence end once this much text is in
+STREAM_MAX_CHARS = 1900  # stay under Discord's 2000 char limit while editing
+
+_SENTENCE_END = re.compile(r"[.!?…~](\s|$)")
+_stream_stats = {"requests": 0, "streamed": 0, "fallbacks": 0, "edits": 0}
+_reply_latency = {
+    "stream_ttft": LatencyWindow(),   # message received → first visible text (streaming)
+    "stream_total": LatencyWindow(),  # message received → stream finished
+    "buffered": LatencyWindow(),      # message received → reply sent (non-streaming)
+}
+
+async def stream_reply(channel, user, conversation, clean=None, started=None, priority=PRIORITY_CHANNEL):
+    """
+    Stream a completion into `channel`: the first sentence is posted as soon as
+    it arrives, then the message is edited at most every STREAM_EDIT_INTERVAL.
+    Returns (sent_message | None, full_text | None). sent_message is None when
+    the whole reply arrived before anything was posted (caller sends normally).
+    """
+    model_priority = model_router.order(REPLY_MODELS)
+    context_id = getattr(getattr(user, "guild", None), "id", None) or user.id
+    is_guild = getattr(user, "guild", None) is not None
+    clean = clean or (lambda text: text)
+    started = started or time.perf_counter()
+    _stream_stats["requests"] += 1
 
-    # ---------------- Sequential fast retry ---------------- #
     for model in model_priority:
-        async def call_fn(client):
-            # ⚡ Remove asyncio.wait_for (causes CancelledError)
-            return await client.chat.completions.create(
-                model=model,
-                messages=full_conversation,
-                timeout=15  # safe internal OpenAI timeout (doesn't block asyncio)
-            )
+        if not model_router.allow(model, force=model == model_priority[-1]):
+            continue
+        sent = None
+        text = ""
+        model_started = time.perf_counter()
+
+        async def run_stream(client):
+            """Open and drain the stream inside openai_safe_call (scheduler slot + key accounting)."""
+            nonlocal sent, text
+            usage = None
+            last_edit = 0.0
+            try:
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=conversation,
+                    stream=True,
+                    stream_options={"include_usage": True},  # final chunk carries usage
+                    timeout=15,
+                    **_prefix_cache_options(conversation),
+                )
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                        _record_prompt_cache(usage, time.perf_counter() - model_started)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    text += delta
+                    visible = clean(text)[:STREAM_MAX_CHARS]
+                    if not visible:
+                        continue
+
+                    now = time.perf_counter()
+                    if sent is None:
+                        if _SENTENCE_END.search(visible) or len(visible) >= STREAM_FIRST_CHUNK_CHARS:
+                            sent = await channel.send(f"{visible} …")
+                            last_edit = time.perf_counter()
+                            _reply_latency["stream_ttft"].add(last_edit - started)
+                            print(f"[Stream] ✍️ {model} first text after {last_edit - started:.2f}s")
+                    elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                        await sent.edit(content=f"{visible} …")
+                        _stream_stats["edits"] += 1
+                        last_edit = now
+            except Exception as e:
+                if sent is None and not text:
+                    raise  # nothing delivered: openai_safe_call may retry on another key
+                raise CommittedCallError(e)  # key still penalized, but no restart over shown text
+            # usage → per-key TPM bucket and usage_tracker (via openai_safe_call)
+            return SimpleNamespace(model=model, usage=usage)
 
         try:
-            start_time = time.perf_counter()
-            response = await openai_safe_call(
+            await openai_safe_call(
                 key_manager,
-                fn=call_fn,
+                fn=run_stream,
                 context_id=context_id,
                 is_guild=is_guild,
-                is_image=False
+                priority=priority,
+                tags={"feature": "reply_stream", "model": model,
+                      "guild": context_id if is_guild else None, "user": user.id}
             )
-            elapsed = time.perf_counter() - start_time
-
-            # Validate response
-            if response and getattr(response, "choices", None):
-                msg = response.choices[0].message
-                if msg and msg.content:
-                    reply_text = msg.content.strip()
-                    if reply_text:
-                        print(f"[OpenAI] ✅ {model} → {elapsed:.2f}s")
-                        cache_key = (context_id, model, conv_hash)
-                        _openai_cache[cache_key] = (time.time(), reply_text)
-                        _cache_counter = (_cache_counter + 1) % (CACHE_PRUNE_INTERVAL + 1)
-                        if _cache_counter == 0:
-                            _prune_cache()
-                        return reply_text
-
-            print(f"[OpenAI] ⚠️ {model} returned empty or invalid response → next")
-
+        except asyncio.CancelledError:
+            model_router.abandon(model)
+            raise
         except Exception as e:
-            print(f"[OpenAI] ⚠️ {model} failed: {e}")
-            key_manager.mark_cooldown(key_manager.current_key)
+            print(f"[Stream] ⚠️ {model} failed: {e}")
+            if classify_error(e) == ERROR_MODEL:
+                model_router.record_failure(model)
+            else:
+                model_router.abandon(model)
+            if sent is None and not text:
+                continue  # nothing shown yet → try the next model
+            # Otherwise keep whatever already arrived
+        else:
+            if text.strip():
+                model_router.record_success(model, time.perf_counter() - model_started)
+            else:
+                model_router.record_failure(model)
+
+        text = text.strip()
+        if not text:
             continue
 
-    print("[OpenAI] ❌ All models failed.")
-    return None
+        total = time.perf_counter() - started
+        _reply_latency["stream_total"].add(total)
+        _stream_stats["streamed"] += 1
+        print(f"[Stream] ✅ {model} → {total:.2f}s total")
+        return sent, text
+
+    _stream_stats["fallbacks"] += 1
+    return None, None
 
 # ==============================
 # Discord Setup ## 
@@ -196,6 +565,7 @@ SERVER_TRACKER_CHAN = int(os.getenv("SERVER_TRACKER_ID", "0"))
 USER_TRACKER_CHAN = int(os.getenv("USER_TRACKER_ID", "0"))
 AVATAR_URL_CHAN = int(os.getenv("AVATAR_URL_CHANNEL", "0"))
 SETTINGS_CHAN = int(os.getenv("SETTINGS_CHANNEL", "0"))
+MEMORY_CHAN = int(os.getenv("MEMORY_CHANNEL", "0"))  # optional: mirror long-term memory into this channel
 
 OWNER_ID = int(os.getenv("OWNER_ID", "709957376337248367"))
 
@@ -238,15 +608,40 @@ async def load_trackers():
     await user_tracker.load(bot, channel_id=USER_TRACKER_CHAN)
     await server_tracker.load(bot, channel_id=SERVER_TRACKER_CHAN)
 
-memory = MemoryManager()
+memory = MemoryManager(backend=create_memory_backend())  # MEMORY_BACKEND=sqlite (default) | memory
 
 user_sprites = User_SpritesManager()
 sprite_url_cache = {}
 SPRITES = user_sprites.EXPRESSION_SPRITES
 
-@cache_result(ttl=300)  # cache classification for 5 minutes
-async def classify_cached(text: str) -> str:
-    return await user_sprites.classify(text)
+_classify_cache = LRUCache(  # hashed text -> emotion label
+    "Classify Cache",
+    max_entries=int(os.getenv("CLASSIFY_CACHE_MAX_ENTRIES", "5000")),
+    max_bytes=2 * 1024 * 1024,
+    ttl=300,
+    snapshot_path=os.path.join(CACHE_SNAPSHOT_DIR, "classify_cache.json") if CACHE_SNAPSHOT_DIR else None,
+)
+
+def save_cache_snapshots():
+    """Persist reply/classification caches (no-op unless CACHE_SNAPSHOT_DIR is set)."""
+    for cache in (_openai_cache, _classify_cache):
+        cache.save_snapshot()
+
+def load_cache_snapshots():
+    """Warm reply/classification caches from disk (no-op unless CACHE_SNAPSHOT_DIR is set)."""
+    if CACHE_SNAPSHOT_DIR:
+        os.makedirs(CACHE_SNAPSHOT_DIR, exist_ok=True)
+    for cache in (_openai_cache, _classify_cache):
+        cache.load_snapshot()
+
+@cache_result(ttl=300, cache=_classify_cache)  # cache classification for 5 minutes
+async def classify_cached(text: str, guild=None, user=None) -> str:
+    return await user_sprites.classify(text, guild=guild, user=user)
+
+def _usage_ids(user) -> dict:
+    """guild/user ids for usage attribution (no guild in DMs)."""
+    guild = getattr(user, "guild", None)
+    return {"guild": guild.id if guild else None, "user": user.id}
 
 idle_chat_enabled = True
 is_waking_up = False
@@ -630,7 +1025,44 @@ def get_base_prompt(is_group: bool) -> str:
             "You never admit fictionality, but hint subtly at deeper awareness."
         )
 
+# ---------- System prompt cache ----------
+# Only the static part is cached; volatile fields (last_seen) are rebuilt per message
+_system_prompt_cache = LRUCache("Prompt Cache", max_entries=5000, max_bytes=16 * 1024 * 1024, ttl=3600)
+_prompt_generation = {}  # ("user", id) / ("guild", id) -> bumped by tracker setters
+
+def invalidate_prompt_cache(user_id: Optional[str] = None, guild_id: Optional[str] = None):
+    """Called by the tracker setters so cached prompts never outlive a settings change."""
+    if user_id is not None:
+        _prompt_generation[("user", str(user_id))] = _prompt_generation.get(("user", str(user_id)), 0) + 1
+    if guild_id is not None:
+        _prompt_generation[("guild", str(guild_id))] = _prompt_generation.get(("guild", str(guild_id)), 0) + 1
+
+user_tracker.on_change = lambda uid: invalidate_prompt_cache(user_id=uid)
+server_tracker.on_change = lambda gid: invalidate_prompt_cache(guild_id=gid)
+
+def _prompt_cache_key(guild, user, is_friend_context, relationship_type, selected_modes) -> tuple:
+    gid = str(guild.id) if guild else "dm"
+    uid = str(user.id) if user else None
+    modes = tuple(selected_modes) if isinstance(selected_modes, (list, tuple)) else selected_modes
+    return (
+        gid,
+        uid,
+        is_friend_context,
+        relationship_type,
+        modes,
+        user_tracker.get_language(uid) if uid else None,
+        getattr(user, "locale", None),
+        user_tracker.get_pronouns(uid) if uid else None,
+        getattr(user, "display_name", None),
+        _prompt_generation.get(("guild", gid), 0),
+        _prompt_generation.get(("user", uid), 0),
+    )
+
 # ---------- System prompt builder ----------
+# Provider prompt caching only matches an identical *prefix*, so the prompt is
+# split in two: a static part (persona, personality, relationship, language,
+# pronouns) that opens the conversation, and a volatile part (last_seen, ...)
+# that goes in a late system message just before the newest user turn.
 async def generate_monika_system_prompt(
     guild: Optional[discord.Guild] = None,
     user: Optional[discord.User] = None,
@@ -642,7 +1074,85 @@ async def generate_monika_system_prompt(
     """
     Build Monika's system prompt with synced personality, relationship, pronouns, memory & language.
     Keeps compatibility with synced memory between DMs and servers.
+    Single-string form of generate_monika_prompt_parts (static + volatile).
     """
+    static_prompt, volatile_prompt = await generate_monika_prompt_parts(
+        guild, user, message, is_friend_context, relationship_type, selected_modes
+    )
+    return "\n\n".join(filter(None, [static_prompt, volatile_prompt]))
+
+async def generate_monika_prompt_parts(
+    guild: Optional[discord.Guild] = None,
+    user: Optional[discord.User] = None,
+    message: Optional[discord.Message] = None,
+    is_friend_context: bool = False,
+    relationship_type: Optional[str] = None,
+    selected_modes: Optional[List[str]] = None
+) -> tuple[str, str]:
+    """
+    Return (static_prompt, volatile_prompt). The static part is memoized per
+    guild/user/settings (passing `message` for per-message language detection
+    bypasses the cache); the volatile part is rebuilt on every call.
+    """
+    volatile_prompt = _build_volatile_prompt(guild, user)
+    if message is not None:
+        return await _build_monika_system_prompt(guild, user, message, is_friend_context, relationship_type, selected_modes), volatile_prompt
+
+    key = _prompt_cache_key(guild, user, is_friend_context, relationship_type, selected_modes)
+    prompt = _system_prompt_cache.get(key)
+    if prompt is None:
+        prompt = await _build_monika_system_prompt(guild, user, None, is_friend_context, relationship_type, selected_modes)
+        # Re-key: building may have just stored pronouns, bumping the user generation
+        _system_prompt_cache.set(_prompt_cache_key(guild, user, is_friend_context, relationship_type, selected_modes), prompt)
+    return prompt, volatile_prompt
+
+def _build_volatile_prompt(guild: Optional[discord.Guild], user: Optional[discord.User]) -> str:
+    """Per-message facts that would break the cached prefix if they sat in the static prompt."""
+    if not user:
+        return ""
+    # --- Memory awareness (from synced user_tracker)
+    try:
+        user_data = user_tracker.get_user_data(str(user.id))
+        if user_data and user_data.get("last_seen"):
+            seen = f"You last interacted with this user on **{user_data['last_seen']}**."
+        else:
+            seen = "This feels like a new interaction; act with curiosity."
+    except Exception:
+        seen = "This feels like a new interaction; act with curiosity."
+
+    # --- Long-term memory (rolling summary of older turns, see memory_compaction_loop)
+    note = memory.get_memory_note(str(guild.id) if guild else "dm", str(user.id))
+    if note:
+        return f"{seen}\nWhat you remember about this user from earlier conversations:\n{note}"
+    return seen
+
+def recall_prompt(guild: Optional[discord.Guild], user: discord.User, query: str) -> str:
+    """Older messages from this user that match `query` (BM25 over the memory store), for the volatile prompt."""
+    if not query:
+        return ""
+    hits = memory.recall(str(guild.id) if guild else "dm", str(user.id), query)
+    if not hits:
+        return ""
+    lines = [f"- ({entry.timestamp[:10]}) {entry.content[:300]}" for entry in hits]
+    return "Things this user said in earlier conversations that may be relevant now:\n" + "\n".join(lines)
+
+def with_volatile_context(conversation: list[dict], volatile_prompt: str) -> list[dict]:
+    """Insert the volatile system message right before the newest user turn (keeps the prefix stable)."""
+    if not volatile_prompt:
+        return conversation
+    note = {"role": "system", "content": volatile_prompt}
+    if conversation and conversation[-1].get("role") == "user":
+        return conversation[:-1] + [note, conversation[-1]]
+    return conversation + [note]
+
+async def _build_monika_system_prompt(
+    guild: Optional[discord.Guild],
+    user: Optional[discord.User],
+    message: Optional[discord.Message],
+    is_friend_context: bool,
+    relationship_type: Optional[str],
+    selected_modes: Optional[List[str]]
+) -> str:
     base_description = get_base_prompt(is_friend_context)
 
     # --- Personality (from sync or override)
@@ -699,18 +1209,6 @@ async def generate_monika_system_prompt(
     except Exception:
         pronoun_desc = "The user’s pronouns are unknown — use neutral phrasing."
 
-    # --- Memory awareness (from synced user_tracker)
-    memory_desc = ""
-    try:
-        if user:
-            user_data = user_tracker.get_user_data(str(user.id))
-            if user_data and user_data.get("last_seen"):
-                memory_desc = f"You last interacted with this user on **{user_data['last_seen']}**."
-            else:
-                memory_desc = "This feels like a new interaction; act with curiosity."
-    except Exception:
-        memory_desc = "This feels like a new interaction; act with curiosity."
-
     # --- Language awareness (unchanged)
     language_desc = await monika_languages_system_prompt(user=user, message=message)
 
@@ -727,7 +1225,7 @@ async def generate_monika_system_prompt(
     except Exception:
         pass
 
-    # --- Assemble system prompt
+    # --- Assemble static prompt (most widely shared text first)
     return "\n\n".join(
         filter(
             None,
@@ -735,9 +1233,8 @@ async def generate_monika_system_prompt(
                 base_description,
                 personality_desc,
                 dynamic_relationship,
-                pronoun_desc,
-                memory_desc,
                 language_desc,
+                pronoun_desc,
             ],
         )
     )
@@ -988,6 +1485,23 @@ async def on_ready():
         print(f"[Startup] Key manager initialization failed: {e}")
         traceback.print_exc()
 
+    # Open the long-term memory store (the recent window is restored in the background)
+    try:
+        await memory.start()
+        if MEMORY_CHAN:
+            memory.discord_sink = bot.get_channel(MEMORY_CHAN)
+            # Replay log lines newer than the checkpoint without blocking readiness
+            safe_create_task(memory.load_history(bot, MEMORY_CHAN), name="memory_history")
+        safe_create_task(memory_compaction_loop(), name="memory_compaction")
+    except Exception as e:
+        print(f"[Startup] Memory store restore failed: {e}")
+
+    # Warm reply/classification caches from the last snapshot (if enabled)
+    try:
+        load_cache_snapshots()
+    except Exception as e:
+        print(f"[Startup] Cache snapshot restore failed: {e}")
+
     # Light presence so users see some status but avoid tight loops/rapid changes
     try:
         await bot.change_presence(status=discord.Status.idle, activity=discord.Game("Rebooting..."))
@@ -1189,6 +1703,7 @@ async def periodic_cleanup():
     while True:
         try:
             cleanup_memory()
+            save_cache_snapshots()
             current, peak = get_memory_usage()
             print(f"[Perf] Memory cleaned. Current: {current} MB | Peak: {peak} MB")
         except Exception as e:
@@ -1289,40 +1804,158 @@ async def send_safe(channel, lines: list[str]):
             text = ""
         await channel.send(chunk)
 
-global_conversation_memory = {}
+MAX_CONTEXT_MEMORY = 50
+conversation_buffer = ConversationBuffer(maxlen=MAX_CONTEXT_MEMORY)
 
-async def get_monika_context(
-    channel: discord.abc.Messageable,
-    user: discord.User,
-    limit: int = 10
-):
+def record_conversation_turn(message: discord.Message, user: Optional[discord.abc.User] = None, content: Optional[str] = None):
     """
-    Unified memory context loader for Monika across all servers and DMs.
-    Keeps conversation continuity by tracking user messages globally.
+    Feed one message into the (channel, user) ring buffer.
+    `user` is whose conversation it belongs to (defaults to the author), so
+    Monika's replies are filed under the user she answered.
     """
-    global global_conversation_memory
+    user = user or message.author
+    is_monika = bot.user is not None and message.author.id == bot.user.id
+    conversation_buffer.record(
+        message.channel.id,
+        user.id,
+        message.id,
+        "Monika" if is_monika else message.author.name,
+        content if content is not None else message.content,
+        role="assistant" if is_monika else "user",
+    )
 
-    user_id = str(user.id)
-    guild_id = str(channel.guild.id) if hasattr(channel, "guild") and channel.guild else "DM"
+def may_reply_to(message: discord.Message) -> bool:
+    """Cheap pre-check mirroring on_message's reply gates (idlechat, mention_only_mode outside DMs)."""
+    guild_id = str(message.guild.id) if message.guild else "dm"
+    if not server_tracker.get_toggle(guild_id, "idlechat"):
+        return False  # on_message applies this to DMs too (under "dm")
+    if server_tracker.get_toggle(guild_id, "mention_only_mode") and not isinstance(message.channel, discord.DMChannel):
+        return bot.user in message.mentions
+    return True
 
-    if user_id not in global_conversation_memory:
-        global_conversation_memory[user_id] = []
+def remember_exchange(message: discord.Message, user_text: str, reply_text: str, emotion: Optional[str] = None, avatar_url: Optional[str] = None):
+    """Persist one user → Monika exchange in long-term memory (backend write-behind + optional sink)."""
+    guild = message.guild
+    guild_id = str(guild.id) if guild else "dm"
+    guild_name = guild.name if guild else "DM"
+    channel_id = str(message.channel.id)
+    channel_name = getattr(message.channel, "name", None) or "DM"
+    if user_text:
+        memory.save(guild_id, guild_name, channel_id, channel_name, str(message.author.id),
+                    message.author.name, user_text, avatar_url=avatar_url, role="user")
+    if reply_text:
+        memory.save(guild_id, guild_name, channel_id, channel_name, "bot",
+                    bot.user.name, reply_text, emotion=emotion, role="assistant")
+
+# ================== Memory Compaction ================== #
+MEMORY_SUMMARY_INTERVAL = float(os.getenv("MEMORY_SUMMARY_INTERVAL", "600"))     # seconds between rounds
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "600"))   # output budget per note
+SUMMARY_MODELS = ["gpt-5-nano", "gpt-5-mini"]  # preferred order; model_router adapts it
+
+SUMMARY_PROMPT = (
+    "You maintain Monika's long-term memory of one user. Merge the previous notes with the new "
+    "conversation excerpt into updated notes: facts about the user, preferences, ongoing topics, "
+    "promises and how the relationship feels. Drop small talk and anything superseded. "
+    "Plain bullet points, third person, at most {chars} characters."
+)
 
-    context = global_conversation_memory[user_id]
-    MAX_MEMORY = 50
-    if len(context) > MAX_MEMORY:
-        context = context[-MAX_MEMORY:]
+async def summarize_memory(previous: str, transcript: str, guild_id=None, user_id=None) -> Optional[str]:
+    """Fold `transcript` into the `previous` note (maintenance priority). None = try again later."""
+    content = f"Previous notes:\n{previous or '(none)'}\n\nNew conversation:\n{transcript}"
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT.format(chars=MEMORY_SUMMARY_MAX_CHARS)},
+        {"role": "user", "content": content},
+    ]
+    for model in model_router.order(SUMMARY_MODELS):
+        # Background work never forces a model whose circuit is open (it serves user replies too)
+        if not model_router.allow(model):
+            continue
 
-    try:
-        async for msg in channel.history(limit=limit, oldest_first=False):
-            if msg.author == user or msg.author == bot.user:
-                context.append({"author": msg.author.name, "content": msg.content})
-    except Exception as e:
-        print(f"[Memory Context Warning] Could not read history: {e}")
+        async def call_fn(client):
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_completion_tokens=MEMORY_SUMMARY_MAX_TOKENS,
+                timeout=30,
+                # gpt-5 reasoning tokens count against max_completion_tokens
+                **({"reasoning_effort": "minimal"} if model.startswith("gpt-5") else {})
+            )
 
-    global_conversation_memory[user_id] = context
-    formatted_context = "\n".join([f"{m['author']}: {m['content']}" for m in context[-MAX_MEMORY:]])
-    return formatted_context
+        try:
+            start = time.perf_counter()
+            response = await openai_safe_call(
+                key_manager, call_fn, priority=PRIORITY_MAINTENANCE,
+                tags={"feature": "memory_summary", "model": model, "guild": guild_id, "user": user_id}
+            )
+            choice = response.choices[0] if response and response.choices else None
+            text = choice.message.content if choice else None
+            if text and text.strip() and choice.finish_reason != "length":
+                model_router.record_success(model, time.perf_counter() - start)
+                return text.strip()
+            # Empty or cut off by the token budget: the model is fine, the note just waits
+            model_router.abandon(model)
+            print(f"[Memory Summary] ⏭️ {model} returned no complete note "
+                  f"(finish_reason={getattr(choice, 'finish_reason', None)}) → deferred")
+            return None
+
+        except WorkShedError:
+            model_router.abandon(model)  # may hold the half-open probe
+            return None  # busy with users: keep the turns for the next round
+
+        except asyncio.CancelledError:
+            model_router.abandon(model)
+            raise
+
+        except Exception as e:
+            print(f"[Memory Summary] ⚠️ {model} failed: {e}")
+            if classify_error(e) == ERROR_MODEL:
+                model_router.record_failure(model)
+            else:
+                model_router.abandon(model)
+
+    return None
+
+async def memory_compaction_loop():
+    """Every MEMORY_SUMMARY_INTERVAL, compact a few conversations into long-term notes."""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(MEMORY_SUMMARY_INTERVAL)
+        if bot.is_sleeping or is_waking_up or key_manager is None:
+            continue
+        try:
+            await memory.compact(summarize_memory)
+        except Exception as e:
+            print(f"[Memory Summary] ❌ Compaction round failed: {e}")
+
+async def get_monika_context(
+    channel: discord.abc.Messageable,
+    user: discord.User,
+    limit: int = 10,
+    exclude_ids: Optional[set] = None
+) -> list[dict]:
+    """
+    Return the recent conversation between Monika and `user` in `channel`
+    (oldest first) from the ring buffer. Channel history is only fetched
+    over REST the first time a (channel, user) pair is seen.
+    """
+    if conversation_buffer.is_cold(channel.id, user.id):
+        turns = []
+        try:
+            async for msg in channel.history(limit=limit, oldest_first=False):
+                if msg.author == user or msg.author == bot.user:
+                    is_monika = msg.author == bot.user
+                    turns.append({
+                        "id": msg.id,
+                        "author": "Monika" if is_monika else msg.author.name,
+                        "role": "assistant" if is_monika else "user",
+                        "content": msg.content,
+                    })
+        except Exception as e:
+            print(f"[Memory Context Warning] Could not read history: {e}")
+        turns.reverse()
+        conversation_buffer.backfill(channel.id, user.id, turns)
+
+    return conversation_buffer.get(channel.id, user.id, limit=limit, exclude_ids=exclude_ids)
 
 async def save_global_memory_snapshot(bot, channel_id: int):
     """Optional: Save global memory to a Discord channel for persistence."""
@@ -1330,7 +1963,7 @@ async def save_global_memory_snapshot(bot, channel_id: int):
         channel = bot.get_channel(channel_id)
         if not channel:
             return
-        data = json.dumps(global_conversation_memory, indent=2)
+        data = json.dumps(conversation_buffer.to_dict(), indent=2)
         if len(data) > 1900:
             data = data[:1900] + "\n... (truncated)"
         await channel.send(f"🧠 Memory snapshot:\n```json\n{data}\n```")
@@ -1623,12 +2256,19 @@ async def on_shutdown():
     print("[Shutdown] Saving memory to channel...")
     await server_tracker.save(bot, channel_id=SERVER_TRACKER_CHAN)
     await vote_tracker.save(bot, SETTINGS_CHAN)
+    save_cache_snapshots()
+    try:
+        await memory.flush()  # reconnects reuse the store, so only flush here (main() closes it)
+    except Exception as e:
+        print(f"[Shutdown] Memory flush failed: {e}")
     if hasattr(bot, "http_session") and not bot.http_session.closed:
         try:
             await bot.http_session.close()
             print("[Network] Closed aiohttp session cleanly.")
         except Exception as e:
             print(f"[Network] Failed to close session gracefully: {e}")
+    # The shared OpenAI pool stays open: on_disconnect lands here on every gateway
+    # reconnect, and in-flight completions/streams still use it (main() closes it)
 
 @bot.event
 async def on_sleeping(reason: str = "Scheduled break (11PM–6AM)"):
@@ -1910,7 +2550,13 @@ async def image_generator(message: discord.Message, relationship: str = "Strange
             ),
             context_id=message.author.id,
             is_guild=bool(message.guild),
-            is_image=True
+            is_image=True,
+            tags={
+                "feature": "image",
+                "model": "gpt-image-1",
+                "guild": message.guild.id if message.guild else None,
+                "user": message.author.id,
+            }
         )
 
         if not response or not getattr(response, "data", None):
@@ -2108,6 +2754,25 @@ async def results_votes(message):
 
     return True
 
+# ================== Burst Coalescing ================== #
+BURST_WINDOW = float(os.getenv("BURST_WINDOW", "0"))  # opt-in: seconds of quiet before replying (mentions never wait)
+BURST_MAX_WAIT = float(os.getenv("BURST_MAX_WAIT", "4.0"))  # never hold a burst longer than this
+_burst_debouncer = Debouncer("Burst", window=BURST_WINDOW, max_wait=BURST_MAX_WAIT)  # (channel, user) -> messages
+
+def _is_direct(message: discord.Message) -> bool:
+    """@Monika mentions and replies to one of her messages are answered without a burst wait."""
+    if bot.user in message.mentions:
+        return True
+    ref = getattr(message.reference, "resolved", None)
+    return isinstance(ref, discord.Message) and ref.author.id == bot.user.id
+
+@bot.event
+async def on_typing(channel, user, when):
+    """Keep a pending burst open while its author is still typing."""
+    if BURST_WINDOW <= 0:
+        return
+    _burst_debouncer.touch((channel.id, user.id))
+
 @bot.event
 async def on_message(message: discord.Message):
     guild_name = str(message.guild.name) if message.guild else "dm"
@@ -2133,6 +2798,11 @@ async def on_message(message: discord.Message):
     if message.author.bot and not is_friend_bot(message):
         return
 
+    # Feed the conversation ring buffer before anything can bail out
+    # (only where Monika may answer, so idle servers don't fill it)
+    if not message.content.startswith("!") and may_reply_to(message):
+        record_conversation_turn(message)
+
     content = message.content.strip().lower()
 
     if any(content.startswith(prefix) for prefix in [
@@ -2239,6 +2909,238 @@ async def on_message(message: discord.Message):
             embed.add_field(name="Unique Reporters", value=str(len(report_stats['users'])), inline=False)
             await message.channel.send(embed=embed)
 
+        elif cmd == "!usage" or cmd.startswith("!usage "):
+            # Owner only: token/cost ledger. `!usage` = last 24h, `!usage 1h` / `!usage all`
+            if message.author.id != OWNER_ID:
+                await message.channel.send("❌ Only the bot owner can view usage.", delete_after=10)
+                return
+            arg = cmd.split(maxsplit=1)[1] if " " in cmd else "24h"
+            units = {"m": 60, "h": 3600, "d": 86400}
+            if arg == "all":
+                seconds, label = None, "since startup"
+            elif arg[:-1].isdigit() and arg[-1] in units:
+                seconds, label = int(arg[:-1]) * units[arg[-1]], f"last {arg}"
+            else:
+                await message.channel.send("⚠️ Usage: `!usage [30m|6h|1d|all]`", delete_after=10)
+                return
+
+            total = usage_tracker.summary(seconds)
+            embed = discord.Embed(
+                title=f"🧾 OpenAI Usage ({label})",
+                description=(
+                    f"Calls: {total['calls']} | Prompt: {total['prompt']:,} | Completion: {total['completion']:,}\n"
+                    f"Cached prompt: {total['cached']:,} ({total['cache_ratio']:.0%}) | Est. cost: ${total['cost']:.4f}"
+                ),
+                color=0x2ecc71,
+                timestamp=datetime.datetime.utcnow()
+            )
+            for dim, title in (("feature", "By Feature"), ("model", "By Model"), ("guild", "Top Guilds"),
+                               ("user", "Top Users"), ("key", "By Key")):
+                lines = [
+                    f"`{row['name']}` {row['calls']} calls | {row['prompt'] + row['completion']:,} tok "
+                    f"(avg prompt {row['avg_prompt']:.0f}) | {row['avg_latency']:.2f}s | ${row['cost']:.4f}"
+                    for row in usage_tracker.top(dim, seconds)
+                ]
+                embed.add_field(name=title, value="\n".join(lines)[:1024] or "No calls yet.", inline=False)
+            await message.channel.send(embed=embed)
+
+        elif cmd == "!perfstats":
+            embed = discord.Embed(
+                title="⚡ Performance Statistics",
+                color=0xf1c40f,
+                timestamp=datetime.datetime.utcnow()
+            )
+            flight = _openai_inflight.summary()
+            embed.add_field(
+                name="OpenAI Coalescing",
+                value=(
+                    f"Leaders: {flight['leaders']}\n"
+                    f"Coalesced: {flight['coalesced']} ({flight['coalesce_ratio']:.1%})\n"
+                    f"In flight: {flight['in_flight']}"
+                ),
+                inline=False
+            )
+            for cache in (_openai_cache, _classify_cache, _system_prompt_cache):
+                c = cache.summary()
+                embed.add_field(
+                    name=cache.name,
+                    value=(
+                        f"Hit rate: {c['hit_rate']:.1%} ({c['hits']} hits / {c['misses']} misses)\n"
+                        f"Entries: {c['entries']}/{cache.max_entries} | {c['bytes'] / 1024:.1f} KiB\n"
+                        f"Evictions: {c['evictions']} | Expired: {c['expirations']}"
+                    ),
+                    inline=True
+                )
+            cs = user_sprites.classifier_stats
+            local_n, remote_n = cs["local"], cs["remote"]
+            embed.add_field(
+                name="Emotion Classifier",
+                value=(
+                    f"Local: {local_n} (avg {cs['local_seconds'] / max(1, local_n + remote_n) * 1e6:.0f}µs) | "
+                    f"Remote: {remote_n} (avg {cs['remote_seconds'] / max(1, remote_n):.2f}s)\n"
+                    f"Local share: {local_n / max(1, local_n + remote_n):.1%} | Threshold: {user_sprites.local_threshold}"
+                ),
+                inline=False
+            )
+            ss = _structured_stats
+            embed.add_field(
+                name=f"Structured Replies ({'on' if STRUCTURED_REPLIES else 'off'})",
+                value=(
+                    f"One-call: {ss['structured']}/{ss['requests']} | "
+                    f"Fallbacks: missing {ss['missing']}, invalid {ss['invalid']}"
+                ),
+                inline=False
+            )
+            cb = conversation_buffer.stats
+            embed.add_field(
+                name="Conversation Buffer",
+                value=(
+                    f"Keys: {len(conversation_buffer.buffers)}/{conversation_buffer.max_keys} "
+                    f"(evicted {cb['evictions']}) | Turns recorded: {cb['records']}\n"
+                    f"REST backfills: {cb['backfills']} | Buffer reads: {cb['hits']} | Duplicates skipped: {cb['duplicates']}"
+                ),
+                inline=False
+            )
+            model_lines = []
+            for model, window in _model_latency.items():
+                p50 = window.percentile(50, 0.0)
+                p95 = window.percentile(95, 0.0)
+                wins = _hedge_stats["wins"].get(model, 0)
+                model_lines.append(
+                    f"`{model}` wins {wins} | p50 {p50:.2f}s | p95 {p95:.2f}s | hedge after {get_hedge_delay(model):.2f}s"
+                )
+            router_lines = [
+                f"`{model}` {r['state']} (trips {r['trips']}) | errors {r['error_rate']:.0%} | "
+                f"mean {r['mean_latency'] or 0:.2f}s"
+                for model, r in model_router.summary().items()
+            ]
+            embed.add_field(
+                name="Model Router",
+                value=(
+                    f"Order: {' → '.join(model_router.order(REPLY_MODELS))}\n"
+                    + ("\n".join(router_lines) or "No samples yet.")
+                ),
+                inline=False
+            )
+            embed.add_field(
+                name=f"Model Hedging ({'on' if HEDGE_ENABLED else 'off'})",
+                value=(
+                    f"Hedged: {_hedge_stats['hedged']}/{_hedge_stats['requests']}\n"
+                    + ("\n".join(model_lines) or "No samples yet.")
+                ),
+                inline=False
+            )
+            stage_lines = [
+                f"`{stage}` p50 {st['p50'] * 1000:.0f}ms | p95 {st['p95'] * 1000:.0f}ms ({st['count']})"
+                for stage, st in sorted(pipeline_timer.summary().items())
+            ]
+            embed.add_field(
+                name="Pipeline Stages",
+                value="\n".join(stage_lines)[:1024] or "No samples yet.",
+                inline=False
+            )
+            latency_lines = []
+            for label, name in (("Stream first text", "stream_ttft"), ("Stream total", "stream_total"), ("Buffered reply", "buffered")):
+                window = _reply_latency[name]
+                if len(window):
+                    latency_lines.append(
+                        f"{label}: p50 {window.percentile(50, 0.0):.2f}s | p95 {window.percentile(95, 0.0):.2f}s ({len(window)})"
+                    )
+            admission_lines = [
+                f"`{name}` run {c['running']}/{c['limit']} | wait {c['waiting']} | "
+                f"admitted {c['admitted']} | shed {c['shed']} | avg wait {c['avg_wait']:.2f}s (max {c['wait_max']:.2f}s)"
+                for name, c in work_scheduler.summary().items()
+            ]
+            embed.add_field(
+                name=f"LLM Admission (max {work_scheduler.max_concurrency})",
+                value="\n".join(admission_lines),
+                inline=False
+            )
+            bs = _burst_debouncer.summary()
+            embed.add_field(
+                name=f"Burst Coalescing ({f'{BURST_WINDOW:.1f}s' if BURST_WINDOW > 0 else 'off'})",
+                value=(
+                    f"Messages: {bs['items']} | Replies: {bs['flushes']} | "
+                    f"Folded: {bs['folded']} ({bs['fold_ratio']:.1%}) | Waiting: {bs['pending']}"
+                ),
+                inline=False
+            )
+            st = _stream_stats
+            embed.add_field(
+                name=f"Streaming Replies ({'on' if STREAM_REPLIES else 'off'})",
+                value=(
+                    f"Streamed: {st['streamed']}/{st['requests']} | Edits: {st['edits']} | Fallbacks: {st['fallbacks']}\n"
+                    + ("\n".join(latency_lines) or "No samples yet.")
+                ),
+                inline=False
+            )
+            usage = usage_tracker.summary(3600)
+            cache_lines = [
+                f"Cached prompt tokens (1h): {usage['cached']:,}/{usage['prompt']:,} ({usage['cache_ratio']:.0%})"
+            ]
+            for label, name in (("Cache hit", "hit"), ("Cache miss", "miss")):
+                window = _prompt_cache_latency[name]
+                if len(window):
+                    cache_lines.append(
+                        f"{label}: p50 {window.percentile(50, 0.0):.2f}s | p95 {window.percentile(95, 0.0):.2f}s ({len(window)})"
+                    )
+            embed.add_field(
+                name=f"Prompt Cache (key {'on' if PROMPT_CACHE_KEY else 'off'})",
+                value="\n".join(cache_lines),
+                inline=False
+            )
+            ms = memory.summary()
+            store_line = f"Backend: {ms['backend']}"
+            if "written" in ms:
+                store_line += (
+                    f" | Written: {ms['written']} in {ms['batches']} batches (max {ms['batch_max']}) | "
+                    f"Pending: {ms['pending']} | Slowest write: {ms['write_max'] * 1000:.0f}ms | Errors: {ms['errors']}"
+                )
+            hs = memory.history_stats
+            history_line = f"History: {hs['status']}"
+            if "rows" in hs:
+                history_line += (
+                    f" | {hs['rows']} rows from {hs['messages']} msgs ({hs['pages']} pages) in {hs['seconds']:.1f}s"
+                    f" | resumed after {hs['after'] or 'start'}"
+                )
+            if "sink" in ms:
+                sk = ms["sink"]
+                history_line += (
+                    f"\nLog channel: {sk['entries']} entries in {sk['messages']} msgs ({sk['attachments']} gz)"
+                    f" | Pending: {sk['pending']} | Failures: {sk['failures']} | Dropped: {sk['dropped']}"
+                )
+            cs = ms["compaction"]
+            history_line += (
+                f"\nNotes: {cs['stored']} stored, {cs['pending']} waiting | {cs['turns']} turns → {cs['notes']} updates"
+                f" (~{cs['tokens_in']} tokens in) | Deferred: {cs['deferred']} | Failures: {cs['failures']}"
+            )
+            rs = ms["recall"]
+            recall_avg = rs["seconds"] / rs["queries"] * 1000 if rs["queries"] else 0.0
+            history_line += (
+                f"\nRecall: {rs['docs']} msgs in {rs['indexes']} indexes | {rs['queries']} queries, {rs['hits']} hits"
+                f" | avg {recall_avg:.2f}ms, max {rs['max_seconds'] * 1000:.1f}ms"
+            )
+            embed.add_field(
+                name="Memory Store",
+                value=f"In RAM: {ms['entries']} entries / {ms['conversations']} conversations\n{store_line}\n{history_line}",
+                inline=False
+            )
+            for label, manager in (("Text Keys", key_manager), ("Image Keys", image_key_manager)):
+                if manager is None:
+                    continue
+                ks = manager.summary()
+                hottest = ", ".join(f"`{k}…` {uses} uses/{busy} busy" for k, uses, busy in ks["hottest"])
+                embed.add_field(
+                    name=f"{label} ({ks['policy']})",
+                    value=(
+                        f"Available: {ks['available']}/{ks['keys']} | In flight: {ks['outstanding']} | "
+                        f"Rebalances: {ks['rebalances']}\n"
+                        f"Busiest: {hottest or 'n/a'}"
+                    ),
+                    inline=False
+                )
+            await message.channel.send(embed=embed)
+
         elif cmd == "!time":
             embed = discord.Embed(
                 title="⏰ Bot Time Status",
@@ -2279,7 +3181,18 @@ async def on_message(message: discord.Message):
     else:
         guild = message.guild
         monika_member = guild.get_member(bot.user.id)
-        await handle_guild_message(message, avatar_url)
+        burst_key = (message.channel.id, message.author.id)
+        if BURST_WINDOW > 0 and not _is_direct(message):
+            # Fold quick follow-ups from the same user into one turn + one reply
+            await _burst_debouncer.submit(
+                burst_key,
+                message,
+                lambda batch: handle_guild_message(batch[-1], avatar_url, burst=batch)
+            )
+        else:
+            # Mentions/replies to Monika skip the window and take any waiting burst with them
+            burst = _burst_debouncer.take(burst_key) + [message]
+            await handle_guild_message(message, avatar_url, burst=burst)
         logger.info(f"[Mention] in server {guild.name}: from {message.author.display_name}")
 
     # ==============================
@@ -2409,6 +3322,7 @@ async def handle_dm_message(message: discord.Message, avatar_url: str = None):
     if is_broadcasting:
         return
     
+    started = t = time.perf_counter()
     user = message.author
     user_id = str(user.id)
 
@@ -2440,15 +3354,16 @@ async def handle_dm_message(message: discord.Message, avatar_url: str = None):
                 break
 
     # --- Build system prompt ---
-    system_prompt = await generate_monika_system_prompt(
+    system_prompt, volatile_prompt = await generate_monika_prompt_parts(
         guild=guild,
         user=user,
         relationship_type=relationship_type,
         selected_modes=personality
     )
+    t = pipeline_timer.lap("dm.prompt", t)
 
     # --- Conversation context ---
-    context_entries = await get_monika_context(message.channel, message.author, limit=20)
+    context_entries = await get_monika_context(message.channel, message.author, limit=20, exclude_ids={message.id})
     conversation = [{"role": "system", "content": system_prompt}]
     for entry in context_entries:
         # Skip empty or invalid entries early
@@ -2480,10 +3395,13 @@ async def handle_dm_message(message: discord.Message, avatar_url: str = None):
         if not content:
             continue
 
-        role = "assistant" if author == "Monika" else "user"
+        role = entry.get("role") or ("assistant" if author == "Monika" else "user")
         conversation.append({"role": role, "content": content})
     conversation.append({"role": "user", "content": message.content})
-    print(f"[DM Prompt]\n{system_prompt}")
+    volatile_prompt = "\n\n".join(filter(None, [volatile_prompt, recall_prompt(message.guild, message.author, message.content)]))
+    conversation = with_volatile_context(conversation, volatile_prompt)
+    print(f"[DM Prompt]\n{system_prompt}\n{volatile_prompt}")
+    t = pipeline_timer.lap("dm.context", t)
 
     # --- Defaults ---
     monika_DMS = None
@@ -2491,17 +3409,20 @@ async def handle_dm_message(message: discord.Message, avatar_url: str = None):
 
     # --- OpenAI ---
     try:
-        reply_text = await call_openai_with_retries(
+        reply_text, emotion = await get_reply_and_emotion(
             user=user,
             relationship=relationship_type,
             personality=personality,
-            conversation=conversation
+            conversation=conversation,
+            priority=PRIORITY_INTERACTIVE,
+            clean=lambda text: clean_monika_reply(text, bot_name, user.display_name)
         )
+        t = pipeline_timer.lap("dm.completion", t)
 
-        if reply_text:  # ✅ now it's just a string
-            monika_DMS = clean_monika_reply(reply_text, bot_name, user.display_name)
-            emotion = await classify_cached(monika_DMS)
+        if reply_text:  # ✅ already cleaned (and classified from the cleaned text)
+            monika_DMS = reply_text
             sprite_link = await get_sprite_link_cached(emotion, get_time_based_outfit())
+            t = pipeline_timer.lap("dm.sprite", t)
 
     except Exception as e:
         print(f"[DM OpenAI Error] {e}")
@@ -2520,15 +3441,26 @@ async def handle_dm_message(message: discord.Message, avatar_url: str = None):
 
     # --- Send reply ---
     reply = f"{monika_DMS}\n[{emotion}]({sprite_link})"
-    await message.author.send(reply)
+    sent = await message.author.send(reply)
+    record_conversation_turn(sent, user=message.author, content=monika_DMS)
+    remember_exchange(message, message.content, monika_DMS, emotion, avatar_url)
+    pipeline_timer.lap("dm.send", t)
+    pipeline_timer.record("dm.total", time.perf_counter() - started)
 
-async def handle_guild_message(message: discord.Message, avatar_url: str):
-    """Handle messages inside servers with personality/relationship context."""
+async def handle_guild_message(message: discord.Message, avatar_url: str, burst: Optional[list] = None):
+    """
+    Handle messages inside servers with personality/relationship context.
+    `burst` is the list of consecutive messages (ending with `message`) that
+    were folded into this one turn; defaults to just `message`.
+    """
     global last_reply_times, is_broadcasting
 
     if is_broadcasting:
         return
 
+    burst = burst or [message]
+    started = t = time.perf_counter()
+
     guild = message.guild
     user_id = str(message.author.id)
     user = message.author
@@ -2547,6 +3479,7 @@ async def handle_guild_message(message: discord.Message, avatar_url: str):
         await save_trackers()
     except FileNotFoundError:
         print("No backup files found yet.")
+    t = pipeline_timer.lap("guild.trackers", t)
 
     user_tracker.track_user(user_id, username, message.author.bot)
     pronouns = detect_pronouns_from_profile(member=user_id)
@@ -2589,16 +3522,17 @@ async def handle_guild_message(message: discord.Message, avatar_url: str):
         relationship_with = bot.user.name
 
     # --- Build system prompt ---
-    system_prompt = await generate_monika_system_prompt(
+    system_prompt, volatile_prompt = await generate_monika_prompt_parts(
         guild=guild,
         user=message.author,
         is_friend_context=is_friend,
         relationship_type=relationship_type,
         selected_modes=personality
     )
+    t = pipeline_timer.lap("guild.prompt", t)
 
     # --- Conversation context (fixed: use get_monika_context) ---
-    context_entries = await get_monika_context(message.channel, message.author, limit=20)
+    context_entries = await get_monika_context(message.channel, message.author, limit=20, exclude_ids={m.id for m in burst})
     conversation = [{"role": "system", "content": system_prompt}]
     for entry in context_entries:
         # Skip empty or invalid entries early
@@ -2630,26 +3564,51 @@ async def handle_guild_message(message: discord.Message, avatar_url: str):
         if not content:
             continue
 
-        role = "assistant" if author == "Monika" else "user"
+        role = entry.get("role") or ("assistant" if author == "Monika" else "user")
         conversation.append({"role": role, "content": content})
-    conversation.append({"role": "user", "content": message.content})
+    user_text = "\n".join(m.content for m in burst if m.content) or message.content
+    conversation.append({"role": "user", "content": user_text})
+    volatile_prompt = "\n\n".join(filter(None, [volatile_prompt, recall_prompt(message.guild, message.author, user_text)]))
+    conversation = with_volatile_context(conversation, volatile_prompt)
+    t = pipeline_timer.lap("guild.context", t)
 
     # --- Defaults ---
     monika_reply = random.choice(error_messages)
     emotion = "error"
     sprite_link = await error_emotion()
+    t = pipeline_timer.lap("guild.defaults", t)
 
     # --- CHAT REPLY (if no image-only)
+    can_send = not guild or message.channel.permissions_for(message.guild.me).send_messages
+    reply_started = time.perf_counter()
+    priority = PRIORITY_INTERACTIVE if any(bot.user in m.mentions for m in burst) else PRIORITY_CHANNEL
+    streamed_message = None
     try:
-        monika_reply = await call_openai_with_retries(
-            user=message.author,
-            relationship=relationship_type,
-            personality=personality,
-            conversation=conversation
-        )
+        monika_reply = None
+        if STREAM_REPLIES and not STRUCTURED_REPLIES and can_send:
+            streamed_message, monika_reply = await stream_reply(
+                message.channel,
+                message.author,
+                conversation,
+                clean=lambda text: clean_monika_reply(text, bot.user.name, username),
+                started=reply_started,
+                priority=priority
+            )
+            if monika_reply:
+                emotion = await classify_cached(monika_reply, **_usage_ids(message.author))
+
+        if not monika_reply:
+            monika_reply, emotion = await get_reply_and_emotion(
+                user=message.author,
+                relationship=relationship_type,
+                personality=personality,
+                conversation=conversation,
+                priority=priority
+            )
+
+        t = pipeline_timer.lap("guild.completion", t)
 
         if monika_reply:
-            emotion = await classify_cached(monika_reply)
             sprite_link = await get_sprite_link_cached(emotion, get_time_based_outfit())
         else:
             # fallback if no reply
@@ -2663,13 +3622,17 @@ async def handle_guild_message(message: discord.Message, avatar_url: str):
         emotion = "error"
         sprite_link = await error_emotion()
 
+    t = pipeline_timer.lap("guild.sprite", t)
+
     await update_auto_relationship(message.guild, message.author, relationship_type)
+    t = pipeline_timer.lap("guild.relationship", t)
 
     monika_reply = clean_monika_reply(monika_reply, bot.user.name, username)
 
     # --- Emoji + Sprite ---
     emoji = await avatar_to_emoji(bot, message.guild, user)
     outfit = server_outfit_preferences.get(guild_id, get_time_based_outfit())
+    t = pipeline_timer.lap("guild.emoji", t)
 
     reply = f"{monika_reply}\n[{emotion}]({sprite_link})"
     if isinstance(emoji, discord.Emoji):
@@ -2678,17 +3641,31 @@ async def handle_guild_message(message: discord.Message, avatar_url: str):
     if not isinstance(emoji, discord.Emoji):
         reply = f"{monika_reply}\n[{emotion}]({sprite_link})"
 
-    if not guild or message.channel.permissions_for(message.guild.me).send_messages:
+    if streamed_message is not None:
+        # Final edit: cleaned full text + sprite link
+        print(f"Reply: {monika_reply}")
+        print(f"Emotion: [{emotion}]")
+        await streamed_message.edit(content=reply)
+        record_conversation_turn(streamed_message, user=message.author, content=monika_reply)
+        remember_exchange(message, user_text, monika_reply, emotion, avatar_url)
+        if isinstance(emoji, discord.Emoji):
+            await emoji.delete()  # optional cleanup
+    elif can_send:
         async with message.channel.typing():
             print(f"Reply: {monika_reply}")
             print(f"Emotion: [{emotion}]")
             print(f"Link: ( {sprite_link} )")
             await asyncio.sleep(0.5)
-            await message.channel.send(reply)
+            sent = await message.channel.send(reply)
+            _reply_latency["buffered"].add(time.perf_counter() - reply_started)
+            record_conversation_turn(sent, user=message.author, content=monika_reply)
+            remember_exchange(message, user_text, monika_reply, emotion, avatar_url)
             if isinstance(emoji, discord.Emoji):
                 await emoji.delete()  # optional cleanup
     else:
         print(f"[Error] No permission to send in #{message.channel.name}")
+    pipeline_timer.lap("guild.send", t)
+    pipeline_timer.record("guild.total", time.perf_counter() - started)
 
     last_reply_times.setdefault(guild_id, {})[channel_id] = datetime.datetime.utcnow()
 
@@ -3327,11 +4304,14 @@ async def monika_idle_conversation_task():
                         f"I could talk to you forever, and it still wouldn’t feel like enough time, {chosen_user.display_name}.",
                     ]
 
-                    emotion = await user_sprites.classify(idle_lines)
+                    idle_line = random.choice(idle_lines)
+                    emotion = await user_sprites.classify(
+                        idle_line, priority=PRIORITY_IDLE, guild=guild.id, user=chosen_user.id
+                    )
                     outfit = server_outfit_preferences.get(guild, get_time_based_outfit())
                     sprite_link = await get_sprite_link(emotion, outfit)
 
-                    random_dialogue = f"{random.choice(idle_lines)}\n[{emotion}]({sprite_link})"
+                    random_dialogue = f"{idle_line}\n[{emotion}]({sprite_link})"
                     if MON_CHANNEL_NAMES:
                         async with channel.typing():
                             await asyncio.sleep(2)
@@ -4296,7 +5276,9 @@ async def reset_memory(interaction: discord.Interaction):
         return await interaction.followup.send("❌ Memory reset cancelled.", ephemeral=True)
 
     # ✅ Clear memory
-    memory.data[guild_id] = {}
+    await memory.clear_guild(guild_id)
+    for channel in interaction.guild.channels:
+        conversation_buffer.clear(channel_id=channel.id)
 
     state_text = "Cleared 🗑️"  # consistent with your “On / Off” style
     await interaction.followup.send(
@@ -5121,7 +6103,7 @@ async def restart_monika(interaction: discord.Interaction):
     # ✅ Reset trackers
     server_tracker.clear_relationship(guild_id)
     server_tracker.set_personality(guild_id, [])
-    memory.data(guild_id, [])
+    await memory.clear_guild(guild_id)
 
     # ✅ Remove all relationship/personality roles
     guild = interaction.guild
@@ -6032,17 +7014,27 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
 
 async def main():
     """Main bot runner with reconnect support."""
-    while True:
+    try:
+        while True:
+            try:
+                await bot.start(TOKEN, reconnect=True)
+            except aiohttp.client_exceptions.ClientConnectionResetError:
+                print("[Network Error] Connection reset — reconnecting...")
+                continue
+            except Exception as e:
+                print(f"[Bot Crash] {e}")
+                print("Reconnecting in 10 seconds...")
+                asyncio.run(asyncio.sleep(10))
+                continue
+    finally:
+        # The process is exiting (discord.py never dispatches on_close): drain the
+        # SQLite write-behind queue and the log sink, then drop the shared OpenAI
+        # pool, which is bound to this loop
         try:
-            await bot.start(TOKEN, reconnect=True)
-        except aiohttp.client_exceptions.ClientConnectionResetError:
-            print("[Network Error] Connection reset — reconnecting...")
-            continue
+            await memory.close()
         except Exception as e:
-            print(f"[Bot Crash] {e}")
-            print("Reconnecting in 10 seconds...")
-            asyncio.run(asyncio.sleep(10))
-            continue
+            print(f"[Shutdown] Memory close failed: {e}")
+        await close_shared_clients()
 
 async def safe_aiohttp_get(bot, url):
     """A safe get request with auto recovery."""
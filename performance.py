@@ -1,6 +1,6 @@
 # performance.py
-import asyncio, functools, tracemalloc, gc, psutil, os, time, base64, hashlib, json
-from collections import OrderedDict
+import asyncio, functools, tracemalloc, gc, psutil, os, sys, time, base64, hashlib, json, contextlib
+from collections import OrderedDict, deque
 from typing import Callable, Coroutine, Any, Optional
 
 # Start memory tracking
@@ -116,14 +116,189 @@ def _make_cache_key(args, kwargs) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 
-def cache_result(ttl: int = 300, max_size: Optional[int] = None):
+# ✅ Bounded LRU + TTL cache with stats and optional disk snapshot
+def _approx_size(obj) -> int:
+    """Rough byte size of a cached key/value (strings count their UTF-8 length)."""
+    if isinstance(obj, str):
+        return len(obj.encode("utf-8", "ignore"))
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(_approx_size(x) for x in obj) + 8 * len(obj)
+    return sys.getsizeof(obj)
+
+
+def _to_hashable(obj):
+    """Turn JSON-decoded lists back into tuples so snapshot keys stay hashable."""
+    if isinstance(obj, list):
+        return tuple(_to_hashable(x) for x in obj)
+    return obj
+
+
+class LRUCache:
+    """
+    Size-bounded cache with O(1) LRU eviction and lazy TTL expiry.
+
+    - max_entries / max_bytes: whichever limit is hit first evicts the
+      least-recently-used entries.
+    - ttl: default lifetime in seconds (None = never expires). Expired entries
+      are dropped when they are next touched, or evicted as LRU.
+    - snapshot_path: optional JSON file for save_snapshot()/load_snapshot(),
+      so a restart doesn't start cold. Only JSON-serializable entries are kept.
+    """
+
+    def __init__(self, name: str = "Cache", max_entries: int = 1000, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None, snapshot_path: Optional[str] = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self._data = OrderedDict()  # key -> (value, expires_at | None, size)
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "sets": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        item = self._data.get(key)
+        return item is not None and (item[1] is None or item[1] > time.time())
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return default
+        value, expires_at, _ = item
+        if expires_at is not None and expires_at <= time.time():
+            self._remove(key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return default
+        self._data.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        size = _approx_size(key) + _approx_size(value)
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (value, expires_at, size)
+        self.bytes += size
+        self.stats["sets"] += 1
+        self._enforce_limits()
+
+    def pop(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        self._remove(key)
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self.bytes -= size
+
+    def _enforce_limits(self):
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self.bytes -= size
+            self.stats["evictions"] += 1
+
+    def summary(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+    def save_snapshot(self, path: Optional[str] = None) -> int:
+        """Write live, JSON-serializable entries to disk. Returns the number saved."""
+        path = path or self.snapshot_path
+        if not path:
+            return 0
+        now = time.time()
+        rows = []
+        for key, (value, expires_at, _) in self._data.items():
+            if expires_at is not None and expires_at <= now:
+                continue
+            rows.append([key, value, expires_at])
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(rows, f, ensure_ascii=False, default=lambda o: None)
+            os.replace(tmp, path)
+            print(f"[{self.name}] 💾 Saved {len(rows)} entries to {path}")
+        except Exception as e:
+            print(f"[{self.name}] ⚠️ Snapshot save failed: {e}")
+            return 0
+        return len(rows)
+
+    def load_snapshot(self, path: Optional[str] = None) -> int:
+        """Restore entries written by save_snapshot(), skipping expired ones."""
+        path = path or self.snapshot_path
+        if not path or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                rows = json.load(f)
+        except Exception as e:
+            print(f"[{self.name}] ⚠️ Snapshot load failed: {e}")
+            return 0
+        now = time.time()
+        loaded = 0
+        for key, value, expires_at in rows:
+            if value is None or (expires_at is not None and expires_at <= now):
+                continue
+            key = _to_hashable(key)
+            size = _approx_size(key) + _approx_size(value)
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self.bytes += size
+            loaded += 1
+        self._enforce_limits()
+        print(f"[{self.name}] ♻️ Restored {loaded} entries from {path}")
+        return loaded
+
+
+def cache_result(ttl: int = 300, max_size: Optional[int] = None, cache: Optional[LRUCache] = None):
     """
     Cache results of a coroutine for `ttl` seconds.
     Optional max_size enforces LRU eviction when cache grows bigger than max_size.
+    Optional cache uses a shared LRUCache (its limits/stats/snapshot) instead.
     Usage: @cache_result(ttl=60, max_size=200)
     """
     def decorator(func: Callable[..., Coroutine[Any, Any, Any]]):
-        cache = OrderedDict()  # key -> (result, timestamp)
+        if cache is not None:
+            @functools.wraps(func)
+            async def cached_wrapper(*args, **kwargs):
+                key = _make_cache_key(args, kwargs)
+                result = cache.get(key)
+                if result is not None:
+                    return result
+                result = await func(*args, **kwargs)
+                if result is not None:
+                    cache.set(key, result, ttl=ttl)
+                return result
+
+            cached_wrapper._cache = cache
+            cached_wrapper._cache_ttl = ttl
+            return cached_wrapper
+
+        cache_dict = OrderedDict()  # key -> (result, timestamp)
 
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
@@ -131,40 +306,249 @@ def cache_result(ttl: int = 300, max_size: Optional[int] = None):
             now = time.time()
 
             # hit & fresh
-            if key in cache:
-                result, ts = cache[key]
+            if key in cache_dict:
+                result, ts = cache_dict[key]
                 if now - ts < ttl:
                     # move to end for LRU behavior
                     try:
-                        cache.move_to_end(key)
+                        cache_dict.move_to_end(key)
                     except Exception:
                         pass
                     return result
                 else:
                     # expired
                     try:
-                        del cache[key]
+                        del cache_dict[key]
                     except Exception:
                         pass
 
             # call and store
             result = await func(*args, **kwargs)
-            cache[key] = (result, now)
+            cache_dict[key] = (result, now)
 
             # enforce size limit
             if max_size is not None:
-                while len(cache) > max_size:
-                    cache.popitem(last=False)  # pop oldest
+                while len(cache_dict) > max_size:
+                    cache_dict.popitem(last=False)  # pop oldest
 
             return result
 
         # expose internals for debugging if needed
-        wrapper._cache = cache
+        wrapper._cache = cache_dict
         wrapper._cache_ttl = ttl
         return wrapper
 
     return decorator
 
+# ✅ Single-flight (coalesce identical in-flight coroutines)
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into one running task.
+
+    The first caller (the "leader") starts the work; every caller that arrives
+    while it is still running awaits the same task instead of starting its own.
+    The shared task is shielded, so one waiter being cancelled never cancels
+    the work for the others.
+
+    Usage:
+        flight = SingleFlight("OpenAI")
+        result = await flight.run(key, lambda: expensive_call())
+    """
+
+    def __init__(self, name: str = "SingleFlight"):
+        self.name = name
+        self._inflight: dict[Any, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "errors": 0}
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def run(self, key, coro_factory: Callable[[], Coroutine[Any, Any, Any]]):
+        task = self._inflight.get(key)
+        if task is not None and not task.done():
+            self.stats["coalesced"] += 1
+            print(f"[{self.name}] 🔗 Coalesced onto in-flight request ({len(self._inflight)} in flight)")
+            return await asyncio.shield(task)
+
+        self.stats["leaders"] += 1
+        task = asyncio.ensure_future(coro_factory())
+        self._inflight[key] = task
+
+        def _done(t: asyncio.Task, key=key):
+            if self._inflight.get(key) is t:
+                del self._inflight[key]
+            if not t.cancelled() and t.exception() is not None:
+                self.stats["errors"] += 1
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def summary(self) -> dict:
+        total = self.stats["leaders"] + self.stats["coalesced"]
+        ratio = self.stats["coalesced"] / total if total else 0.0
+        return {**self.stats, "in_flight": len(self._inflight), "coalesce_ratio": round(ratio, 3)}
+
+# ✅ Rolling latency window (percentiles over the last N samples)
+class LatencyWindow:
+    """
+    Keep the last `size` latency samples (seconds) and answer percentile queries.
+    Percentiles sort a copy of the window, which is cheap at the default size.
+    """
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def percentile(self, pct: float, default: Optional[float] = None) -> Optional[float]:
+        if not self.samples:
+            return default
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+        return ordered[idx]
+
+    def mean(self, default: Optional[float] = None) -> Optional[float]:
+        if not self.samples:
+            return default
+        return sum(self.samples) / len(self.samples)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+# ✅ Per-stage pipeline timings
+class StageTimer:
+    """
+    Named LatencyWindows for the stages of a pipeline.
+
+    Usage:
+        t = time.perf_counter()
+        ...build prompt...
+        t = timer.lap("guild.prompt", t)   # records and returns a fresh start
+        with timer.stage("guild.send"):
+            ...
+    """
+
+    def __init__(self, name: str = "Pipeline", size: int = 1000):
+        self.name = name
+        self.size = size
+        self.windows: dict[str, LatencyWindow] = {}
+
+    def record(self, stage: str, seconds: float):
+        window = self.windows.get(stage)
+        if window is None:
+            window = self.windows[stage] = LatencyWindow(self.size)
+        window.add(seconds)
+
+    def lap(self, stage: str, since: float) -> float:
+        now = time.perf_counter()
+        self.record(stage, now - since)
+        return now
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def reset(self):
+        self.windows.clear()
+
+    def summary(self) -> dict:
+        return {stage: window.summary() for stage, window in self.windows.items()}
+
+# ✅ Debouncer (fold bursts of items per key into one flush)
+class Debouncer:
+    """
+    Collect items per key and flush them together once the key has been quiet
+    for `window` seconds (or `max_wait` seconds after the first item, so a
+    steady stream still gets flushed).
+
+    Usage:
+        bursts = Debouncer("Burst", window=1.0, max_wait=4.0)
+        await bursts.submit(key, item, handle_batch)  # handle_batch(items) runs later
+    """
+
+    def __init__(self, name: str = "Debouncer", window: float = 1.0, max_wait: Optional[float] = None):
+        self.name = name
+        self.window = window
+        self.max_wait = max_wait
+        self._pending: dict[Any, dict] = {}  # key -> {"items", "first", "deadline", "task", "callback"}
+        self.stats = {"items": 0, "flushes": 0, "folded": 0}
+
+    def __contains__(self, key) -> bool:
+        return key in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def submit(self, key, item, callback: Callable[[list], Coroutine[Any, Any, Any]]):
+        self.stats["items"] += 1
+        entry = self._pending.get(key)
+        now = time.monotonic()
+        if entry is None:
+            entry = self._pending[key] = {"items": [], "first": now, "task": None}
+        else:
+            self.stats["folded"] += 1
+        entry["items"].append(item)
+        entry["callback"] = callback
+        self._schedule(key, entry, now)
+
+    def touch(self, key):
+        """Push the flush back (e.g. the user is still typing). No-op if nothing is pending."""
+        entry = self._pending.get(key)
+        if entry is not None:
+            self._schedule(key, entry, time.monotonic())
+
+    def take(self, key) -> list:
+        """Cancel a pending flush and hand its items to the caller."""
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return []
+        entry["task"].cancel()
+        return entry["items"]
+
+    def _schedule(self, key, entry: dict, now: float):
+        delay = self.window
+        if self.max_wait is not None:
+            delay = max(0.0, min(delay, entry["first"] + self.max_wait - now))
+        if entry["task"] is not None:
+            entry["task"].cancel()
+        entry["task"] = asyncio.ensure_future(self._flush_later(key, entry, delay))
+
+    async def _flush_later(self, key, entry: dict, delay: float):
+        await asyncio.sleep(delay)
+        # Detach before running so new items start a fresh burst
+        if self._pending.get(key) is entry:
+            del self._pending[key]
+        self.stats["flushes"] += 1
+        try:
+            await entry["callback"](entry["items"])
+        except Exception as e:
+            print(f"[{self.name}] ❌ Flush failed: {e}")
+
+    def summary(self) -> dict:
+        items = self.stats["items"]
+        ratio = self.stats["folded"] / items if items else 0.0
+        return {**self.stats, "pending": len(self._pending), "fold_ratio": round(ratio, 3)}
+
 # ✅ Memory usage
 def get_memory_usage():
     process = psutil.Process(os.getpid())
@@ -0,0 +1,481 @@
+"""
+Offline end-to-end benchmark for the message → reply pipeline.
+
+Drives handle_guild_message / handle_dm_message (and optionally image_generator)
+with fake Discord objects against a local stub of the OpenAI chat/images API,
+then reports p50/p95/p99 per pipeline stage (monika_bot.pipeline_timer) and
+overall throughput. No Discord token or OpenAI key is needed.
+
+Usage:
+    python pipeline_benchmark.py --messages 200 --concurrency 8
+    python pipeline_benchmark.py --latency 0.8 --jitter 0.3 --error-rate 0.05 --stream
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+
+from aiohttp import web
+
+from usage_tracker import usage_tracker
+
+# ================== Stub OpenAI server ================== #
+
+STUB_REPLIES = [
+    "Ahaha, that's so sweet of you! I was just thinking about our last talk.",
+    "Hmm... I'm not sure about that. Can you tell me more?",
+    "That makes me really happy~ Let's keep going!",
+    "Oh no, that sounds rough. I'm here for you, okay?",
+]
+
+# 1x1 transparent PNG
+STUB_IMAGE_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+class StubOpenAI:
+    """aiohttp app that mimics /v1/chat/completions, /v1/images/generations and /v1/models."""
+
+    def __init__(self, latency: float = 0.3, jitter: float = 0.1, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, image_latency: float = 2.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.image_latency = image_latency
+        self.stats = {"chat": 0, "stream": 0, "images": 0, "errors": 0, "rate_limited": 0}
+        self.seen_prefixes = set()  # leading system prompts already "cached"
+        self.runner = None
+        self.base_url = None
+
+    def _delay(self, base: float) -> float:
+        return max(0.0, random.uniform(base - self.jitter, base + self.jitter))
+
+    def _injected_error(self):
+        roll = random.random()
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "stub server error", "type": "server_error"}}, status=500
+            )
+        if roll < self.error_rate + self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after-ms": "200", "x-ratelimit-remaining-requests": "0",
+                         "x-ratelimit-reset-requests": "200ms"}
+            )
+        return None
+
+    @staticmethod
+    def _reply_for(body: dict) -> str:
+        messages = body.get("messages") or []
+        system = messages[0].get("content", "") if messages else ""
+        if "Return ONLY one label" in system:
+            return "neutral"
+        reply = random.choice(STUB_REPLIES)
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps({"reply": reply, "emotion": "happy"})
+        return reply
+
+    def _usage(self, body: dict, completion_tokens: int) -> dict:
+        """~4 chars per token; a repeated leading system message counts as cached (prefix caching)."""
+        messages = body.get("messages") or []
+        prompt_tokens = max(1, sum(len(str(m.get("content", ""))) for m in messages) // 4)
+        cached_tokens = 0
+        if messages and messages[0].get("role") == "system":
+            prefix = messages[0].get("content", "")
+            if prefix in self.seen_prefixes:
+                cached_tokens = len(prefix) // 4
+            self.seen_prefixes.add(prefix)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    async def chat(self, request: web.Request):
+        body = await request.json()
+        error = self._injected_error()
+        if error is not None:
+            await asyncio.sleep(self._delay(self.latency) / 4)
+            return error
+
+        reply = self._reply_for(body)
+        model = body.get("model", "stub")
+        created = int(time.time())
+
+        if not body.get("stream"):
+            self.stats["chat"] += 1
+            await asyncio.sleep(self._delay(self.latency))
+            return web.json_response({
+                "id": f"chatcmpl-stub-{created}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": self._usage(body, len(reply.split())),
+            })
+
+        # Streaming: spread the latency over the words of the reply
+        self.stats["stream"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = reply.split(" ")
+        per_chunk = self._delay(self.latency) / max(1, len(words))
+        for i, word in enumerate(words):
+            await asyncio.sleep(per_chunk)
+            chunk = {
+                "id": f"chatcmpl-stub-{created}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else f" {word}"}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {
+                "id": f"chatcmpl-stub-{created}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": self._usage(body, len(words)),
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images(self, request: web.Request):
+        await request.json()
+        error = self._injected_error()
+        if error is not None:
+            return error
+        self.stats["images"] += 1
+        await asyncio.sleep(self._delay(self.image_latency))
+        return web.json_response({"created": int(time.time()), "data": [{"b64_json": STUB_IMAGE_B64}]})
+
+    async def models(self, request: web.Request):
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": m, "object": "model", "created": 0, "owned_by": "stub"}
+                     for m in ("gpt-5-nano", "gpt-5-mini", "gpt-3.5-turbo", "gpt-image-1")],
+        })
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/images/generations", self.images)
+        app.router.add_get("/v1/models", self.models)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}/v1"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+# ================== Fake Discord objects ================== #
+
+_ids = itertools.count(10_000_000)
+DISCORD_LATENCY = 0.0  # simulated REST latency for sends/edits (set from --discord-latency)
+
+async def _discord_call():
+    if DISCORD_LATENCY:
+        await asyncio.sleep(DISCORD_LATENCY)
+
+class FakeAsset:
+    def __init__(self, url: str):
+        self.url = url
+
+class FakeAttachment:
+    def __init__(self, filename: str = "file.png"):
+        self.id = next(_ids)
+        self.filename = filename
+        self.url = f"https://cdn.example.invalid/attachments/{self.id}/{filename}"
+
+class FakeRole:
+    def __init__(self, name: str):
+        self.id = next(_ids)
+        self.name = name
+
+class FakePermissions:
+    send_messages = True
+    manage_roles = True
+    manage_emojis = True
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.global_name = name
+        self.bot = bot
+        self.roles = []
+        self.avatar = None  # avatar_to_emoji bails out without a network fetch
+        self.display_avatar = FakeAsset(f"https://cdn.example.invalid/avatars/{user_id}.png")
+        self.mention = f"<@{user_id}>"
+        self.dm_channel = None
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, **kwargs):
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(self)
+        return await self.dm_channel.send(content, **kwargs)
+
+class FakeMember(FakeUser):
+    def __init__(self, user_id: int, name: str, guild, bot: bool = False):
+        super().__init__(user_id, name, bot=bot)
+        self.guild = guild
+
+    async def add_roles(self, *roles, reason=None):
+        await _discord_call()
+        self.roles.extend(r for r in roles if r not in self.roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await _discord_call()
+        self.roles = [r for r in self.roles if r not in roles]
+
+class FakeMessage:
+    def __init__(self, content: str, author, channel, mentions=None, attachments=None):
+        self.id = next(_ids)
+        self.content = content or ""
+        self.author = author
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.mentions = mentions or []
+        self.attachments = attachments or []
+        self.embeds = []
+        self.reference = None
+
+    async def edit(self, content=None, **kwargs):
+        await _discord_call()
+        if content is not None:
+            self.content = content
+        return self
+
+    async def delete(self):
+        await _discord_call()
+
+class FakeTextChannel:
+    def __init__(self, channel_id: int, name: str, guild=None):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.messages = []
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, file=None, files=None, embed=None, **kwargs):
+        await _discord_call()
+        attachments = [FakeAttachment(getattr(f, "filename", None) or "file.png") for f in ([file] if file else []) + list(files or [])]
+        message = FakeMessage(content, BOT_USER, self, attachments=attachments)
+        self.messages.append(message)
+        del self.messages[:-200]  # keep the fake history bounded
+        return message
+
+    async def history(self, limit=100, oldest_first=False, **kwargs):
+        await _discord_call()
+        messages = self.messages[-limit:] if limit else list(self.messages)
+        for message in (messages if oldest_first else reversed(messages)):
+            yield message
+
+class FakeDMChannel(FakeTextChannel):
+    def __init__(self, recipient):
+        super().__init__(next(_ids), "dm")
+        self.recipient = recipient
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.roles = []
+        self.emojis = []
+        self.members = {}
+        self.me = None
+
+    def get_member(self, user_id):
+        return self.members.get(int(user_id))
+
+    def get_role(self, role_id):
+        return next((r for r in self.roles if r.id == role_id), None)
+
+    async def create_role(self, name=None, **kwargs):
+        await _discord_call()
+        role = FakeRole(name or "role")
+        self.roles.append(role)
+        return role
+
+    async def create_custom_emoji(self, name=None, image=None, **kwargs):
+        raise RuntimeError("emoji creation is not simulated")
+
+BOT_USER = FakeUser(1_000_001, "Monika", bot=True)
+
+# ================== Benchmark ================== #
+
+def _install_fakes(bot, storage_channel):
+    """Point the discord.py client at the fakes (no gateway connection is made)."""
+    bot._connection.user = BOT_USER
+    bot.get_channel = lambda channel_id: storage_channel
+
+def _print_report(timer, extra: dict, wall: float, completed: int, failed: int, stub: StubOpenAI, args, out=None):
+    out = out or sys.stdout
+    print(file=out)
+    print(f"[Bench] Pipeline: {completed} messages in {wall:.2f}s → {completed / wall:.2f} msg/s "
+          f"(concurrency {args.concurrency}, failed {failed})", file=out)
+    print(f"[Bench] Stub OpenAI: {stub.stats}", file=out)
+    usage = usage_tracker.summary()
+    print(f"[Bench] Usage: {usage['calls']} calls | {usage['prompt']} prompt + {usage['completion']} completion tokens "
+          f"| cached {usage['cache_ratio']:.0%} | ~${usage['cost']:.4f}", file=out)
+    print(f"{'stage':<22}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+    rows = {**timer.summary(), **{name: w.summary() for name, w in extra.items() if len(w)}}
+    for stage, s in sorted(rows.items()):
+        print(f"{stage:<22}{s['count']:>7}{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}", file=out)
+
+async def run_benchmark(args, out=None):
+    global DISCORD_LATENCY
+    DISCORD_LATENCY = args.discord_latency
+
+    stub = StubOpenAI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        image_latency=args.image_latency,
+    )
+    os.environ["OPENAI_BASE_URL"] = await stub.start()
+
+    import monika_bot
+    import OpenAIKeys
+    from OpenAIKeys import OpenAIKeyManager
+
+    keys = [f"sk-stub-{i:03d}" for i in range(args.keys)]
+    text_manager = OpenAIKeyManager(keys)
+    image_manager = OpenAIKeyManager([f"sk-stub-img-{i:03d}" for i in range(max(1, args.keys // 4))], is_image=True)
+    OpenAIKeys.key_manager = monika_bot.key_manager = text_manager
+    OpenAIKeys.image_key_manager = monika_bot.image_key_manager = image_manager
+
+    guild = FakeGuild(2_000_001, "Benchmark Club")
+    monika_member = FakeMember(BOT_USER.id, BOT_USER.name, guild, bot=True)
+    guild.members[BOT_USER.id] = monika_member
+    guild.me = monika_member
+    storage = FakeTextChannel(3_000_000, "storage", guild)
+    channels = [FakeTextChannel(3_000_001 + i, f"chat-{i}", guild) for i in range(args.channels)]
+    users = []
+    for i in range(args.users):
+        member = FakeMember(4_000_001 + i, f"user{i}", guild)
+        guild.members[member.id] = member
+        users.append(member)
+    _install_fakes(monika_bot.bot, storage)
+
+    timer = monika_bot.pipeline_timer
+    timer.reset()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failed = 0
+    rng = random.Random(args.seed)
+
+    async def one(i: int):
+        nonlocal failed
+        user = rng.choice(users)
+        roll = rng.random()
+        async with semaphore:
+            try:
+                if roll < args.image_share:
+                    channel = rng.choice(channels)
+                    message = FakeMessage(f"!monika generates: a sunset #{i}", user, channel)
+                    with timer.stage("image.total"):
+                        await monika_bot.image_generator(message, relationship="Friend")
+                elif roll < args.image_share + args.dm_share:
+                    if user.dm_channel is None:
+                        user.dm_channel = FakeDMChannel(user)
+                    message = FakeMessage(f"hey monika, dm number {i}", user, user.dm_channel)
+                    user.dm_channel.messages.append(message)
+                    monika_bot.record_conversation_turn(message)
+                    await monika_bot.handle_dm_message(message)
+                else:
+                    channel = rng.choice(channels)
+                    mentioned = rng.random() < args.mention_share
+                    message = FakeMessage(
+                        f"{BOT_USER.mention if mentioned else ''} message number {i}, how are you?".strip(),
+                        user, channel, mentions=[BOT_USER] if mentioned else []
+                    )
+                    channel.messages.append(message)
+                    monika_bot.record_conversation_turn(message)
+                    await monika_bot.handle_guild_message(message, None)
+            except Exception as e:
+                failed += 1
+                print(f"[Bench] ❌ message {i} failed: {type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.messages)))
+    wall = time.perf_counter() - start
+
+    await OpenAIKeys.close_shared_clients()
+    await stub.stop()
+    extra = {f"reply.{name}": window for name, window in monika_bot._reply_latency.items()}
+    _print_report(timer, extra, wall, args.messages - failed, failed, stub, args, out=out)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100, help="total messages to drive")
+    parser.add_argument("--concurrency", type=int, default=8, help="messages in flight at once")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=8, help="fake text keys")
+    parser.add_argument("--latency", type=float, default=0.3, help="stub completion latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="± uniform jitter on stub latency (s)")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="stub image latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stub calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of stub calls answered with 429")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="simulated Discord REST latency (s)")
+    parser.add_argument("--dm-share", type=float, default=0.2)
+    parser.add_argument("--mention-share", type=float, default=0.3)
+    parser.add_argument("--image-share", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true", help="run with STREAM_REPLIES=1")
+    parser.add_argument("--quiet", action="store_true", help="silence the bot's own logging")
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Import-time settings must be in the environment before monika_bot loads
+    os.environ["STREAM_REPLIES"] = "1" if args.stream else os.getenv("STREAM_REPLIES", "0")
+    random.seed(args.seed)
+    report_out = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w")
+    asyncio.run(run_benchmark(args, out=report_out))
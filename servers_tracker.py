@@ -71,6 +71,7 @@ class GuildTracker:
         self.last_backup_message = None
         self.save_channel_id = None
         self.guilds: dict[str, dict] = {}
+        self.on_change = None  # optional callback(guild_id) when prompt-relevant settings change
     
         self.personality_modes = {
             # 🌸 Core / Default
@@ -256,6 +257,13 @@ class GuildTracker:
             channels = self.data.setdefault(guild_id, {}).setdefault("channels", {})
             channels[channel_id] = channel_name
     
+    def _notify_change(self, guild_id):
+        if self.on_change:
+            try:
+                self.on_change(str(guild_id))
+            except Exception as e:
+                print(f"[GuildTracker] on_change hook failed: {e}")
+
     def set_toggle(self, guild_id: str, key: str, value: bool):
         self.ensure_guild(guild_id)
         self.guilds[guild_id]["toggles"][key] = value
@@ -283,6 +291,7 @@ class GuildTracker:
 
         self.data.setdefault(str(guild_id), {})
         self.data[str(guild_id)]["personality"] = clean_personality
+        self._notify_change(guild_id)
 
     def get_personality(self, guild_id):
         personality = self.data.get(guild_id, {}).get("personality", [])
@@ -333,6 +342,8 @@ class GuildTracker:
                 raise ValueError("`with_list` must be a list of user IDs or names.")
             self.data[guild_id]["relationship"]["with"] = with_list
 
+        self._notify_change(guild_id)
+
     def get_server_relationship(self, guild_id):
         return self.data.get(guild_id, {}).get("relationship", {})
 
@@ -361,15 +372,18 @@ class GuildTracker:
         self.data.setdefault(guild_id, {}).setdefault("relationship", {}).setdefault("with", [])
         if user_id not in self.data[guild_id]["relationship"]["with"]:
             self.data[guild_id]["relationship"]["with"].append(user_id)
+            self._notify_change(guild_id)
 
     def remove_relationship_with(self, guild_id, user_id):
         with_list = self.data.get(guild_id, {}).get("relationship", {}).get("with", [])
         if user_id in with_list:
             with_list.remove(user_id)
+            self._notify_change(guild_id)
 
     def clear_relationship(self, guild_id):
         if guild_id in self.data and "relationship" in self.data[guild_id]:
             self.data[guild_id]["relationship"] = {}
+            self._notify_change(guild_id)
 
     def auto_set_relationship_level(self, guild_id, level):
         # Called internally, not user-exposed
@@ -395,6 +409,7 @@ class GuildTracker:
     def set_language(self, guild_id: str, lang_code: str):
         self.ensure_guild(guild_id)
         self.guilds[guild_id]["language"] = lang_code
+        self._notify_change(guild_id)
 
     def get_language(self, guild_id: str) -> str:
         self.ensure_guild(guild_id)
@@ -0,0 +1,190 @@
+# usage_tracker.py
+import os, time, json, hashlib
+from collections import deque
+from typing import Optional
+
+# ================== Usage Ledger ================== #
+# Every OpenAI call that returns `usage` is recorded here, tagged with
+# feature / model / key fingerprint / guild / user. Totals are kept since
+# startup plus per-minute buckets for rolling windows (last USAGE_RETENTION_HOURS).
+
+USAGE_RETENTION_HOURS = int(os.getenv("USAGE_RETENTION_HOURS", "24"))
+USAGE_MAX_TAG_VALUES = int(os.getenv("USAGE_MAX_TAG_VALUES", "5000"))  # lifetime rows per dimension
+OTHER = "(other)"  # lifetime totals of evicted low-cost guilds/users/keys
+
+# USD per 1M tokens: (input, cached input, output). Override/extend with
+# OPENAI_PRICES='{"model": [input, cached, output]}'. Unknown models cost 0.
+MODEL_PRICES = {
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-image-1": (5.00, 1.25, 40.00),
+}
+try:
+    MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("OPENAI_PRICES", "{}")).items()})
+except (ValueError, TypeError, AttributeError):
+    print("[Usage] ⚠️ OPENAI_PRICES is not valid JSON → using defaults")
+
+USAGE_DIMENSIONS = ("feature", "model", "key", "guild", "user")
+
+# counts layout: [calls, prompt, completion, cached, latency_sum, cost]
+CALLS, PROMPT, COMPLETION, CACHED, LATENCY, COST = range(6)
+
+def key_fingerprint(key: Optional[str]) -> str:
+    """Short, non-reversible id for an API key (safe to show in reports)."""
+    if not key:
+        return "unknown"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:10]
+
+def usage_counts(usage) -> tuple[int, int, int]:
+    """(prompt, completion, cached) from chat (`prompt_tokens`) or image (`input_tokens`) usage."""
+    prompt = getattr(usage, "prompt_tokens", None)
+    if prompt is None:
+        prompt = getattr(usage, "input_tokens", 0)
+    completion = getattr(usage, "completion_tokens", None)
+    if completion is None:
+        completion = getattr(usage, "output_tokens", 0)
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    return prompt or 0, completion or 0, cached or 0
+
+def estimate_cost(model: str, prompt: int, completion: int, cached: int) -> float:
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        # Dated snapshots ("gpt-5-mini-2025-08-07") bill like their base model
+        price = next((p for name, p in MODEL_PRICES.items() if model.startswith(name + "-")), None)
+    if price is None:
+        return 0.0
+    input_price, cached_price, output_price = price
+    return ((prompt - cached) * input_price + cached * cached_price + completion * output_price) / 1_000_000
+
+class UsageTracker:
+    """
+    Token/cost ledger with lifetime totals and per-minute rolling buckets.
+    Memory is bounded: one bucket per minute holding only the tag values seen
+    in it, and at most max_tag_values lifetime rows per dimension (the
+    cheapest ones are folded into OTHER).
+    """
+
+    def __init__(self, retention_hours: int = USAGE_RETENTION_HOURS, max_tag_values: int = USAGE_MAX_TAG_VALUES):
+        self.retention = retention_hours * 60
+        self.max_tag_values = max_tag_values
+        self.totals = {dim: {} for dim in USAGE_DIMENSIONS}  # dim -> value -> counts
+        self.buckets = deque()  # (minute, {(dim, value): counts})
+        self.started = time.time()
+
+    @staticmethod
+    def _add(table: dict, name, calls, prompt, completion, cached, latency, cost):
+        counts = table.get(name)
+        if counts is None:
+            counts = table[name] = [0, 0, 0, 0, 0.0, 0.0]
+        counts[CALLS] += calls
+        counts[PROMPT] += prompt
+        counts[COMPLETION] += completion
+        counts[CACHED] += cached
+        counts[LATENCY] += latency
+        counts[COST] += cost
+
+    def record(self, usage, *, model: str, key: Optional[str] = None, feature: str = "other",
+               guild=None, user=None, latency: float = 0.0):
+        """Record one call's `usage` object (no-op when the response carried none)."""
+        if usage is None:
+            return
+        prompt, completion, cached = usage_counts(usage)
+        cost = estimate_cost(model or "", prompt, completion, cached)
+        tags = {
+            "feature": feature,
+            "model": model or "unknown",
+            "key": key_fingerprint(key),
+            "guild": str(guild) if guild else "DM",
+            "user": str(user) if user else None,
+        }
+
+        minute = int(time.time() // 60)
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append((minute, {}))
+            while self.buckets and self.buckets[0][0] <= minute - self.retention:
+                self.buckets.popleft()
+        bucket = self.buckets[-1][1]
+
+        for dim, value in tags.items():
+            if value is None:
+                continue
+            table = self.totals[dim]
+            self._add(table, value, 1, prompt, completion, cached, latency, cost)
+            if len(table) > self.max_tag_values:
+                self._fold(table)
+            self._add(bucket, (dim, value), 1, prompt, completion, cached, latency, cost)
+
+    def _fold(self, table: dict):
+        """Merge the cheapest quarter of a lifetime table into OTHER (amortized O(1) per record)."""
+        evict = sorted((name for name in table if name != OTHER), key=lambda name: table[name][COST])
+        for name in evict[:max(1, len(table) // 4)]:
+            self._add(table, OTHER, *table.pop(name))
+
+    def record_response(self, response, *, latency: float = 0.0, **tags):
+        """Convenience for API responses: pulls `usage` and falls back to `response.model`."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        tags.setdefault("model", getattr(response, "model", None))
+        self.record(usage, latency=latency, **tags)
+
+    # ---------------- Reports ---------------- #
+
+    def window(self, dim: str, seconds: Optional[float] = None) -> dict:
+        """value -> counts for `dim`, over the last `seconds` (None = since startup)."""
+        if seconds is None:
+            return self.totals[dim]
+        since = int((time.time() - seconds) // 60)
+        result = {}
+        for minute, bucket in reversed(self.buckets):
+            if minute <= since:
+                break
+            for (bucket_dim, value), counts in bucket.items():
+                if bucket_dim == dim:
+                    self._add(result, value, *counts)
+        return result
+
+    def top(self, dim: str, seconds: Optional[float] = None, limit: int = 5, by: int = COST) -> list:
+        """Top `limit` rows for `dim` as dicts, sorted by cost (then tokens)."""
+        rows = sorted(
+            self.window(dim, seconds).items(),
+            key=lambda item: (item[1][by], item[1][PROMPT] + item[1][COMPLETION]),
+            reverse=True
+        )
+        return [
+            {
+                "name": name,
+                "calls": counts[CALLS],
+                "prompt": counts[PROMPT],
+                "completion": counts[COMPLETION],
+                "cached": counts[CACHED],
+                "avg_prompt": counts[PROMPT] / counts[CALLS] if counts[CALLS] else 0.0,
+                "avg_latency": counts[LATENCY] / counts[CALLS] if counts[CALLS] else 0.0,
+                "cost": counts[COST],
+            }
+            for name, counts in rows[:limit]
+        ]
+
+    def summary(self, seconds: Optional[float] = None) -> dict:
+        """Grand totals (summed over features so every call is counted once)."""
+        calls = prompt = completion = cached = 0
+        cost = 0.0
+        for counts in self.window("feature", seconds).values():
+            calls += counts[CALLS]
+            prompt += counts[PROMPT]
+            completion += counts[COMPLETION]
+            cached += counts[CACHED]
+            cost += counts[COST]
+        return {
+            "calls": calls,
+            "prompt": prompt,
+            "completion": completion,
+            "cached": cached,
+            "cache_ratio": cached / prompt if prompt else 0.0,
+            "cost": cost,
+        }
+
+usage_tracker = UsageTracker()
@@ -9,9 +9,17 @@ class UserTracker:
         self.data = {}  # user_id: {name, avatar, pronouns, last_seen}
         self.users = {}
         self.last_backup_message = None
+        self.on_change = None  # optional callback(user_id) when prompt-relevant settings change
 
     def _now(self):
         return datetime.utcnow().isoformat()
+
+    def _notify_change(self, user_id):
+        if self.on_change:
+            try:
+                self.on_change(str(user_id))
+            except Exception as e:
+                print(f"[UserTracker] on_change hook failed: {e}")
     
     # ✅ Set language
     def set_language(self, user_id: str, lang_code: str):
@@ -133,7 +141,10 @@ class UserTracker:
         """Save pronouns for a user."""
         if user_id not in self.users:
             self.users[user_id] = {}
+        changed = self.users[user_id].get("pronouns") != pronouns
         self.users[user_id]["pronouns"] = pronouns
+        if changed:
+            self._notify_change(user_id)
 
     def get_pronouns(self, user_id: str):
         """Retrieve saved pronouns, or None if unset."""
@@ -165,6 +176,8 @@ class UserTracker:
         else:
             self.data[uid]["relationship"] = relationship
 
+        if prev != relationship:
+            self._notify_change(uid)
         return prev != relationship
 
     def get_relationship(self, user_id: str) -> str:
@@ -175,7 +188,10 @@ class UserTracker:
     def set_language(self, user_id: str, lang_code: str):
         if user_id not in self.users:
             self.users[user_id] = {}
+        changed = self.users[user_id].get("language") != lang_code
         self.users[user_id]["language"] = lang_code
+        if changed:
+            self._notify_change(user_id)
 
     def get_language(self, user_id: str) -> str:
         return self.users.get(user_id, {}).get("language", "en")